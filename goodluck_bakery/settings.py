@@ -33,6 +33,7 @@ INSTALLED_APPS = [
     'django.contrib.contenttypes',
     'django.contrib.sessions',
     'django.contrib.messages',
+    'whitenoise.runserver_nostatic',
     'django.contrib.staticfiles',
     'django.contrib.sites',
     # Third party apps
@@ -43,23 +44,36 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'shop.middleware.MetricsMiddleware',
     'django.middleware.security.SecurityMiddleware',
+    'shop.middleware.StaticFilesMiddleware',
+    'shop.media.MediaFilesMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
+    'shop.db_router.ReplicaPinningMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
+    'shop.carts.CookieCartMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
 ]
 
 ROOT_URLCONF = 'goodluck_bakery.urls'
 
+TEMPLATE_LOADERS = [
+    'django.template.loaders.filesystem.Loader',
+    'django.template.loaders.app_directories.Loader',
+]
+if not DEBUG:
+    # Keep compiled templates in memory in production.
+    TEMPLATE_LOADERS = [('django.template.loaders.cached.Loader', TEMPLATE_LOADERS)]
+
 TEMPLATES = [
     {
         'BACKEND': 'django.template.backends.django.DjangoTemplates',
         'DIRS': [BASE_DIR / 'templates'],
-        'APP_DIRS': True,
         'OPTIONS': {
+            'loaders': TEMPLATE_LOADERS,
             'context_processors': [
                 'django.template.context_processors.debug',
                 'django.template.context_processors.request',
@@ -75,13 +89,40 @@ TEMPLATES = [
 WSGI_APPLICATION = 'goodluck_bakery.wsgi.application'
 
 # Database
+# sqlite_backend enables WAL, tuned pragmas and BEGIN IMMEDIATE writes;
+# CONN_MAX_AGE keeps one connection per worker thread instead of
+# reconnecting on every request.
 DATABASES = {
     'default': {
-        'ENGINE': 'django.db.backends.sqlite3',
-        'NAME': BASE_DIR / 'db.sqlite3',
+        'ENGINE': 'sqlite_backend',
+        'NAME': Path(os.getenv('DB_PATH', str(BASE_DIR / 'db.sqlite3'))),
+        'CONN_MAX_AGE': int(os.getenv('DB_CONN_MAX_AGE', '600')),
+        'CONN_HEALTH_CHECKS': True,
+        'OPTIONS': {
+            'transaction_mode': 'IMMEDIATE',
+        },
     }
 }
 
+# Read replicas: comma-separated database files in DB_REPLICAS. Catalog and
+# report reads go to them (see shop.db_router); writes and everything that
+# must read its own writes stay on the primary.
+DATABASE_REPLICAS = []
+for index, replica_name in enumerate(filter(None, os.getenv('DB_REPLICAS', '').split(',')), start=1):
+    alias = f'replica{index}'
+    DATABASES[alias] = {
+        **DATABASES['default'],
+        'NAME': replica_name,
+        'OPTIONS': {**DATABASES['default']['OPTIONS']},
+        'TEST': {'MIRROR': 'default'},
+    }
+    DATABASE_REPLICAS.append(alias)
+
+DATABASE_ROUTERS = ['shop.db_router.PrimaryReplicaRouter']
+
+# Seconds a session keeps reading from the primary after it writes.
+REPLICA_PIN_SECONDS = int(os.getenv('REPLICA_PIN_SECONDS', '10'))
+
 # Password validation
 AUTH_PASSWORD_VALIDATORS = [
     {
@@ -115,9 +156,30 @@ STATIC_URL = '/static/'
 STATIC_ROOT = BASE_DIR / 'staticfiles'
 STATICFILES_DIRS = [BASE_DIR / 'static']
 
+# collectstatic writes content-hashed copies with gzip/Brotli variants (see
+# shop.storage) and WhiteNoise serves them with immutable cache headers.
+# Unhashed copies are kept too, and files missing from the manifest are
+# hashed when first used. A file that does not exist at all fails the page;
+# templates check optional ones with {% optional_static %}.
+STORAGES = {
+    'default': {'BACKEND': 'shop.storage.ContentHashedMediaStorage'},
+    'staticfiles': {'BACKEND': 'shop.storage.IncrementalCompressedManifestStorage'},
+}
+WHITENOISE_MANIFEST_STRICT = False
+# Unhashed names may change under the same URL.
+WHITENOISE_MAX_AGE = 0 if DEBUG else 3600
+
 # Media files
 MEDIA_URL = '/media/'
 MEDIA_ROOT = BASE_DIR / 'media'
+# Served by shop.media.MediaFilesMiddleware. Uploads have content-hashed
+# names and are cached as immutable; other media for MEDIA_MAX_AGE seconds.
+# Behind nginx set MEDIA_SENDFILE_HEADER=X-Accel-Redirect and map
+# MEDIA_ACCEL_REDIRECT_PREFIX to MEDIA_ROOT as an internal location; behind
+# Apache or lighttpd use X-Sendfile.
+MEDIA_MAX_AGE = int(os.getenv('MEDIA_MAX_AGE', '86400'))
+MEDIA_SENDFILE_HEADER = os.getenv('MEDIA_SENDFILE_HEADER', '')
+MEDIA_ACCEL_REDIRECT_PREFIX = '/protected-media/'
 
 # Default primary key field type
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
@@ -131,8 +193,8 @@ LOGIN_URL = 'login'
 LOGIN_REDIRECT_URL = 'home'
 LOGOUT_REDIRECT_URL = 'home'
 
-# Messages
-MESSAGE_STORAGE = 'django.contrib.messages.storage.session.SessionStorage'
+# Messages travel in a signed cookie, so flashing one writes no session.
+MESSAGE_STORAGE = 'django.contrib.messages.storage.cookie.CookieStorage'
 
 # Email Configuration (for password reset)
 EMAIL_BACKEND = 'django.core.mail.backends.console.EmailBackend'
@@ -142,12 +204,25 @@ DEFAULT_FROM_EMAIL = 'noreply@goodluckbakery.com'
 STRIPE_PUBLIC_KEY = os.getenv('STRIPE_PUBLIC_KEY', '')
 STRIPE_SECRET_KEY = os.getenv('STRIPE_SECRET_KEY', '')
 STRIPE_WEBHOOK_SECRET = os.getenv('STRIPE_WEBHOOK_SECRET', '')
+# Point at a local payment stub for load tests (see bench_asgi).
+STRIPE_API_BASE = os.getenv('STRIPE_API_BASE', 'https://api.stripe.com')
 
 # Session Configuration
+# Database sessions read through the cache and written only when their data
+# changes (see shop.sessions). Expired ones are deleted by `manage.py
+# cleanup` (or clearsessions) in batches.
+SESSION_ENGINE = 'shop.sessions'
+SESSION_CACHE_ALIAS = 'default'
 SESSION_COOKIE_AGE = 86400 * 7  # 1 week
 SESSION_COOKIE_HTTPONLY = True
 SESSION_COOKIE_SECURE = not DEBUG
 
+# Anonymous carts live in a signed cookie (see shop.carts) and are merged
+# into the user's cart on login.
+CART_COOKIE_NAME = 'cart'
+CART_COOKIE_AGE = 60 * 60 * 24 * 30
+CART_COOKIE_MAX_LINES = 50
+
 # CSRF Configuration
 CSRF_COOKIE_HTTPONLY = True
 CSRF_COOKIE_SECURE = not DEBUG
@@ -157,9 +232,106 @@ if not DEBUG:
     SECURE_BROWSER_XSS_FILTER = True
     SECURE_CONTENT_TYPE_NOSNIFF = True
     X_FRAME_OPTIONS = 'DENY'
-    SECURE_SSL_REDIRECT = True
+    # Off when TLS ends at a proxy that already redirects, or for local
+    # load tests over plain HTTP.
+    SECURE_SSL_REDIRECT = os.getenv('SECURE_SSL_REDIRECT', 'True') == 'True'
     SESSION_COOKIE_SECURE = True
     CSRF_COOKIE_SECURE = True
 
 # Sites Framework
 SITE_ID = 1
+
+# Two-tier cache (see shop.cache): a per-worker LRU in front of a file
+# cache in CACHE_DIR that every worker shares. Tag invalidations empty the
+# LRUs of all workers through the invalidation bus.
+CACHE_DIR = Path(os.getenv('CACHE_DIR', str(BASE_DIR / '.cache')))
+# Shared memory-mapped file holding cache tag versions for every worker on
+# the host (see shop.invalidation). Must be on a local filesystem.
+INVALIDATION_BUS_PATH = CACHE_DIR / 'invalidation.bus'
+CACHES = {
+    'default': {
+        'BACKEND': 'shop.cache.TieredCache',
+        'TIMEOUT': 300,
+        'OPTIONS': {
+            'L2': 'shared',
+            'L1_MAX_ENTRIES': 2000,
+            'L1_MAX_BYTES': 32 * 1024 * 1024,
+            'L1_TIMEOUT': 5,
+        },
+    },
+    'shared': {
+        'BACKEND': 'shop.cache.SharedFileCache',
+        'LOCATION': str(CACHE_DIR / 'shared'),
+        'TIMEOUT': 300,
+        'OPTIONS': {'MAX_ENTRIES': 20000},
+    },
+}
+
+# Full-page cache for anonymous catalog pages (see shop.page_cache)
+PAGE_CACHE_ENABLED = os.getenv('PAGE_CACHE_ENABLED', 'True') == 'True'
+PAGE_CACHE_ALIAS = 'default'
+PAGE_CACHE_TTL = int(os.getenv('PAGE_CACHE_TTL', '300'))
+# How long a stale page may still be served while it is re-rendered.
+PAGE_CACHE_STALE_TTL = int(os.getenv('PAGE_CACHE_STALE_TTL', '3600'))
+PAGE_CACHE_STALE_WHILE_REVALIDATE = True
+# Part of every page ETag; change it on deploys that change page markup so
+# browsers do not keep revalidating old copies.
+PAGE_CONTENT_VERSION = os.getenv('PAGE_CONTENT_VERSION', '1')
+
+# Search box autocomplete (see shop.autocomplete): a snapshot file that every
+# worker memory-maps, rebuilt whenever a product or category changes.
+AUTOCOMPLETE_INDEX_PATH = os.getenv('AUTOCOMPLETE_INDEX_PATH', str(BASE_DIR / '.autocomplete' / 'index.bin'))
+# Searches needed before a query is suggested to everyone.
+AUTOCOMPLETE_MIN_QUERY_COUNT = 3
+
+# "Frequently bought together" products kept per product by the
+# build_recommendations command (run it from cron, e.g. hourly).
+RECOMMENDATIONS_PER_PRODUCT = 4
+
+# Bake plan written nightly by the forecast_demand command (see shop.forecast):
+# days of paid orders it learns from, how quickly it follows recent days
+# (0-1), and the chance that a day's plan covers that day's demand.
+FORECAST_HISTORY_DAYS = 365
+FORECAST_SMOOTHING = 0.3
+FORECAST_SERVICE_LEVEL = 0.9
+
+# Idempotency keys on checkout and cart submissions (see shop.idempotency):
+# how long a response is kept for replay, how long a repeat waits for the
+# first request to finish, and when an unfinished claim counts as abandoned.
+IDEMPOTENCY_KEY_TTL = 24 * 60 * 60
+IDEMPOTENCY_WAIT_SECONDS = 5
+IDEMPOTENCY_LOCK_SECONDS = 60
+
+# Maintenance (see shop.cleanup; run `manage.py cleanup --loop 300` or from
+# cron). Rows are deleted at most CLEANUP_BATCH_SIZE per transaction, fewer
+# whenever a batch holds the write lock longer than CLEANUP_MAX_BATCH_SECONDS.
+CLEANUP_CART_DAYS = 30
+CLEANUP_ABANDONED_ORDER_DAYS = 7
+CLEANUP_BATCH_SIZE = 500
+CLEANUP_MAX_BATCH_SECONDS = 0.05
+
+# Order archive (see shop.archive; run `manage.py archive_orders` from cron).
+# Delivered, cancelled and refunded orders unchanged for this many days move
+# to the archive tables, in batches sized like the cleanup ones.
+ORDER_ARCHIVE_DAYS = 90
+
+# Product view counter (see shop.view_counter). Each worker buffers views
+# and writes them at most every VIEW_COUNTER_FLUSH_INTERVAL seconds or
+# VIEW_COUNTER_MAX_PENDING views, which bounds what a crash can lose.
+VIEW_COUNTER_BUFFERED = True
+VIEW_COUNTER_FLUSH_INTERVAL = int(os.getenv('VIEW_COUNTER_FLUSH_INTERVAL', '5'))
+VIEW_COUNTER_MAX_PENDING = int(os.getenv('VIEW_COUNTER_MAX_PENDING', '500'))
+TRENDING_HALF_LIFE_HOURS = 72
+
+# Metrics (Prometheus /metrics endpoint)
+# Each gunicorn worker writes its samples to a file in METRICS_DIR; the
+# directory should be emptied when the server (re)starts. Exiting processes
+# fold their files into values_aggregate.db.
+METRICS_ENABLED = os.getenv('METRICS_ENABLED', 'True') == 'True'
+METRICS_DIR = os.getenv('METRICS_DIR', str(BASE_DIR / '.metrics'))
+METRICS_ALLOWED_IPS = os.getenv('METRICS_ALLOWED_IPS', '127.0.0.1').split(',')
+
+# Resolve URLs, compile templates and import Stripe when wsgi.py/asgi.py is
+# loaded (see shop.warmup), so no request pays for them. With gunicorn
+# --preload this runs once in the master before the workers fork.
+WARMUP = os.getenv('WARMUP', str(not DEBUG)) == 'True'
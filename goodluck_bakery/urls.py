@@ -3,8 +3,6 @@ URL configuration for goodluck_bakery project.
 """
 from django.contrib import admin
 from django.urls import path, include
-from django.conf import settings
-from django.conf.urls.static import static
 from shop import views
 
 urlpatterns = [
@@ -27,14 +25,16 @@ urlpatterns = [
     path('about/', views.about, name='about'),
     path('contact/', views.contact, name='contact'),
     path('shop/', views.shop, name='shop'),
+    path('search/suggest/', views.search_suggestions, name='search_suggestions'),
     path('product/<slug:slug>/', views.product_detail, name='product_detail'),
     path('category/<slug:slug>/', views.category_products, name='category_products'),
 
     # Cart
     path('cart/', views.cart, name='cart'),
+    path('cart/api/', views.cart_api, name='cart_api'),
     path('cart/add/', views.add_to_cart, name='add_to_cart'),
     path('cart/update/', views.update_cart, name='update_cart'),
-    path('cart/remove/<int:item_id>/', views.remove_from_cart, name='remove_from_cart'),
+    path('cart/remove/<int:product_id>/', views.remove_from_cart, name='remove_from_cart'),
 
     # Checkout & Orders
     path('checkout/', views.checkout, name='checkout'),
@@ -50,9 +50,8 @@ urlpatterns = [
 
     # Newsletter
     path('newsletter/subscribe/', views.newsletter_subscribe, name='newsletter_subscribe'),
+
+    # Monitoring
+    path('metrics', views.metrics_view, name='metrics'),
 ]
 
-# Serve media files in development
-if settings.DEBUG:
-    urlpatterns += static(settings.MEDIA_URL, document_root=settings.MEDIA_ROOT)
-    urlpatterns += static(settings.STATIC_URL, document_root=settings.STATIC_ROOT)
@@ -0,0 +1,152 @@
+"""Gunicorn settings for production; gunicorn loads this file from the
+working directory.
+
+``GUNICORN_PROFILE`` picks the worker model:
+
+* ``threaded`` (default): WSGI with ``gthread`` workers, a few threads
+  each, so a worker keeps serving while a request waits on Stripe or the
+  database.
+* ``async``: the ASGI app on uvicorn workers; async views and middleware
+  run in the event loop.
+* ``sync``: one request at a time per worker, for comparison.
+
+Workers are sized from the CPUs this process may use (affinity and cgroup
+quota) and capped so that they fit in half the available memory at
+``GUNICORN_WORKER_MEMORY_MB`` each. ``GUNICORN_WORKERS`` and
+``GUNICORN_THREADS`` override the sizing.
+"""
+import math
+import os
+import time
+
+
+PROFILES = {
+    'sync': {'worker_class': 'sync', 'app': 'goodluck_bakery.wsgi:application'},
+    'threaded': {'worker_class': 'gthread', 'app': 'goodluck_bakery.wsgi:application'},
+    'async': {'worker_class': 'uvicorn_worker.UvicornWorker', 'app': 'goodluck_bakery.asgi:application'},
+}
+# Share of available memory the workers may use, and what one uses
+# (about 30 MB after the warm-up; the L1 cache may add up to 32 MB).
+MEMORY_SHARE = 0.5
+WORKER_MEMORY_MB = int(os.getenv('GUNICORN_WORKER_MEMORY_MB', '128'))
+
+
+def cpu_count():
+    """CPUs available to this process, honouring a cgroup v2 CPU quota."""
+    cpus = len(os.sched_getaffinity(0))
+    try:
+        with open('/sys/fs/cgroup/cpu.max') as f:
+            quota, period = f.read().split()
+        if quota != 'max':
+            cpus = min(cpus, max(1, math.ceil(int(quota) / int(period))))
+    except (OSError, ValueError):
+        pass
+    return cpus
+
+
+def available_memory_mb():
+    """Free memory, or the cgroup limit if that is lower; None if unknown."""
+    available = None
+    try:
+        with open('/proc/meminfo') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    available = int(line.split()[1]) // 1024
+    except OSError:
+        pass
+    try:
+        with open('/sys/fs/cgroup/memory.max') as f:
+            limit = f.read().strip()
+        if limit != 'max':
+            limit = int(limit) // (1024 * 1024)
+            available = limit if available is None else min(available, limit)
+    except (OSError, ValueError):
+        pass
+    return available
+
+
+def worker_count(profile, cpus, memory_mb):
+    # Blocking workers need more processes than CPUs to keep them busy; an
+    # event loop keeps one CPU busy by itself.
+    workers = cpus + 1 if profile == 'async' else 2 * cpus + 1
+    if memory_mb is not None:
+        workers = min(workers, int(memory_mb * MEMORY_SHARE // WORKER_MEMORY_MB))
+    return max(workers, 1)
+
+
+profile = os.getenv('GUNICORN_PROFILE', 'threaded')
+if profile not in PROFILES:
+    raise RuntimeError(f'GUNICORN_PROFILE must be one of {", ".join(PROFILES)}, not {profile!r}')
+
+wsgi_app = PROFILES[profile]['app']
+worker_class = PROFILES[profile]['worker_class']
+workers = int(os.getenv('GUNICORN_WORKERS') or worker_count(profile, cpu_count(), available_memory_mb()))
+threads = int(os.getenv('GUNICORN_THREADS', '4')) if profile == 'threaded' else 1
+bind = os.getenv('GUNICORN_BIND', '0.0.0.0:8000')
+
+# Import and warm the app (shop.warmup) once in the master; workers fork
+# from it ready to serve and share its memory until they write to it.
+preload_app = True
+# Restart each worker after about this many requests, spread out so that
+# they do not all restart at once, to bound leaks and fragmentation.
+max_requests = int(os.getenv('GUNICORN_MAX_REQUESTS', '2000'))
+max_requests_jitter = max_requests // 10
+timeout = int(os.getenv('GUNICORN_TIMEOUT', '30'))
+graceful_timeout = 30
+keepalive = 5
+# Worker heartbeats are file writes; keep them off a possibly slow disk.
+if os.path.isdir('/dev/shm'):
+    worker_tmp_dir = '/dev/shm'
+
+
+# ============================================
+# LIFECYCLE HOOKS
+# ============================================
+# Worker events are counted in bakery_gunicorn_worker_events and the number
+# of workers is the bakery_gunicorn_workers gauge. shop.metrics only reads
+# settings, so the hooks work whether or not the app has been loaded yet.
+
+def _metrics():
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'goodluck_bakery.settings')
+    from shop import metrics
+    return metrics
+
+
+def on_starting(server):
+    # Samples from a previous run would be added to this run's. The master
+    # may have written already (nworkers_changed), so its files stay.
+    directory = _metrics().metrics_dir()
+    if os.path.isdir(directory):
+        for name in os.listdir(directory):
+            if name.endswith('.db') and not name.endswith(f'_{os.getpid()}.db'):
+                os.remove(os.path.join(directory, name))
+
+
+def pre_fork(server, worker):
+    worker.forked_at = time.monotonic()
+
+
+def post_worker_init(worker):
+    metrics = _metrics()
+    metrics.WORKER_EVENTS.inc(event='started')
+    metrics.WORKER_BOOT.observe(time.monotonic() - worker.forked_at)
+
+
+def worker_exit(server, worker):
+    if worker.nr >= worker.max_requests:
+        _metrics().WORKER_EVENTS.inc(event='recycled')
+
+
+def worker_abort(worker):
+    # SIGABRT: the master killed the worker for missing the timeout.
+    _metrics().WORKER_EVENTS.inc(event='timeout')
+
+
+def child_exit(server, worker):
+    metrics = _metrics()
+    metrics.WORKER_EVENTS.inc(event='exited')
+    metrics.mark_process_dead(worker.pid)
+
+
+def nworkers_changed(server, new_value, old_value):
+    _metrics().WORKERS.set(new_value)
@@ -1,11 +1,27 @@
 """MySQL connector database backend for Django.
 
 Requires mysql-connector-python: https://github.com/mysql/mysql-connector-python
+
+Connections come from an in-process pool (see ``pool.py``) configured with
+``OPTIONS['pool']``::
+
+    'OPTIONS': {
+        'pool': {'size': 5, 'max_overflow': 10, 'recycle': 3600, 'pre_ping': True},
+        'prepared': False,
+    }
+
+Set ``'pool': None`` to open a fresh connection per request as before.
 """
+import os
+import threading
+
 from django.db.backends.base.base import BaseDatabaseWrapper
 from django.db.backends.mysql import base as mysql_base
 
+from .pool import ConnectionPool
+
 try:
+    import mysql.connector
     from mysql.connector import MySQLConnection, Error
 except ImportError as e:
     raise ImportError(
@@ -14,9 +30,105 @@ except ImportError as e:
     ) from e
 
 
+DEFAULT_POOL_OPTIONS = {
+    'size': 5,
+    'max_overflow': 10,
+    'recycle': 3600,
+    'pre_ping': True,
+    'timeout': 30,
+}
+
+# mysqlclient-only connection arguments produced by Django's MySQL backend.
+_MYSQLCLIENT_ONLY = ('conv', 'client_flag')
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def _ping(conn):
+    conn.ping(reconnect=False, attempts=1)
+
+
+def _reset(conn):
+    # Never hand a connection with an open transaction to the next request.
+    if conn.in_transaction:
+        conn.rollback()
+
+
+def get_pool(key, connect, options):
+    """Return the process-wide pool for ``key``, creating it on first use.
+
+    Pools are keyed by PID too so forked gunicorn workers never share
+    sockets inherited from the master.
+    """
+    key = (os.getpid(), key)
+    pool = _pools.get(key)
+    if pool is None:
+        with _pools_lock:
+            pool = _pools.get(key)
+            if pool is None:
+                pool = ConnectionPool(connect, ping=_ping, reset=_reset, **options)
+                _pools[key] = pool
+    return pool
+
+
 class DatabaseWrapper(mysql_base.DatabaseWrapper):
     """Database wrapper that uses mysql-connector-python instead of MySQLdb."""
 
     vendor = "mysql"
 
-    Database = MySQLConnection
+    # The DB-API module, so Django can map the driver's exception classes.
+    Database = mysql.connector
+
+    def get_connection_params(self):
+        options = self.settings_dict['OPTIONS']
+        pool_options = options.get('pool', DEFAULT_POOL_OPTIONS)
+        self.pool_options = None if pool_options is None else {**DEFAULT_POOL_OPTIONS, **pool_options}
+        self.use_prepared = options.get('prepared', False)
+
+        kwargs = super().get_connection_params()
+        for key in ('pool', 'prepared') + _MYSQLCLIENT_ONLY:
+            kwargs.pop(key, None)
+        # Return affected rows, not changed rows, as Django expects.
+        kwargs.setdefault('client_flags', [mysql.connector.constants.ClientFlag.FOUND_ROWS])
+        # Use the C extension when it is available.
+        kwargs.setdefault('use_pure', False)
+        return kwargs
+
+    def get_new_connection(self, conn_params):
+        if self.pool_options is None:
+            self.connection_pool = None
+            return mysql.connector.connect(**conn_params)
+        key = (self.alias, tuple(sorted((k, repr(v)) for k, v in conn_params.items())))
+        self.connection_pool = get_pool(
+            key, lambda: mysql.connector.connect(**conn_params), self.pool_options
+        )
+        return self.connection_pool.acquire()
+
+    def _close(self):
+        pool = getattr(self, 'connection_pool', None)
+        if self.connection is None or pool is None:
+            return super()._close()
+        with self.wrap_database_errors:
+            pool.release(self.connection)
+
+    def create_cursor(self, name=None):
+        # Buffered cursors fetch the whole result set at once, matching
+        # mysqlclient's default; prepared cursors reuse the server-side
+        # statement when the same SQL is executed repeatedly.
+        if self.use_prepared:
+            cursor = self.connection.cursor(prepared=True)
+        else:
+            cursor = self.connection.cursor(buffered=True)
+        return mysql_base.CursorWrapper(cursor)
+
+    def _set_autocommit(self, autocommit):
+        with self.wrap_database_errors:
+            self.connection.autocommit = autocommit
+
+    def is_usable(self):
+        try:
+            _ping(self.connection)
+        except Error:
+            return False
+        return True
@@ -0,0 +1,142 @@
+"""In-process connection pool used by the mysql-connector backend.
+
+The pool is driver agnostic: it is given a ``connect`` callable and only
+relies on the connection having ``close()`` and, for health checks,
+``ping()``.
+"""
+import collections
+import threading
+import time
+
+
+class PoolTimeout(Exception):
+    """No connection became available within the pool timeout."""
+
+
+class ConnectionPool:
+    """Thread-safe pool with overflow, recycling and pre-ping health checks.
+
+    ``size`` connections are kept idle between requests; up to
+    ``max_overflow`` extra connections may be opened under load and are
+    closed again when returned. Connections older than ``recycle`` seconds
+    are replaced, and with ``pre_ping`` every checkout pings the server
+    first so a connection dropped by the server is never handed out.
+    """
+
+    def __init__(self, connect, size=5, max_overflow=10, recycle=3600,
+                 pre_ping=True, timeout=30, ping=None, reset=None):
+        self._connect = connect
+        self.size = size
+        self.max_overflow = max_overflow
+        self.recycle = recycle
+        self.pre_ping = pre_ping
+        self.timeout = timeout
+        self._ping = ping or (lambda conn: conn.ping())
+        self._reset = reset
+        self._cond = threading.Condition()
+        # Most recently returned connection is reused first, so idle
+        # connections beyond the working set age out via ``recycle``.
+        self._idle = collections.deque()
+        self._created = {}
+        self._open = 0
+        self.stats = collections.Counter()
+
+    @property
+    def checked_out(self):
+        with self._cond:
+            return self._open - len(self._idle)
+
+    @property
+    def open_connections(self):
+        with self._cond:
+            return self._open
+
+    def _new_connection(self):
+        try:
+            conn = self._connect()
+        except Exception:
+            with self._cond:
+                self._open -= 1
+                self._cond.notify()
+            raise
+        with self._cond:
+            self._created[id(conn)] = time.monotonic()
+            self.stats['created'] += 1
+        return conn
+
+    def _is_healthy(self, conn):
+        age = time.monotonic() - self._created.get(id(conn), 0)
+        if self.recycle is not None and self.recycle >= 0 and age > self.recycle:
+            with self._cond:
+                self.stats['recycled'] += 1
+            return False
+        if self.pre_ping:
+            try:
+                self._ping(conn)
+            except Exception:
+                with self._cond:
+                    self.stats['ping_failures'] += 1
+                return False
+        return True
+
+    def acquire(self):
+        """Check a connection out, opening one if the pool allows it."""
+        deadline = time.monotonic() + self.timeout
+        while True:
+            with self._cond:
+                while not self._idle and self._open >= self.size + self.max_overflow:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self.stats['timeouts'] += 1
+                        raise PoolTimeout(
+                            f'Connection pool exhausted ({self.size} + {self.max_overflow} '
+                            f'overflow) after {self.timeout}s'
+                        )
+                    self._cond.wait(remaining)
+                if self._idle:
+                    conn = self._idle.pop()
+                else:
+                    self._open += 1
+                    conn = None
+            if conn is None:
+                return self._new_connection()
+            if self._is_healthy(conn):
+                with self._cond:
+                    self.stats['reused'] += 1
+                return conn
+            self.discard(conn)
+
+    def release(self, conn):
+        """Return a connection; overflow connections are closed."""
+        if self._reset is not None:
+            try:
+                self._reset(conn)
+            except Exception:
+                self.discard(conn)
+                return
+        with self._cond:
+            if len(self._idle) < self.size:
+                self._idle.append(conn)
+                self._cond.notify()
+                return
+        self.discard(conn)
+
+    def discard(self, conn):
+        """Close a connection and free its slot."""
+        try:
+            conn.close()
+        except Exception:
+            pass
+        with self._cond:
+            self._created.pop(id(conn), None)
+            self._open -= 1
+            self.stats['closed'] += 1
+            self._cond.notify()
+
+    def close_all(self):
+        """Close every idle connection (e.g. after fork or at shutdown)."""
+        with self._cond:
+            idle = list(self._idle)
+            self._idle.clear()
+        for conn in idle:
+            self.discard(conn)
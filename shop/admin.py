@@ -1,10 +1,16 @@
-from django.contrib import admin
+from urllib.parse import urlencode
+
+from django.contrib import admin, messages
+from django.contrib.admin.utils import unquote
+from django.contrib.admin.views.main import SEARCH_VAR
 from django.contrib.auth.admin import UserAdmin as BaseUserAdmin
+from django.shortcuts import redirect
+from django.urls import reverse
 from django.utils.html import format_html
 from django.db.models import Sum, Avg, Count
 from .models import (
     User, Category, Product, Cart, CartItem,
-    Order, OrderItem, Review, Newsletter, ContactMessage
+    Order, OrderItem, ArchivedOrder, ArchivedOrderItem, BakePlan, Review, Newsletter, ContactMessage
 )
 
 
@@ -205,11 +211,105 @@ class OrderAdmin(admin.ModelAdmin):
         self.message_user(request, f'{queryset.count()} orders marked as delivered.')
     mark_as_delivered.short_description = 'Mark selected orders as delivered'
 
+    # Orders moved out by shop.archive are shown by ArchivedOrderAdmin.
+    archive_model = ArchivedOrder
+
+    def _archive_admin(self):
+        return self.admin_site._registry.get(self.archive_model) if self.archive_model else None
+
+    def changelist_view(self, request, extra_context=None):
+        """Point searches that also match archived orders to the archive"""
+        archive_admin = self._archive_admin()
+        query = request.GET.get(SEARCH_VAR, '').strip()
+        if archive_admin is not None and query:
+            archived, _ = archive_admin.get_search_results(request, archive_admin.get_queryset(request), query)
+            count = archived.count()
+            if count:
+                url = reverse('admin:shop_archivedorder_changelist') + '?' + urlencode({SEARCH_VAR: query})
+                self.message_user(
+                    request,
+                    format_html('{} archived orders also match. <a href="{}">Search the archive</a>', count, url),
+                    messages.INFO,
+                )
+        return super().changelist_view(request, extra_context)
+
+    def change_view(self, request, object_id, form_url='', extra_context=None):
+        """Redirect links to orders that have since been archived"""
+        archive_admin = self._archive_admin()
+        if (
+            archive_admin is not None
+            and self.get_object(request, unquote(object_id)) is None
+            and archive_admin.get_object(request, unquote(object_id)) is not None
+        ):
+            return redirect('admin:shop_archivedorder_change', object_id)
+        return super().change_view(request, object_id, form_url, extra_context)
+
     # Dashboard functionality
     def has_dashboard_permission(self, request):
         return request.user.is_staff or request.user.is_superuser
 
 
+class ArchivedOrderItemInline(OrderItemInline):
+    """Item inline for ArchivedOrder admin"""
+    model = ArchivedOrderItem
+
+
+@admin.register(ArchivedOrder)
+class ArchivedOrderAdmin(OrderAdmin):
+    """Read-only admin for orders moved out by shop.archive"""
+    archive_model = None
+    inlines = [ArchivedOrderItemInline]
+    actions = None
+    fieldsets = OrderAdmin.fieldsets[:-2] + (
+        ('Timestamps', {
+            'fields': ('created_at', 'updated_at', 'confirmed_at', 'shipped_at', 'delivered_at', 'archived_at'),
+            'classes': ('collapse',)
+        }),
+        OrderAdmin.fieldsets[-1],
+    )
+
+    def has_add_permission(self, request):
+        return False
+
+    def has_change_permission(self, request, obj=None):
+        return False
+
+    def has_delete_permission(self, request, obj=None):
+        return False
+
+
+@admin.register(BakePlan)
+class BakePlanAdmin(admin.ModelAdmin):
+    """Bake plan written by forecast_demand; quantities can be adjusted"""
+    list_display = [
+        'product', 'get_category', 'bake_date', 'get_weekday', 'forecast', 'last_week', 'quantity', 'adjusted',
+    ]
+    list_editable = ['quantity']
+    list_filter = ['bake_date', 'adjusted', 'product__category']
+    list_select_related = ['product__category']
+    search_fields = ['product__name']
+    date_hierarchy = 'bake_date'
+    readonly_fields = ['bake_date', 'product', 'forecast', 'last_week', 'adjusted', 'planned_at']
+
+    def get_category(self, obj):
+        return obj.product.category
+    get_category.short_description = 'Category'
+    get_category.admin_order_field = 'product__category__name'
+
+    def get_weekday(self, obj):
+        return obj.bake_date.strftime('%A')
+    get_weekday.short_description = 'Weekday'
+
+    def save_model(self, request, obj, form, change):
+        # forecast_demand leaves quantities set here alone.
+        if 'quantity' in form.changed_data:
+            obj.adjusted = True
+        super().save_model(request, obj, form, change)
+
+    def has_add_permission(self, request):
+        return False
+
+
 @admin.register(Review)
 class ReviewAdmin(admin.ModelAdmin):
     """Review admin"""
@@ -262,23 +362,30 @@ def get_dashboard_stats():
     from django.utils import timezone
     from datetime import timedelta
 
+    from .archive import order_totals
+    from .db_router import read_alias
+
     today = timezone.now()
     last_30_days = today - timedelta(days=30)
 
+    # Reports tolerate replica lag, so read them from a replica.
+    db = read_alias()
+    # Order totals include archived orders (shop.archive).
+    total_orders, _ = order_totals(db)
+    orders_last_30_days, _ = order_totals(db, created_at__gte=last_30_days)
+    paid_orders, total_revenue = order_totals(db, payment_status='paid')
+    _, revenue_last_30_days = order_totals(db, payment_status='paid', created_at__gte=last_30_days)
+
     stats = {
-        'total_orders': Order.objects.count(),
-        'orders_last_30_days': Order.objects.filter(created_at__gte=last_30_days).count(),
-        'total_revenue': Order.objects.filter(payment_status='paid').aggregate(total=Sum('total'))['total'] or 0,
-        'revenue_last_30_days': Order.objects.filter(
-            payment_status='paid',
-            created_at__gte=last_30_days
-        ).aggregate(total=Sum('total'))['total'] or 0,
-        'total_products': Product.objects.count(),
-        'active_products': Product.objects.filter(is_active=True).count(),
-        'total_users': User.objects.count(),
-        'pending_orders': Order.objects.filter(status='pending').count(),
-        'average_order_value': Order.objects.filter(payment_status='paid').aggregate(
-            avg=Avg('total')
-        )['avg'] or 0,
+        'total_orders': total_orders,
+        'orders_last_30_days': orders_last_30_days,
+        'total_revenue': total_revenue,
+        'revenue_last_30_days': revenue_last_30_days,
+        'total_products': Product.objects.using(db).count(),
+        'active_products': Product.objects.using(db).filter(is_active=True).count(),
+        'total_users': User.objects.using(db).count(),
+        # Pending orders are never archived.
+        'pending_orders': Order.objects.using(db).filter(status='pending').count(),
+        'average_order_value': total_revenue / paid_orders if paid_orders else 0,
     }
     return stats
@@ -0,0 +1,105 @@
+"""Hot and cold order storage.
+
+Nearly all order reads are for recent orders, but ``Order`` and
+``OrderItem`` keep every order ever placed. ``manage.py archive_orders``
+moves finished orders (``ARCHIVE_STATUSES``) that have not changed for
+``ORDER_ARCHIVE_DAYS`` days into ``ArchivedOrder`` and
+``ArchivedOrderItem``, one short transaction per batch
+(``shop.cleanup.in_batches``). Rows keep their primary keys and order
+numbers, so links and payment references to them stay valid. Paid orders
+wait until build_recommendations has counted them.
+
+Code that may need an old order reads through the functions below rather
+than ``Order.objects``. They look in the live tables and then in the
+archive.
+"""
+import heapq
+from datetime import timedelta
+from itertools import islice
+from operator import attrgetter
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Count, Q, Sum
+from django.http import Http404
+from django.utils import timezone
+
+from . import metrics
+from .cleanup import in_batches
+from .models import ArchivedOrder, ArchivedOrderItem, Order, OrderItem
+
+
+ARCHIVE_STATUSES = ('delivered', 'cancelled', 'refunded')
+
+
+def archivable_orders(now=None):
+    cutoff = (now or timezone.now()) - timedelta(days=getattr(settings, 'ORDER_ARCHIVE_DAYS', 90))
+    return Order.objects.filter(
+        status__in=ARCHIVE_STATUSES, created_at__lt=cutoff, updated_at__lt=cutoff,
+    ).filter(Q(counted_in_recommendations=True) | ~Q(payment_status='paid'))
+
+
+def _copy(instance, model):
+    return model(**{field.attname: getattr(instance, field.attname) for field in instance._meta.concrete_fields})
+
+
+def archive_orders(batch_size=None, max_seconds=None, pause=0, now=None):
+    """Move archivable orders with their items; yield how many each batch moved."""
+    queryset = archivable_orders(now)
+
+    def move(pks):
+        with transaction.atomic():
+            # Orders that changed since they were selected stay.
+            orders = list(queryset.filter(pk__in=pks))
+            pks = [order.pk for order in orders]
+            items = OrderItem.objects.filter(order_id__in=pks)
+            ArchivedOrder.objects.bulk_create([_copy(order, ArchivedOrder) for order in orders])
+            ArchivedOrderItem.objects.bulk_create([_copy(item, ArchivedOrderItem) for item in items])
+            Order.objects.filter(pk__in=pks).delete()
+        metrics.ORDERS_ARCHIVED.inc(len(orders))
+        return len(orders)
+
+    yield from in_batches(queryset, move, batch_size, max_seconds, pause)
+
+
+# ============================================
+# READS
+# ============================================
+
+def _querysets(using=None):
+    return Order.objects.using(using), ArchivedOrder.objects.using(using)
+
+
+def find_order(**lookup):
+    """The live or archived order matching ``lookup`` with its items, or None."""
+    for queryset in _querysets():
+        order = queryset.prefetch_related('items__product').filter(**lookup).first()
+        if order is not None:
+            return order
+    return None
+
+
+def get_order_or_404(**lookup):
+    order = find_order(**lookup)
+    if order is None:
+        raise Http404('No order matches the given query.')
+    return order
+
+
+def orders_for_user(user, limit=None):
+    """The user's live and archived orders with their items, newest first."""
+    querysets = [
+        queryset.filter(user=user).prefetch_related('items').order_by('-created_at')[:limit]
+        for queryset in _querysets()
+    ]
+    return list(islice(heapq.merge(*querysets, key=attrgetter('created_at'), reverse=True), limit))
+
+
+def order_totals(using=None, **filters):
+    """Number and summed ``total`` of the live and archived orders matching ``filters``."""
+    count, revenue = 0, 0
+    for queryset in _querysets(using):
+        totals = queryset.filter(**filters).aggregate(count=Count('pk'), revenue=Sum('total'))
+        count += totals['count']
+        revenue += totals['revenue'] or 0
+    return count, revenue
@@ -0,0 +1,262 @@
+"""Search box autocomplete over a memory-mapped snapshot.
+
+Product names, category names and popular search queries are normalized
+and written, sorted, to ``AUTOCOMPLETE_INDEX_PATH``. Every name is indexed
+under each of its words, so "cake" finds "Chocolate Cake". Workers mmap
+the file and bisect it, so they share one copy of the index in the page
+cache. ``build_index`` swaps in a new file atomically, and readers notice
+the new inode on their next lookup.
+
+Snapshot layout, in native byte order since the file is only shared
+between workers on one machine::
+
+    magic (8 bytes) | record count N (uint32)
+    N + 1 record offsets (uint32, relative to the start of the records)
+    N weights (uint32)
+    records: key 0x1f label 0x1f url 0x1f kind
+
+A prefix maps to a contiguous range of records; the best suggestions are
+picked from the weights array and only those records are decoded. When
+nothing starts with the query, keys near it are accepted within a small
+edit distance, so "choclate" still finds "Chocolate Cake".
+"""
+import bisect
+import heapq
+import mmap
+import os
+import re
+import struct
+import tempfile
+import threading
+import unicodedata
+from array import array
+from urllib.parse import urlencode
+
+from django.conf import settings
+from django.db.models import F
+from django.urls import reverse
+
+from .models import Category, Product, SearchQuery
+
+
+MAGIC = b'GLBAC002'
+HEADER = struct.Struct('=8sI')
+SEPARATOR = b'\x1f'
+
+# Categories rank above products, products by views, queries by count.
+CATEGORY_WEIGHT = 10 ** 9
+MAX_WEIGHT = 2 ** 32 - 1
+MAX_FUZZY_SCAN = 512
+
+_lock = threading.Lock()
+_snapshot = None
+
+
+def normalize(text):
+    """Lowercase, strip accents and collapse everything else to single spaces."""
+    text = unicodedata.normalize('NFKD', text.lower())
+    text = ''.join(char for char in text if not unicodedata.combining(char))
+    return ' '.join(re.sub(r'[^\w]+', ' ', text).split())
+
+
+# ============================================
+# BUILDING
+# ============================================
+
+def _entries():
+    """Yield ``(label, url, kind, weight)`` for everything worth suggesting."""
+    for name, slug in Category.objects.filter(is_active=True).values_list('name', 'slug'):
+        yield name, reverse('category_products', args=[slug]), 'category', CATEGORY_WEIGHT
+    for name, slug, views in Product.objects.filter(is_active=True).values_list('name', 'slug', 'views'):
+        yield name, reverse('product_detail', args=[slug]), 'product', views
+    shop_url = reverse('shop')
+    popular = SearchQuery.objects.filter(
+        count__gte=getattr(settings, 'AUTOCOMPLETE_MIN_QUERY_COUNT', 3)
+    ).order_by('-count').values_list('query', 'count')[:getattr(settings, 'AUTOCOMPLETE_MAX_QUERIES', 1000)]
+    for query, count in popular:
+        yield query, f'{shop_url}?{urlencode({"q": query})}', 'query', count
+
+
+def build_index(path=None):
+    """Write a fresh snapshot and atomically replace the old one.
+
+    Returns the number of records written.
+    """
+    path = path or settings.AUTOCOMPLETE_INDEX_PATH
+    records = []
+    for label, url, kind, weight in _entries():
+        words = normalize(label).split()
+        payload = SEPARATOR.join(part.encode() for part in (label.replace('\x1f', ' '), url, kind))
+        for start in range(len(words)):
+            key = ' '.join(words[start:]).encode()
+            records.append((key + SEPARATOR + payload, min(weight, MAX_WEIGHT)))
+    records.sort()
+
+    offsets, position = array('I'), 0
+    for record, _ in records:
+        offsets.append(position)
+        position += len(record)
+    offsets.append(position)
+
+    directory = os.path.dirname(os.path.abspath(path))
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=directory, prefix='.autocomplete-')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(HEADER.pack(MAGIC, len(records)))
+            f.write(offsets.tobytes())
+            f.write(array('I', [weight for _, weight in records]).tobytes())
+            f.write(b''.join(record for record, _ in records))
+        os.replace(tmp, path)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+    return len(records)
+
+
+# ============================================
+# LOOKUP
+# ============================================
+
+class _Keys:
+    """Sequence view of the snapshot's sorted keys, for ``bisect``."""
+
+    def __init__(self, snapshot):
+        self.snapshot = snapshot
+
+    def __len__(self):
+        return self.snapshot.count
+
+    def __getitem__(self, index):
+        return self.snapshot.key(index)
+
+
+class Snapshot:
+    """Read-only view of a snapshot file"""
+
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            self.stat = os.fstat(f.fileno())
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.count = HEADER.unpack_from(self.mm)
+        if magic != MAGIC:
+            raise ValueError(f'{path} is not an autocomplete snapshot')
+        view = memoryview(self.mm)
+        weights_start = HEADER.size + 4 * (self.count + 1)
+        self.base = weights_start + 4 * self.count
+        self.offsets = view[HEADER.size:weights_start].cast('I')
+        self.weights = view[weights_start:self.base].cast('I')
+        self.keys = _Keys(self)
+
+    def key(self, index):
+        start = self.base + self.offsets[index]
+        return self.mm[start:self.mm.find(SEPARATOR, start)]
+
+    def suggestion(self, index):
+        record = self.mm[self.base + self.offsets[index]:self.base + self.offsets[index + 1]]
+        _, label, url, kind = record.split(SEPARATOR)
+        return {'label': label.decode(), 'url': url.decode(), 'type': kind.decode()}
+
+    def prefix_range(self, prefix):
+        # No UTF-8 byte is 0xff, so this sorts after every key with the prefix.
+        return bisect.bisect_left(self.keys, prefix), bisect.bisect_left(self.keys, prefix + b'\xff')
+
+    def fuzzy_matches(self, prefix, start):
+        """Keys whose beginning is within a small edit distance of ``prefix``."""
+        if len(prefix) < 3:
+            return []
+        # The typo comes after the longest prefix shared with a neighbour.
+        neighbours = [self.key(index) for index in (start - 1, start) if 0 <= index < self.count]
+        shared = max((_common_prefix(prefix, key) for key in neighbours), default=0)
+        anchor = prefix[:max(1, min(shared, len(prefix) - 1))]
+        begin, end = self.prefix_range(anchor)
+        limit = 1 if len(prefix) < 6 else 2
+        matches, seen = [], {}
+        for index in range(begin, min(end, begin + MAX_FUZZY_SCAN)):
+            head = self.key(index)[:len(prefix) + limit]
+            if head not in seen:
+                seen[head] = _prefix_distance(prefix, head, limit) <= limit
+            if seen[head]:
+                matches.append(index)
+        return matches
+
+    def search(self, query, limit=8):
+        prefix = normalize(query).encode()
+        if not prefix or not self.count:
+            return []
+        start, end = self.prefix_range(prefix)
+        matches = range(start, end) if end > start else self.fuzzy_matches(prefix, start)
+        # A name can match through more than one of its words, so take
+        # spares to make up for duplicates.
+        best = heapq.nlargest(limit * 2, matches, key=self.weights.__getitem__)
+        suggestions, urls = [], set()
+        for index in best:
+            suggestion = self.suggestion(index)
+            if suggestion['url'] not in urls:
+                urls.add(suggestion['url'])
+                suggestions.append(suggestion)
+                if len(suggestions) == limit:
+                    break
+        return suggestions
+
+
+def _common_prefix(a, b):
+    length = 0
+    for x, y in zip(a, b):
+        if x != y:
+            break
+        length += 1
+    return length
+
+
+def _prefix_distance(a, b, limit):
+    """Smallest edit distance (with transpositions) between ``a`` and a
+    prefix of ``b``, or ``limit + 1`` once it must exceed ``limit``."""
+    previous2, previous = None, list(range(len(b) + 1))
+    for i in range(1, len(a) + 1):
+        current = [i] + [0] * len(b)
+        for j in range(1, len(b) + 1):
+            cost = a[i - 1] != b[j - 1]
+            current[j] = min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + cost)
+            if i > 1 and j > 1 and a[i - 1] == b[j - 2] and a[i - 2] == b[j - 1]:
+                current[j] = min(current[j], previous2[j - 2] + 1)
+        if min(current) > limit:
+            return limit + 1
+        previous2, previous = previous, current
+    return min(previous)
+
+
+def get_snapshot():
+    """Return the current snapshot, remapping it if the file was replaced."""
+    global _snapshot
+    path = settings.AUTOCOMPLETE_INDEX_PATH
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        build_index(path)
+        stat = os.stat(path)
+    snapshot = _snapshot
+    if snapshot is None or (snapshot.stat.st_ino, snapshot.stat.st_mtime_ns) != (stat.st_ino, stat.st_mtime_ns):
+        with _lock:
+            if _snapshot is snapshot:
+                _snapshot = Snapshot(path)
+            snapshot = _snapshot
+    return snapshot
+
+
+def suggest(query, limit=8):
+    """Return up to ``limit`` suggestions for what has been typed so far."""
+    return get_snapshot().search(query, limit)
+
+
+# ============================================
+# POPULAR QUERIES
+# ============================================
+
+def record_search(query):
+    """Count a search from the shop page towards the popular queries."""
+    query = normalize(query)[:100]
+    if not query:
+        return
+    if not SearchQuery.objects.filter(query=query).update(count=F('count') + 1):
+        SearchQuery.objects.get_or_create(query=query)
@@ -0,0 +1,298 @@
+"""Two-tier cache: a small LRU in each worker in front of a shared cache.
+
+``TieredCache`` keeps recently used entries in a per-process LRU (L1, at
+most ``L1_MAX_ENTRIES`` entries and ``L1_MAX_BYTES`` pickled bytes, each for
+at most ``L1_TIMEOUT`` seconds) and
+everything in the cache named by ``L2``, which all workers share. The
+default L2 is ``SharedFileCache``, a file-based cache under ``CACHE_DIR``,
+so nothing beyond the app itself has to run.
+
+Values can carry tags: ``set(key, value, tags=[...])``. Tag versions live
+on the invalidation bus (``shop.invalidation``), and ``invalidate_tags``
+bumps them there, so tagged entries stop being returned. Every worker reads
+the bus generation on each lookup and empties its L1 when it has moved, so
+an invalidation is seen everywhere at once instead of after
+``L1_TIMEOUT``. Plain ``set``/``delete`` calls only update the
+calling worker's L1; other workers may see the old value for up to
+``L1_TIMEOUT`` seconds.
+
+``get_or_set`` lets one caller per key compute a missing value while the
+others, in this worker and in the rest, wait for it (stampede protection).
+Lookups are counted per tier in the ``bakery_cache_requests`` metric.
+"""
+import collections
+import os
+import pickle
+import tempfile
+import threading
+import time
+
+from django.core.cache import caches
+from django.core.cache.backends.base import DEFAULT_TIMEOUT, BaseCache
+from django.core.cache.backends.filebased import FileBasedCache
+
+from . import invalidation, metrics
+
+
+_MISSING = object()
+
+
+class _Tagged:
+    """A value stored together with the versions of its tags"""
+
+    __slots__ = ('value', 'tags')
+
+    def __init__(self, value, tags):
+        self.value = value
+        self.tags = tags
+
+
+class SharedFileCache(FileBasedCache):
+    """File-based cache whose ``add`` is atomic across processes"""
+
+    def add(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        self._createdir()
+        fname = self._key_to_file(key, version)
+        self._cull()
+        fd, tmp_path = tempfile.mkstemp(dir=self._dir)
+        try:
+            with open(fd, 'wb') as f:
+                self._write_content(f, timeout, value)
+            for _ in range(2):
+                try:
+                    # Fails if the file exists, unlike os.replace.
+                    os.link(tmp_path, fname)
+                    return True
+                except FileExistsError:
+                    if self.has_key(key, version=version):
+                        return False
+                    # Expired (has_key removed it); try once more.
+        finally:
+            os.remove(tmp_path)
+        return False
+
+
+class TieredCache(BaseCache):
+    """Per-process LRU in front of a shared cache"""
+
+    def __init__(self, location, params):
+        super().__init__(params)
+        options = params.get('OPTIONS', {})
+        self._l2_alias = options.get('L2', 'shared')
+        self._l1_max_entries = options.get('L1_MAX_ENTRIES', 1000)
+        self._l1_timeout = options.get('L1_TIMEOUT', 5)
+        self._lock_timeout = options.get('LOCK_TIMEOUT', 10)
+        self._l1_max_bytes = options.get('L1_MAX_BYTES', 32 * 1024 * 1024)
+        self._l1 = collections.OrderedDict()
+        self._l1_bytes = 0
+        self._l1_lock = threading.Lock()
+        self._generation = None
+        # Single-flight locks for get_or_set, striped by key.
+        self._computing = [threading.Lock() for _ in range(64)]
+
+    @property
+    def l2(self):
+        return caches[self._l2_alias]
+
+    # ----- L1 -----
+
+    def _check_generation(self):
+        generation = invalidation.generation()
+        if generation != self._generation:
+            with self._l1_lock:
+                self._l1.clear()
+                self._l1_bytes = 0
+                self._generation = generation
+
+    def _l1_get(self, key):
+        self._check_generation()
+        with self._l1_lock:
+            entry = self._l1.get(key)
+            if entry is None:
+                return _MISSING
+            expires, data = entry
+            if expires < time.monotonic():
+                del self._l1[key]
+                self._l1_bytes -= len(data)
+                return _MISSING
+            self._l1.move_to_end(key)
+        return pickle.loads(data)
+
+    def _l1_set(self, key, value, timeout):
+        if timeout is DEFAULT_TIMEOUT:
+            timeout = self.default_timeout
+        ttl = self._l1_timeout if timeout is None else min(timeout, self._l1_timeout)
+        data = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        if ttl <= 0 or len(data) > self._l1_max_bytes // 16:
+            self._l1_delete(key)
+            return
+        if self._generation is None:
+            self._check_generation()
+        elif invalidation.generation() != self._generation:
+            # Tags may have been invalidated since the value was read.
+            self._check_generation()
+            return
+        with self._l1_lock:
+            self._l1_pop(key)
+            self._l1[key] = (time.monotonic() + ttl, data)
+            self._l1_bytes += len(data)
+            while len(self._l1) > self._l1_max_entries or self._l1_bytes > self._l1_max_bytes:
+                _, (_, evicted) = self._l1.popitem(last=False)
+                self._l1_bytes -= len(evicted)
+
+    def _l1_pop(self, key):
+        entry = self._l1.pop(key, None)
+        if entry is not None:
+            self._l1_bytes -= len(entry[1])
+
+    def _l1_delete(self, key):
+        with self._l1_lock:
+            self._l1_pop(key)
+
+    # ----- tags -----
+
+    def tag_versions(self, tags):
+        """Current version of each tag."""
+        return invalidation.versions(tags)
+
+    def invalidate_tags(self, *tags, generation=True):
+        """Make every entry tagged with any of ``tags`` stale, in all workers.
+
+        ``generation=False`` keeps the other workers' L1s: use it for tags
+        that only tagged entries depend on.
+        """
+        invalidation.invalidate(*tags, generation=generation)
+
+    def _unwrap(self, value):
+        if isinstance(value, _Tagged):
+            if self.tag_versions(value.tags) != value.tags:
+                return _MISSING
+            return value.value
+        return value
+
+    # ----- cache API -----
+
+    def _key(self, key, version):
+        # L2 validates keys; the L1 only needs them to be unique.
+        return self.make_key(key, version=version)
+
+    def get(self, key, default=None, version=None):
+        value = self._get(key, version)
+        return default if value is _MISSING else value
+
+    def _get(self, key, version):
+        l1_key = self._key(key, version)
+        value = self._l1_get(l1_key)
+        if value is not _MISSING:
+            value = self._unwrap(value)
+        metrics.record_cache_lookup('l1', value is not _MISSING)
+        if value is not _MISSING:
+            return value
+        # Not in L1, or its tags have moved on since: L2 may be newer.
+        value = self.l2.get(key, _MISSING, version=version)
+        metrics.record_cache_lookup('l2', value is not _MISSING)
+        if value is _MISSING:
+            return _MISSING
+        self._l1_set(l1_key, value, self._l1_timeout)
+        return self._unwrap(value)
+
+    def _wrap(self, value, tags):
+        return _Tagged(value, self.tag_versions(tags)) if tags else value
+
+    def set(self, key, value, timeout=DEFAULT_TIMEOUT, version=None, tags=None):
+        value = self._wrap(value, tags)
+        self.l2.set(key, value, timeout, version=version)
+        self._l1_set(self._key(key, version), value, timeout)
+
+    def add(self, key, value, timeout=DEFAULT_TIMEOUT, version=None, tags=None):
+        value = self._wrap(value, tags)
+        if not self.l2.add(key, value, timeout, version=version):
+            return False
+        self._l1_set(self._key(key, version), value, timeout)
+        return True
+
+    def touch(self, key, timeout=DEFAULT_TIMEOUT, version=None):
+        return self.l2.touch(key, timeout, version=version)
+
+    def delete(self, key, version=None):
+        self._l1_delete(self._key(key, version))
+        return self.l2.delete(key, version=version)
+
+    def has_key(self, key, version=None):
+        return self._get(key, version) is not _MISSING
+
+    def get_many(self, keys, version=None):
+        found, missing = {}, []
+        for key in keys:
+            value = self._l1_get(self._key(key, version))
+            metrics.record_cache_lookup('l1', value is not _MISSING)
+            if value is _MISSING:
+                missing.append(key)
+            else:
+                found[key] = value
+        if missing:
+            fetched = self.l2.get_many(missing, version=version)
+            for key in missing:
+                metrics.record_cache_lookup('l2', key in fetched)
+            for key, value in fetched.items():
+                self._l1_set(self._key(key, version), value, self._l1_timeout)
+            found.update(fetched)
+        values = {key: self._unwrap(value) for key, value in found.items()}
+        return {key: value for key, value in values.items() if value is not _MISSING}
+
+    def set_many(self, data, timeout=DEFAULT_TIMEOUT, version=None):
+        failed = self.l2.set_many(data, timeout, version=version)
+        for key, value in data.items():
+            if key not in failed:
+                self._l1_set(self._key(key, version), value, timeout)
+        return failed
+
+    def delete_many(self, keys, version=None):
+        for key in keys:
+            self._l1_delete(self._key(key, version))
+        self.l2.delete_many(keys, version=version)
+
+    def incr(self, key, delta=1, version=None):
+        value = self.l2.incr(key, delta, version=version)
+        self._l1_delete(self._key(key, version))
+        return value
+
+    def clear(self):
+        self.l2.clear()
+        # Moves the generation, which empties every worker's L1.
+        invalidation.invalidate('cache')
+
+    def get_or_set(self, key, default, timeout=DEFAULT_TIMEOUT, version=None, tags=None):
+        """Return the cached value, or compute ``default`` once across workers.
+
+        While one caller computes, others wait up to ``LOCK_TIMEOUT``
+        seconds for its result before computing it themselves.
+        """
+        value = self._get(key, version)
+        if value is not _MISSING:
+            return value
+        l1_key = self._key(key, version)
+        with self._computing[hash(l1_key) % len(self._computing)]:
+            value = self._get(key, version)
+            if value is not _MISSING:
+                return value
+            lock_key = f'lock:{l1_key}'
+            locked = self.l2.add(lock_key, 1, timeout=self._lock_timeout)
+            if not locked:
+                deadline = time.monotonic() + self._lock_timeout
+                while time.monotonic() < deadline and self.l2.has_key(lock_key):
+                    time.sleep(0.05)
+                    self._l1_delete(l1_key)
+                    value = self._get(key, version)
+                    if value is not _MISSING:
+                        return value
+            try:
+                value = default() if callable(default) else default
+                self.set(key, value, timeout, version=version, tags=tags)
+            finally:
+                if locked:
+                    self.l2.delete(lock_key)
+            return value
+
+    def close(self, **kwargs):
+        self.l2.close(**kwargs)
@@ -0,0 +1,265 @@
+"""Carts for signed-in users and anonymous visitors.
+
+Signed-in users keep their cart in ``Cart``/``CartItem`` rows. Anonymous
+visitors get a ``CookieCart``: product ids and quantities in a signed
+cookie (``3-2.7-1``), so browsing with a cart needs no database row and
+the header badge is read straight from the cookie. ``CookieCartMiddleware``
+writes the cookie back when the cart changes, and logging in merges it into
+the user's cart with one bulk upsert. ``aget_cart`` and ``acart_lines``
+are the async versions of ``get_cart`` and ``cart_lines``.
+"""
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import F
+from django.db.models.functions import Least
+
+from .models import Cart, CartItem, Product
+
+
+MAX_QUANTITY = 99
+COOKIE_SALT = 'shop.carts'
+
+
+class CartOperationError(Exception):
+    """A cart operation that cannot be applied"""
+
+    def __init__(self, message, index=None):
+        super().__init__(message)
+        self.index = index
+
+
+def stock_error(product_id):
+    """Message for an operation refused because of stock"""
+    product = Product.objects.filter(pk=product_id, is_active=True).values('name', 'stock').first()
+    if product is None:
+        return 'This product is no longer available.'
+    return f'Sorry, only {product["stock"]} of {product["name"]} available in stock.'
+
+
+# ============================================
+# DATABASE CARTS
+# ============================================
+
+def apply_db_operation(cart, product_id, quantity=None, delta=None):
+    """Set a line's quantity or change it by ``delta``, checking stock in the UPDATE.
+
+    A resulting quantity of 0 removes the line.
+    """
+    items = CartItem.objects.filter(cart=cart, product_id=product_id)
+    if delta is not None and delta <= 0:
+        # Taking items out is always allowed, even past the current stock.
+        if not items.filter(quantity__lte=-delta).delete()[0]:
+            items.update(quantity=F('quantity') + delta)
+        return
+    if delta is not None:
+        # Only applies while the new quantity is within stock and limits.
+        if items.filter(
+            quantity__lte=Least(F('product__stock'), MAX_QUANTITY) - delta,
+            product__is_active=True,
+        ).update(quantity=F('quantity') + delta):
+            return
+        if items.exists():
+            raise CartOperationError(stock_error(product_id))
+        quantity = delta
+
+    if quantity == 0:
+        items.delete()
+        return
+    if quantity > MAX_QUANTITY:
+        raise CartOperationError(f'At most {MAX_QUANTITY} of an item per order.')
+    if items.filter(product__stock__gte=quantity, product__is_active=True).update(quantity=quantity):
+        return
+    if items.exists() or not Product.objects.filter(pk=product_id, is_active=True, stock__gte=quantity).exists():
+        raise CartOperationError(stock_error(product_id))
+    CartItem.objects.create(cart=cart, product_id=product_id, quantity=quantity)
+
+
+# ============================================
+# COOKIE CARTS
+# ============================================
+
+class CookieCart:
+    """Cart of an anonymous visitor, kept in a signed cookie"""
+
+    def __init__(self, lines=None):
+        self.lines = dict(lines or {})
+        self.modified = False
+
+    @classmethod
+    def from_request(cls, request):
+        value = request.get_signed_cookie(
+            settings.CART_COOKIE_NAME, default=None, salt=COOKIE_SALT, max_age=settings.CART_COOKIE_AGE
+        )
+        if not value:
+            return cls()
+        try:
+            lines = dict(map(int, pair.split('-')) for pair in value.split('.'))
+        except ValueError:
+            return cls()
+        return cls({product_id: quantity for product_id, quantity in lines.items() if quantity > 0})
+
+    def __bool__(self):
+        return bool(self.lines)
+
+    def get_total_items(self):
+        return sum(self.lines.values())
+
+    def _products(self):
+        return Product.objects.filter(pk__in=self.lines, is_active=True).select_related('category')
+
+    def line_items(self):
+        """Unsaved ``CartItem`` objects for the products still on sale."""
+        return [CartItem(product=product, quantity=self.lines[product.pk]) for product in self._products()]
+
+    async def aline_items(self):
+        return [CartItem(product=product, quantity=self.lines[product.pk]) async for product in self._products()]
+
+    def get_total_price(self):
+        return sum(item.get_subtotal() for item in self.line_items())
+
+    def apply(self, operations):
+        """Apply ``(product_id, quantity, delta)`` operations all or nothing."""
+        stock = dict(
+            Product.objects.filter(pk__in={product_id for product_id, _, _ in operations}, is_active=True)
+            .values_list('pk', 'stock')
+        )
+        lines = dict(self.lines)
+        for index, (product_id, quantity, delta) in enumerate(operations):
+            if delta is not None:
+                quantity = max(lines.get(product_id, 0) + delta, 0)
+            if quantity == 0:
+                lines.pop(product_id, None)
+                continue
+            if quantity > MAX_QUANTITY:
+                raise CartOperationError(f'At most {MAX_QUANTITY} of an item per order.', index)
+            # Taking items out is always allowed, even past the current stock.
+            if quantity > stock.get(product_id, 0) and not (delta is not None and delta < 0):
+                raise CartOperationError(stock_error(product_id), index)
+            if product_id not in lines and len(lines) >= settings.CART_COOKIE_MAX_LINES:
+                raise CartOperationError(
+                    f'Sign in to add more than {settings.CART_COOKIE_MAX_LINES} different products.', index
+                )
+            lines[product_id] = quantity
+        self.lines = lines
+        self.modified = True
+
+    def clear(self):
+        self.lines = {}
+        self.modified = True
+
+    def update_response(self, response):
+        if not self.modified:
+            return
+        if self.lines:
+            value = '.'.join(f'{product_id}-{quantity}' for product_id, quantity in self.lines.items())
+            response.set_signed_cookie(
+                settings.CART_COOKIE_NAME, value, salt=COOKIE_SALT, max_age=settings.CART_COOKIE_AGE,
+                secure=settings.SESSION_COOKIE_SECURE, httponly=True, samesite='Lax',
+            )
+        else:
+            response.delete_cookie(settings.CART_COOKIE_NAME, samesite='Lax')
+
+
+class CookieCartMiddleware:
+    """Attach the anonymous cart as ``request.cookie_cart`` and save it"""
+
+    async_capable = True
+    sync_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        request.cookie_cart = CookieCart.from_request(request)
+        response = self.get_response(request)
+        request.cookie_cart.update_response(response)
+        return response
+
+    async def __acall__(self, request):
+        request.cookie_cart = CookieCart.from_request(request)
+        response = await self.get_response(request)
+        request.cookie_cart.update_response(response)
+        return response
+
+
+# ============================================
+# EITHER KIND
+# ============================================
+
+def get_cart(request):
+    """The user's ``Cart``, or the visitor's ``CookieCart``."""
+    if request.user.is_authenticated:
+        cart, created = Cart.objects.get_or_create(user=request.user)
+        return cart
+    return request.cookie_cart
+
+
+async def aget_cart(request):
+    """``get_cart`` for async views."""
+    user = await request.auser()
+    if user.is_authenticated:
+        cart, created = await Cart.objects.aget_or_create(user=user)
+        return cart
+    return request.cookie_cart
+
+
+def cart_lines(cart):
+    """Line items of either kind of cart, with their products loaded."""
+    if isinstance(cart, CookieCart):
+        return cart.line_items()
+    return list(cart.items.select_related('product', 'product__category'))
+
+
+async def acart_lines(cart):
+    """``cart_lines`` for async views."""
+    if isinstance(cart, CookieCart):
+        return await cart.aline_items()
+    return [item async for item in cart.items.select_related('product', 'product__category')]
+
+
+def apply_operations(cart, operations):
+    """Apply ``(product_id, quantity, delta)`` operations all or nothing.
+
+    Raises ``CartOperationError`` with the index of the first operation
+    that cannot be applied.
+    """
+    if isinstance(cart, CookieCart):
+        cart.apply(operations)
+        return
+    with transaction.atomic():
+        for index, (product_id, quantity, delta) in enumerate(operations):
+            try:
+                apply_db_operation(cart, product_id, quantity=quantity, delta=delta)
+            except CartOperationError as e:
+                e.index = index
+                raise
+
+
+def merge_cookie_cart(request, user):
+    """Add the visitor's cookie cart to the user's cart with one bulk upsert."""
+    cookie_cart = getattr(request, 'cookie_cart', None)
+    if not cookie_cart:
+        return
+    cart, created = Cart.objects.get_or_create(user=user)
+    existing = dict(cart.items.filter(product_id__in=cookie_cart.lines).values_list('product_id', 'quantity'))
+    stock = dict(
+        Product.objects.filter(pk__in=cookie_cart.lines, is_active=True).values_list('pk', 'stock')
+    )
+    items = []
+    for product_id, quantity in cookie_cart.lines.items():
+        quantity = min(existing.get(product_id, 0) + quantity, stock.get(product_id, 0), MAX_QUANTITY)
+        if quantity > 0:
+            items.append(CartItem(cart=cart, product_id=product_id, quantity=quantity))
+    CartItem.objects.bulk_create(
+        items,
+        update_conflicts=True,
+        # MySQL upserts on any unique key and does not take a target.
+        unique_fields=['cart', 'product'] if connection.features.supports_update_conflicts_with_target else None,
+        update_fields=['quantity', 'updated_at'],
+    )
+    cookie_cart.clear()
@@ -0,0 +1,107 @@
+"""Batched deletion of rows that nothing else removes.
+
+``manage.py cleanup`` runs the ``TASKS`` below:
+
+* ``carts``: carts of users who have not touched them for
+  ``CLEANUP_CART_DAYS`` days, with their items.
+* ``orders``: unpaid ``pending`` orders older than
+  ``CLEANUP_ABANDONED_ORDER_DAYS`` days, left by abandoned or failed
+  checkouts. Stock is only taken when an order is paid, so nothing has to
+  be put back.
+* ``sessions``: expired sessions.
+* ``idempotency_keys``: expired idempotency records.
+
+``delete_in_batches`` selects a batch of primary keys outside any
+transaction and deletes those rows, re-checking the filter, in one short
+transaction of its own. SQLite has a single write lock for the whole
+database, so checkout writes get in between batches. The batch size
+halves whenever a delete takes longer than ``CLEANUP_MAX_BATCH_SECONDS``
+and grows back, up to ``CLEANUP_BATCH_SIZE``, while deletes are quick.
+"""
+import time
+from datetime import timedelta
+from importlib import import_module
+
+from django.conf import settings
+from django.utils import timezone
+
+from . import metrics
+from .models import Cart, IdempotencyKey, Order
+
+
+def in_batches(queryset, process, batch_size=None, max_seconds=None, pause=0):
+    """Call ``process`` with the primary keys of ``queryset``, a batch at a time.
+
+    ``process`` must take the rows out of ``queryset`` and return a count,
+    which is yielded. The batch size follows how long each call takes.
+    """
+    limit = batch_size or getattr(settings, 'CLEANUP_BATCH_SIZE', 500)
+    max_seconds = max_seconds or getattr(settings, 'CLEANUP_MAX_BATCH_SECONDS', 0.05)
+    size = limit
+    while True:
+        pks = list(queryset.values_list('pk', flat=True)[:size])
+        if not pks:
+            return
+        start = time.perf_counter()
+        count = process(pks)
+        elapsed = time.perf_counter() - start
+        if elapsed > max_seconds:
+            size = max(size // 2, 1)
+        elif elapsed < max_seconds / 2:
+            size = min(size * 2, limit)
+        yield count
+        if pause:
+            time.sleep(pause)
+
+
+def delete_in_batches(queryset, batch_size=None, max_seconds=None, pause=0):
+    """Delete the rows of ``queryset`` a batch at a time.
+
+    Yields the number of rows each batch deleted, counting those removed
+    by cascades.
+    """
+    def delete(pks):
+        # Rows that stopped matching since they were selected are kept.
+        deleted, _ = queryset.filter(pk__in=pks).delete()
+        return deleted
+
+    yield from in_batches(queryset, delete, batch_size, max_seconds, pause)
+
+
+def stale_carts(now):
+    cutoff = now - timedelta(days=getattr(settings, 'CLEANUP_CART_DAYS', 30))
+    # Changing an item does not touch the cart row.
+    return Cart.objects.filter(updated_at__lt=cutoff).exclude(items__updated_at__gte=cutoff)
+
+
+def abandoned_orders(now):
+    cutoff = now - timedelta(days=getattr(settings, 'CLEANUP_ABANDONED_ORDER_DAYS', 7))
+    return Order.objects.filter(status='pending', payment_status__in=('pending', 'failed'), created_at__lt=cutoff)
+
+
+def expired_sessions(now):
+    model = import_module(settings.SESSION_ENGINE).SessionStore.get_model_class()
+    return model.objects.filter(expire_date__lt=now)
+
+
+def expired_idempotency_keys(now):
+    return IdempotencyKey.objects.filter(expires_at__lt=now)
+
+
+TASKS = {
+    'carts': stale_carts,
+    'orders': abandoned_orders,
+    'sessions': expired_sessions,
+    'idempotency_keys': expired_idempotency_keys,
+}
+
+
+def run(task, **options):
+    """Run one task; return ``(rows deleted, batches, seconds)``."""
+    start = time.perf_counter()
+    rows = batches = 0
+    for deleted in delete_in_batches(TASKS[task](timezone.now()), **options):
+        rows += deleted
+        batches += 1
+        metrics.CLEANUP_DELETED_ROWS.inc(deleted, task=task)
+    return rows, batches, time.perf_counter() - start
@@ -1,5 +1,7 @@
 from django.conf import settings
-from .models import Cart, Category
+from django.db.models import Sum
+from .models import Cart, CartItem, Category
+from .page_cache import tag_versions
 
 
 def cart_context(request):
@@ -8,12 +10,18 @@ def cart_context(request):
     cart_total = 0
 
     if request.user.is_authenticated:
-        try:
-            cart = Cart.objects.get(user=request.user)
-            cart_items_count = cart.get_total_items()
-            cart_total = cart.get_total_price()
-        except Cart.DoesNotExist:
-            pass
+        cart_items_count = CartItem.objects.filter(cart__user=request.user).aggregate(
+            count=Sum('quantity')
+        )['count'] or 0
+        if cart_items_count:
+            # Only computed if a template uses it.
+            cart_total = lambda: Cart.objects.get(user=request.user).get_total_price()
+    else:
+        # Read from the cookie; no database access.
+        cookie_cart = getattr(request, 'cookie_cart', None)
+        if cookie_cart:
+            cart_items_count = cookie_cart.get_total_items()
+            cart_total = cookie_cart.get_total_price
 
     return {
         'cart_items_count': cart_items_count,
@@ -26,5 +34,8 @@ def categories_context(request):
     categories = Category.objects.filter(is_active=True)
     return {
         'categories': categories,
+        # Versions for keying cached fragments; the categories queryset is
+        # lazy and only hits the database when a fragment is rebuilt.
+        'cache_versions': tag_versions(['categories', 'catalog']),
         'site_url': getattr(settings, 'SITE_URL', 'http://localhost:8000'),
     }
@@ -0,0 +1,112 @@
+"""Database routing between the primary database and read replicas.
+
+Catalog models (categories, products, reviews, recommendations) are read
+from a replica listed in ``settings.DATABASE_REPLICAS``; every other model
+and every write goes to the primary. Once a request writes anything, the rest of
+that request reads from the primary, and ``ReplicaPinningMiddleware``
+keeps the session on the primary for ``REPLICA_PIN_SECONDS`` after a
+write so the user always sees their own changes.
+"""
+import contextvars
+import random
+import time
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS
+
+
+REPLICA_MODELS = {'category', 'product', 'review', 'productrecommendation'}
+SESSION_PIN_KEY = '_db_pinned_until'
+
+_pinned = contextvars.ContextVar('db_pinned_to_primary', default=False)
+
+
+def pin_to_primary():
+    """Send all reads for the rest of this request to the primary."""
+    _pinned.set(True)
+
+
+def reset_pinning():
+    """Forget earlier writes, e.g. between tests or background task runs."""
+    _pinned.set(False)
+
+
+def is_pinned():
+    return _pinned.get()
+
+
+def read_alias():
+    """Alias to read catalog or report data from for the current request."""
+    replicas = getattr(settings, 'DATABASE_REPLICAS', [])
+    if not replicas or _pinned.get():
+        return DEFAULT_DB_ALIAS
+    return random.choice(replicas)
+
+
+class PrimaryReplicaRouter:
+    """Route catalog reads to replicas and everything else to the primary"""
+
+    def db_for_read(self, model, **hints):
+        instance = hints.get('instance')
+        if instance is not None and instance._state.db:
+            # Follow relations on the database the instance came from.
+            return instance._state.db
+        if model._meta.app_label == 'shop' and model._meta.model_name in REPLICA_MODELS:
+            return read_alias()
+        return DEFAULT_DB_ALIAS
+
+    def db_for_write(self, model, **hints):
+        pin_to_primary()
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # Replicas hold the same data as the primary.
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        return True
+
+
+class ReplicaPinningMiddleware:
+    """Keep a session on the primary for a while after it writes"""
+
+    async_capable = True
+    sync_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        session = getattr(request, 'session', None)
+        pinned = session is not None and session.get(SESSION_PIN_KEY, 0) > time.time()
+        token = _pinned.set(pinned)
+        try:
+            response = self.get_response(request)
+            if self._wrote(request, session):
+                session[SESSION_PIN_KEY] = self._pinned_until()
+        finally:
+            _pinned.reset(token)
+        return response
+
+    async def __acall__(self, request):
+        session = getattr(request, 'session', None)
+        pinned = session is not None and await session.aget(SESSION_PIN_KEY, 0) > time.time()
+        token = _pinned.set(pinned)
+        try:
+            response = await self.get_response(request)
+            if self._wrote(request, session):
+                await session.aset(SESSION_PIN_KEY, self._pinned_until())
+        finally:
+            _pinned.reset(token)
+        return response
+
+    def _wrote(self, request, session):
+        return _pinned.get() and session is not None and request.method not in ('GET', 'HEAD', 'OPTIONS')
+
+    def _pinned_until(self):
+        return time.time() + getattr(settings, 'REPLICA_PIN_SECONDS', 10)
@@ -0,0 +1,175 @@
+"""Demand forecasts for the daily bake plan.
+
+``load_history`` sums the units of each product sold per day, from live
+and archived paid orders, into a (products × days) array. ``forecast``
+works on all products at once:
+
+* Day-of-week factors: each product's mean sales on a weekday over its
+  mean sales on any day. A product that never sells on Sundays gets 0.
+* Simple exponential smoothing of the sales divided by those factors.
+  ``scipy.signal.lfilter`` runs the recursion
+
+      level[t] = alpha * sales[t] + (1 - alpha) * level[t - 1]
+
+  along every row in C.
+* Expected demand on a future day is the last level times that weekday's
+  factor. The quantity to bake adds a safety margin for the spread of
+  the one-step forecast errors over the last ``ERROR_WINDOW`` days. The
+  margin is set so that demand stays below the plan with probability
+  ``FORECAST_SERVICE_LEVEL``, assuming normal errors.
+
+``plan`` writes the result to ``BakePlan``. Quantities staff have changed
+in the admin (``adjusted``) are kept; only their forecast is refreshed.
+
+Requires NumPy and SciPy; only the ``forecast_demand`` management command
+imports this module, never the web workers.
+"""
+import datetime
+from statistics import NormalDist
+
+import numpy as np
+from scipy.signal import lfilter
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.utils import timezone
+
+from .models import ArchivedOrder, ArchivedOrderItem, BakePlan, Order, OrderItem, Product
+
+
+ERROR_WINDOW = 56
+
+
+def _start_of(day):
+    return timezone.make_aware(datetime.datetime.combine(day, datetime.time.min))
+
+
+def load_history(start, end):
+    """Units sold per product and day from ``start`` until ``end`` (excluded).
+
+    Returns the product ids and a (products × days) float array.
+    """
+    zone, first = timezone.get_current_timezone(), start.toordinal()
+    sales = []
+    for order_model, item_model in ((Order, OrderItem), (ArchivedOrder, ArchivedOrderItem)):
+        orders = order_model.objects.filter(
+            payment_status='paid', created_at__gte=_start_of(start), created_at__lt=_start_of(end),
+        )
+        # Days are worked out per order here. Truncating dates in SQL would
+        # run a Python function for every item row on SQLite.
+        order_rows = list(orders.values_list('pk', 'created_at').order_by('pk'))
+        if not order_rows:
+            continue
+        order_ids = np.array([pk for pk, _ in order_rows], dtype=np.int64)
+        order_days = np.array([created.astimezone(zone).date().toordinal() for _, created in order_rows]) - first
+        items = np.array(
+            list(item_model.objects.filter(order__in=orders, product__isnull=False)
+                 .values_list('order_id', 'product_id', 'quantity').order_by()),
+            dtype=np.int64,
+        ).reshape(-1, 3)
+        day = order_days[np.searchsorted(order_ids, items[:, 0])]
+        sales.append(np.column_stack([items[:, 1], day, items[:, 2]]))
+
+    days = (end - start).days
+    sales = np.concatenate(sales) if sales else np.zeros((0, 3), dtype=np.int64)
+    products, row = np.unique(sales[:, 0], return_inverse=True)
+    history = np.zeros((len(products), days))
+    np.add.at(history, (row, sales[:, 1]), sales[:, 2])
+    return products, history
+
+
+def forecast(history, first_weekday, horizon, alpha, service_level):
+    """Forecast the ``horizon`` days that follow ``history``.
+
+    ``first_weekday`` is the weekday (Monday is 0) of the first day of
+    history. Returns the expected demand and the quantity to bake, both
+    (products × horizon) arrays.
+    """
+    products, days = history.shape
+    weekday = (first_weekday + np.arange(days)) % 7
+    by_weekday = np.eye(7)[weekday]
+    weekday_means = (history @ by_weekday) / np.maximum(by_weekday.sum(axis=0), 1)
+    overall = history.mean(axis=1, keepdims=True)
+    seasonal = np.divide(weekday_means, overall, out=np.ones_like(weekday_means), where=overall > 0)
+    factors = seasonal[:, weekday]
+    # Days with a factor of 0 say nothing about the level and are skipped.
+    observed = (factors > 0).astype(np.float64)
+    adjusted = np.divide(history, factors, out=np.zeros_like(history), where=factors > 0)
+
+    # Smoothing both the values and the mask averages the observed days only.
+    # The level starts from the mean over all days.
+    weighted, _ = lfilter([alpha], [1, alpha - 1], adjusted, axis=1, zi=(1 - alpha) * overall)
+    weights, _ = lfilter([alpha], [1, alpha - 1], observed, axis=1, zi=np.full((products, 1), 1 - alpha))
+    level = np.divide(weighted, weights, out=np.zeros_like(weighted), where=weights > 0)
+
+    previous = np.hstack([overall, level[:, :-1]])
+    window = observed[:, -ERROR_WINDOW:]
+    errors = (adjusted - previous)[:, -ERROR_WINDOW:] * window
+    spread = np.sqrt((errors ** 2).sum(axis=1, keepdims=True) / np.maximum(window.sum(axis=1, keepdims=True), 1))
+
+    ahead = (first_weekday + days + np.arange(horizon)) % 7
+    expected = level[:, -1:] * seasonal[:, ahead]
+    # Errors are relative to the weekday factor, and so is the margin.
+    margin = NormalDist().inv_cdf(service_level) * spread * seasonal[:, ahead]
+    # Rounded first so that float noise does not add a whole unit.
+    quantity = np.ceil(np.round(expected + margin, 6)).clip(min=0).astype(np.int64)
+    return expected, quantity
+
+
+def plan(first_date, days=1, history_days=None, alpha=None, service_level=None):
+    """Forecast and store the bake plan of ``days`` days from ``first_date``.
+
+    History runs until the day before ``first_date``, or until yesterday
+    if that is earlier. Returns the number of products planned.
+    """
+    history_days = history_days or getattr(settings, 'FORECAST_HISTORY_DAYS', 365)
+    alpha = alpha or getattr(settings, 'FORECAST_SMOOTHING', 0.3)
+    service_level = service_level or getattr(settings, 'FORECAST_SERVICE_LEVEL', 0.9)
+    end = min(first_date, timezone.localdate())
+    start = end - datetime.timedelta(days=history_days)
+    products, history = load_history(start, end)
+    if not len(products):
+        return 0
+
+    # Days between the end of history and the first bake date are forecast too.
+    gap = (first_date - end).days
+    expected, quantity = forecast(history, start.weekday(), gap + days, alpha, service_level)
+    active = np.isin(products, list(Product.objects.filter(is_active=True).values_list('pk', flat=True)))
+
+    # Pad so that the last week of history always has seven days.
+    recent = np.hstack([np.zeros((len(products), 7)), history])[:, -7:]
+    plans = []
+    for offset in range(days):
+        column = gap + offset
+        last_week = recent[:, column % 7]
+        plans += [
+            BakePlan(
+                bake_date=first_date + datetime.timedelta(days=offset), product_id=int(product),
+                forecast=round(float(demand), 2), quantity=int(units), last_week=int(sold),
+            )
+            for product, demand, units, sold in zip(
+                products[active], expected[active, column], quantity[active, column], last_week[active]
+            )
+        ]
+    planned = {(plan.bake_date, plan.product_id) for plan in plans}
+    # MySQL upserts on any unique key and does not take a target.
+    target = ['bake_date', 'product'] if connection.features.supports_update_conflicts_with_target else None
+    upsert = {'update_conflicts': True, 'unique_fields': target, 'batch_size': 500}
+    with transaction.atomic():
+        rows = list(BakePlan.objects.filter(
+            bake_date__gte=first_date, bake_date__lt=first_date + datetime.timedelta(days=days),
+        ).values_list('pk', 'bake_date', 'product_id', 'adjusted'))
+        adjusted = {(bake_date, product) for _, bake_date, product, is_adjusted in rows if is_adjusted}
+        # Rows staff adjusted stay even if the product is no longer planned.
+        keep = planned | adjusted
+        stale = [pk for pk, bake_date, product, _ in rows if (bake_date, product) not in keep]
+        BakePlan.objects.filter(pk__in=stale).delete()
+        BakePlan.objects.bulk_create(
+            [plan for plan in plans if (plan.bake_date, plan.product_id) not in adjusted],
+            update_fields=['forecast', 'quantity', 'last_week', 'planned_at'], **upsert,
+        )
+        BakePlan.objects.bulk_create(
+            [plan for plan in plans if (plan.bake_date, plan.product_id) in adjusted],
+            update_fields=['forecast', 'last_week', 'planned_at'], **upsert,
+        )
+    return int(active.sum())
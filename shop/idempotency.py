@@ -0,0 +1,218 @@
+"""Idempotency keys for submissions that must not run twice.
+
+The client sends a fresh key with each logical submission, in the
+``Idempotency-Key`` header or an ``idempotency_key`` form field, and sends
+the same key again when it retries or the user double-clicks. The first
+request claims the key by inserting an ``IdempotencyKey`` row, runs the
+view and stores the response in that row; repeats within
+``IDEMPOTENCY_KEY_TTL`` seconds get the stored response back without
+running the view again. A repeat that arrives while the first request is
+still running waits up to ``IDEMPOTENCY_WAIT_SECONDS`` for its result.
+
+Keys belong to the signed-in user (or to anonymous visitors as a whole,
+which is safe because keys are random), and a key reused for a different
+request is refused. Responses with a 5xx status are not kept, so those
+can be retried with the same key.
+
+Flash messages and the anonymous cart live in cookies that the first
+response may have set without them ever reaching the client, so both are
+stored with the response and set again on a replay.
+"""
+import hashlib
+import re
+import time
+import uuid
+from datetime import timedelta
+from functools import wraps
+from urllib.parse import urlencode
+
+from asgiref.sync import iscoroutinefunction, sync_to_async
+from django.conf import settings
+from django.contrib import messages
+from django.db import IntegrityError, transaction
+from django.db.models import Q
+from django.http import HttpResponse, JsonResponse
+from django.utils import timezone
+
+from . import metrics
+from .models import IdempotencyKey
+
+
+HEADER = 'HTTP_IDEMPOTENCY_KEY'
+FORM_FIELD = 'idempotency_key'
+REPLAYED_HEADER = 'Idempotent-Replayed'
+KEY_PATTERN = re.compile(r'^[A-Za-z0-9_-]{16,64}$')
+FORM_CONTENT_TYPES = ('application/x-www-form-urlencoded', 'multipart/form-data')
+POLL_INTERVAL = 0.05
+
+
+def _setting(name, default):
+    return getattr(settings, name, default)
+
+
+def new_key():
+    """A fresh key for a form rendered by the server."""
+    return uuid.uuid4().hex
+
+
+def request_key(request):
+    """The idempotency key sent with ``request``, if any."""
+    key = request.META.get(HEADER)
+    if key is None and request.content_type in FORM_CONTENT_TYPES:
+        key = request.POST.get(FORM_FIELD)
+    return key or None
+
+
+def _owner(request):
+    return f'user:{request.user.pk}' if request.user.is_authenticated else 'anonymous'
+
+
+def _fingerprint(request):
+    if request.content_type in FORM_CONTENT_TYPES:
+        # The CSRF token is masked differently on every render.
+        payload = urlencode(sorted(
+            (name, value) for name, values in request.POST.lists()
+            if name not in ('csrfmiddlewaretoken', FORM_FIELD) for value in values
+        )).encode()
+    else:
+        payload = request.body
+    return hashlib.sha256(request.path.encode() + b'\n' + payload).hexdigest()
+
+
+def _claim(owner, key, fingerprint):
+    """Insert the row for ``key``; returns ``None`` if someone else holds it."""
+    now = timezone.now()
+    for _ in range(2):
+        try:
+            with transaction.atomic():
+                return IdempotencyKey.objects.create(
+                    owner=owner, key=key, fingerprint=fingerprint,
+                    expires_at=now + timedelta(seconds=_setting('IDEMPOTENCY_KEY_TTL', 86400)),
+                )
+        except IntegrityError:
+            # Take over expired keys and claims whose request died
+            # without storing a response.
+            abandoned = now - timedelta(seconds=_setting('IDEMPOTENCY_LOCK_SECONDS', 60))
+            if not IdempotencyKey.objects.filter(owner=owner, key=key).filter(
+                Q(expires_at__lte=now) | Q(status_code__isnull=True, created_at__lte=abandoned)
+            ).delete()[0]:
+                return None
+    return None
+
+
+def _wait_for(owner, key):
+    """The row for ``key`` once it has a response, or as it is at the deadline.
+
+    Returns ``None`` if the first request gave the key up by failing.
+    """
+    deadline = time.monotonic() + _setting('IDEMPOTENCY_WAIT_SECONDS', 5)
+    while True:
+        record = IdempotencyKey.objects.filter(owner=owner, key=key).first()
+        if record is None or record.status_code is not None or time.monotonic() >= deadline:
+            return record
+        time.sleep(POLL_INTERVAL)
+
+
+def _in_progress():
+    metrics.IDEMPOTENT_REQUESTS.inc(outcome='in_progress')
+    response = JsonResponse({'error': 'A request with this idempotency key is still in progress.'}, status=409)
+    response['Retry-After'] = '1'
+    return response
+
+
+def _replay(request, record, fingerprint):
+    if record.fingerprint != fingerprint:
+        metrics.IDEMPOTENT_REQUESTS.inc(outcome='mismatch')
+        return JsonResponse({'error': 'This idempotency key was used for a different request.'}, status=422)
+    if record.status_code is None:
+        return _in_progress()
+
+    metrics.IDEMPOTENT_REQUESTS.inc(outcome='replayed')
+    response = HttpResponse(bytes(record.body), status=record.status_code, content_type=record.content_type)
+    if record.location:
+        response['Location'] = record.location
+    response[REPLAYED_HEADER] = 'true'
+    if record.cookie_cart is not None and hasattr(request, 'cookie_cart'):
+        # The cookie the first response set may never have arrived.
+        request.cookie_cart.lines = {int(pk): quantity for pk, quantity in record.cookie_cart.items()}
+        request.cookie_cart.modified = True
+    for level, message, extra_tags in record.messages or ():
+        messages.add_message(request, level, message, extra_tags=extra_tags, fail_silently=True)
+    return response
+
+
+def _begin(request):
+    """Claim the request's key: ``(response, None)`` to answer with a stored
+    or error response, ``(None, record)`` to run the view, or
+    ``(None, None)`` when the request has no key."""
+    key = request_key(request) if request.method == 'POST' else None
+    if key is None:
+        return None, None
+    if not KEY_PATTERN.match(key):
+        return JsonResponse({'error': 'Idempotency keys are 16 to 64 letters, digits, - or _.'}, status=400), None
+
+    owner, fingerprint = _owner(request), _fingerprint(request)
+    record = _claim(owner, key, fingerprint)
+    if record is None:
+        existing = _wait_for(owner, key)
+        if existing is not None:
+            return _replay(request, existing, fingerprint), None
+        record = _claim(owner, key, fingerprint)
+        if record is None:
+            return _in_progress(), None
+    return None, record
+
+
+def _finish(request, record, response):
+    """Store the view's response in ``record``."""
+    if response.status_code >= 500 or response.streaming:
+        record.delete()
+        return response
+
+    metrics.IDEMPOTENT_REQUESTS.inc(outcome='stored')
+    record.status_code = response.status_code
+    record.content_type = response.get('Content-Type', '')
+    record.location = response.get('Location', '')
+    record.body = response.content
+    cookie_cart = getattr(request, 'cookie_cart', None)
+    if cookie_cart is not None and cookie_cart.modified:
+        record.cookie_cart = cookie_cart.lines
+    # Reading the storage would mark the visitor's earlier messages as shown.
+    queued = getattr(getattr(request, '_messages', None), '_queued_messages', [])
+    record.messages = [[message.level, str(message.message), message.extra_tags] for message in queued] or None
+    record.save(update_fields=['status_code', 'content_type', 'location', 'body', 'cookie_cart', 'messages'])
+    return response
+
+
+def idempotent(view):
+    """Run a POST view at most once per idempotency key and replay its response."""
+    if iscoroutinefunction(view):
+        @wraps(view)
+        async def async_wrapper(request, *args, **kwargs):
+            response, record = await sync_to_async(_begin)(request)
+            if response is not None:
+                return response
+            if record is None:
+                return await view(request, *args, **kwargs)
+            try:
+                response = await view(request, *args, **kwargs)
+            except BaseException:
+                await record.adelete()
+                raise
+            return await sync_to_async(_finish)(request, record, response)
+        return async_wrapper
+
+    @wraps(view)
+    def wrapper(request, *args, **kwargs):
+        response, record = _begin(request)
+        if response is not None:
+            return response
+        if record is None:
+            return view(request, *args, **kwargs)
+        try:
+            response = view(request, *args, **kwargs)
+        except BaseException:
+            record.delete()
+            raise
+        return _finish(request, record, response)
+    return wrapper
@@ -0,0 +1,109 @@
+"""Cross-worker cache invalidation bus.
+
+Every cache tag (``catalog``, ``product:<id>``, ...) has a version in a
+memory-mapped file at ``INVALIDATION_BUS_PATH`` that all processes on the
+host share. Slot 0 is a global generation that moves on every
+invalidation. Reading a version is a memory read, so workers can check
+tags on every lookup, and a worker notices a change made by any other
+worker straight away.
+
+Tags are hashed into a fixed number of slots; two tags sharing a slot only
+means one of them is invalidated more often than needed. Versions are
+nanosecond timestamps of the last change (at least one more than before),
+and a new file starts every slot at its creation time, so a cache entry
+can never be mistaken for current after the file is recreated.
+
+``invalidate`` bumps tags immediately and again when the surrounding
+transaction commits, so a worker that re-caches the old rows in between
+is corrected as soon as the new rows are visible. With
+``generation=False`` the global generation stays put; that is enough for
+entries that are only ever cached with their tags (sessions), and no
+worker has to empty its L1 for them.
+"""
+import contextlib
+import fcntl
+import mmap
+import os
+import struct
+import time
+import zlib
+
+from django.conf import settings
+from django.db import connection, transaction
+
+
+SLOTS = 1 << 16
+_SLOT = struct.Struct('Q')
+
+_bus = None
+
+
+class Bus:
+    """Tag versions in a shared memory-mapped file"""
+
+    def __init__(self, path):
+        self.path = path
+        self.pid = os.getpid()
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        size = SLOTS * _SLOT.size
+        with self._locked():
+            if os.fstat(self.fd).st_size < size:
+                os.pwrite(self.fd, _SLOT.pack(0) + _SLOT.pack(time.time_ns()) * (SLOTS - 1), 0)
+        self.mm = mmap.mmap(self.fd, size)
+        self.slots = memoryview(self.mm).cast('Q')
+
+    @contextlib.contextmanager
+    def _locked(self):
+        fcntl.flock(self.fd, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(self.fd, fcntl.LOCK_UN)
+
+    @staticmethod
+    def slot(tag):
+        return 1 + zlib.crc32(tag.encode()) % (SLOTS - 1)
+
+    @property
+    def generation(self):
+        return self.slots[0]
+
+    def versions(self, tags):
+        return {tag: self.slots[self.slot(tag)] for tag in tags}
+
+    def bump(self, tags, generation=True):
+        now = time.time_ns()
+        with self._locked():
+            for slot in {self.slot(tag) for tag in tags}:
+                self.slots[slot] = max(self.slots[slot] + 1, now)
+            if generation:
+                self.slots[0] += 1
+
+
+def get_bus():
+    """The bus of this process (reopened after a fork, for ``flock``)."""
+    global _bus
+    path = str(settings.INVALIDATION_BUS_PATH)
+    if _bus is None or _bus.pid != os.getpid() or _bus.path != path:
+        _bus = Bus(path)
+    return _bus
+
+
+def generation():
+    """Number of invalidations so far; changes whenever any tag does."""
+    return get_bus().generation
+
+
+def versions(tags):
+    """Return ``{tag: version}`` for ``tags``."""
+    return get_bus().versions(tags)
+
+
+def invalidate(*tags, generation=True):
+    """Give ``tags`` new versions now and once the transaction commits."""
+    if not tags:
+        return
+    get_bus().bump(tags, generation)
+    if connection.in_atomic_block:
+        transaction.on_commit(lambda: get_bus().bump(tags, generation))
@@ -0,0 +1,31 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from shop import archive
+
+
+class Command(BaseCommand):
+    help = 'Move finished orders older than ORDER_ARCHIVE_DAYS into the archive tables, in small batches'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, help='Most orders per transaction (default: CLEANUP_BATCH_SIZE)')
+        parser.add_argument('--max-batch-seconds', type=float,
+                            help='Shrink batches that take longer (default: CLEANUP_MAX_BATCH_SECONDS)')
+        parser.add_argument('--pause', type=float, default=0.0, help='Seconds to sleep between batches')
+        parser.add_argument('--dry-run', action='store_true', help='Only count what would be archived')
+
+    def handle(self, *args, **options):
+        if options['dry_run']:
+            self.stdout.write(f'{archive.archivable_orders().count()} orders to archive')
+            return
+        start = time.perf_counter()
+        orders = batches = 0
+        for moved in archive.archive_orders(
+            batch_size=options['batch_size'], max_seconds=options['max_batch_seconds'], pause=options['pause'],
+        ):
+            orders += moved
+            batches += 1
+        seconds = time.perf_counter() - start
+        rate = orders / seconds if seconds else 0
+        self.stdout.write(f'archived {orders} orders in {batches} batches, {seconds:.2f}s ({rate:.0f} orders/s)')
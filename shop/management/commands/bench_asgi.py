@@ -0,0 +1,266 @@
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import random
+import socket
+import sqlite3
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlencode
+
+from django.conf import settings
+from django.core.management import call_command
+from django.core.management.base import BaseCommand
+from django.utils.crypto import get_random_string
+
+
+CHECKOUT_USERS = 20
+SEARCH_PREFIXES = ('ca', 'br', 'choc', 'sour', 'cro', 'co')
+
+
+class PaymentStub(BaseHTTPRequestHandler):
+    """Answers Stripe's create-PaymentIntent call after a fixed delay"""
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        time.sleep(self.server.latency)
+        next(self.server.calls)
+        intent_id = f'pi_{uuid.uuid4().hex[:24]}'
+        body = json.dumps({
+            'id': intent_id,
+            'object': 'payment_intent',
+            'client_secret': f'{intent_id}_secret_{uuid.uuid4().hex[:12]}',
+            'status': 'requires_payment_method',
+        }).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def _free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def _prepare():
+    """Migrate the copied database and add what the load needs; runs with DB_PATH set."""
+    from django.test import Client
+    from shop.models import Cart, CartItem, Category, Product, User
+
+    call_command('migrate', verbosity=0, interactive=False)
+    if not Product.objects.filter(is_active=True, stock__gt=0).exists():
+        category = Category.objects.filter(is_active=True).first() or Category.objects.create(
+            name='Breads', slug='breads', category_type='breads'
+        )
+        for i in range(20):
+            Product.objects.create(
+                name=f'Bench Loaf {i}', slug=f'bench-loaf-{i}', category=category,
+                description='Benchmark product', price=100 + i, stock=1000, image='products/bench.jpg',
+            )
+    products = list(Product.objects.filter(is_active=True, stock__gt=0).values_list('pk', 'slug')[:50])
+    sessions = []
+    for i in range(CHECKOUT_USERS):
+        user, _ = User.objects.get_or_create(username=f'bench{i}', defaults={'email': f'bench{i}@example.com'})
+        cart, _ = Cart.objects.get_or_create(user=user)
+        CartItem.objects.get_or_create(cart=cart, product_id=products[i % len(products)][0])
+        client = Client()
+        client.force_login(user)
+        sessions.append(client.cookies[settings.SESSION_COOKIE_NAME].value)
+    return {
+        'products': [slug for _, slug in products],
+        'categories': list(Category.objects.filter(is_active=True).values_list('slug', flat=True)),
+        'sessions': sessions,
+    }
+
+
+async def _fetch(port, method, path, headers=(), body=b''):
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    try:
+        lines = [f'{method} {path} HTTP/1.1', f'Host: 127.0.0.1:{port}', 'Connection: close', *headers]
+        if body:
+            lines += ['Content-Type: application/x-www-form-urlencoded', f'Content-Length: {len(body)}']
+        writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode() + body)
+        await writer.drain()
+        status_line = await reader.readline()
+        await reader.read()
+        return int(status_line.split()[1])
+    finally:
+        writer.close()
+
+
+class Load:
+    """Mixed catalog, JSON API and checkout requests"""
+
+    def __init__(self, data, api_share, checkout_share):
+        self.data = data
+        self.api_share = api_share
+        self.checkout_share = checkout_share
+        self.csrf = get_random_string(32)
+        self.form = urlencode({
+            'shipping_name': 'Bench Customer', 'shipping_email': 'bench@example.com',
+            'shipping_phone': '9999999999', 'shipping_address': '1 Oven Lane', 'shipping_city': 'Varanasi',
+            'shipping_state': 'UP', 'shipping_postal_code': '221003', 'shipping_method': 'pickup',
+            'cardholder_name': 'Bench Customer',
+        }).encode()
+
+    def pick(self):
+        roll = random.random()
+        if roll < self.checkout_share:
+            session = random.choice(self.data['sessions'])
+            headers = (
+                f'Cookie: {settings.SESSION_COOKIE_NAME}={session}; {settings.CSRF_COOKIE_NAME}={self.csrf}',
+                f'X-CSRFToken: {self.csrf}',
+            )
+            return 'checkout', 'POST', '/checkout/', headers, self.form
+        if roll < self.checkout_share + self.api_share:
+            if random.random() < 0.5:
+                return 'api', 'GET', f'/search/suggest/?q={random.choice(SEARCH_PREFIXES)}', (), b''
+            return 'api', 'GET', '/cart/api/', (), b''
+        path = random.choice([
+            '/', '/shop/', '/shop/?sort=price_low',
+            f'/product/{random.choice(self.data["products"])}/',
+            f'/category/{random.choice(self.data["categories"])}/' if self.data['categories'] else '/shop/',
+        ])
+        return 'catalog', 'GET', path, (), b''
+
+    async def run(self, port, concurrency, duration):
+        results = {'catalog': [], 'api': [], 'checkout': []}
+        deadline = time.perf_counter() + duration
+
+        async def user():
+            while time.perf_counter() < deadline:
+                kind, method, path, headers, body = self.pick()
+                start = time.perf_counter()
+                try:
+                    status = await asyncio.wait_for(_fetch(port, method, path, headers, body), 30)
+                except (OSError, ValueError, IndexError, asyncio.TimeoutError):
+                    status = None
+                results[kind].append((time.perf_counter() - start, status))
+
+        await asyncio.gather(*(user() for _ in range(concurrency)))
+        return results
+
+
+class Command(BaseCommand):
+    help = 'Benchmark the gunicorn.conf.py profiles under mixed load with a local payment stub'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, help='Gunicorn workers per server (default: autotuned)')
+        parser.add_argument('--concurrency', type=int, default=50, help='Concurrent clients')
+        parser.add_argument('--duration', type=float, default=10.0, help='Seconds per run')
+        parser.add_argument('--payment-latency', type=float, default=0.3,
+                            help='Seconds the payment stub takes per PaymentIntent')
+        parser.add_argument('--checkout-share', type=float, default=0.1, help='Fraction of checkout POSTs')
+        parser.add_argument('--api-share', type=float, default=0.3, help='Fraction of JSON API requests')
+        parser.add_argument('--no-page-cache', action='store_true', help='Render every catalog page')
+        parser.add_argument('--modes', default='sync,threaded,async', help='GUNICORN_PROFILEs to compare')
+        parser.add_argument('--prepare', action='store_true', help=argparse.SUPPRESS)
+
+    def handle(self, *args, **options):
+        if options['prepare']:
+            self.stdout.write(json.dumps(_prepare()))
+            return
+
+        stub = ThreadingHTTPServer(('127.0.0.1', 0), PaymentStub)
+        stub.daemon_threads = True
+        stub.latency = options['payment_latency']
+        stub.calls = itertools.count()
+        threading.Thread(target=stub.serve_forever, daemon=True).start()
+
+        with tempfile.TemporaryDirectory() as tmp:
+            env = self._environment(tmp, stub, options)
+            data = json.loads(subprocess.run(
+                [sys.executable, 'manage.py', 'bench_asgi', '--prepare'],
+                cwd=settings.BASE_DIR, env=env, check=True, capture_output=True, text=True,
+            ).stdout)
+            load = Load(data, options['api_share'], options['checkout_share'])
+            for mode in options['modes'].split(','):
+                calls_before = next(stub.calls)
+                results = self._run(mode, env, load, options)
+                self._report(mode, results, options)
+                self.stdout.write(f'  {next(stub.calls) - calls_before - 1} PaymentIntents created')
+        stub.shutdown()
+        self.stdout.write(self.style.SUCCESS('Benchmark complete'))
+
+    def _environment(self, tmp, stub, options):
+        """Servers get a copy of the database and caches of their own."""
+        db_path = os.path.join(tmp, 'db.sqlite3')
+        source = sqlite3.connect(settings.DATABASES['default']['NAME'])
+        target = sqlite3.connect(db_path)
+        source.backup(target)
+        source.close()
+        target.close()
+        return {
+            **os.environ,
+            'DB_PATH': db_path,
+            'DB_REPLICAS': '',
+            'CACHE_DIR': os.path.join(tmp, 'cache'),
+            'METRICS_DIR': os.path.join(tmp, 'metrics'),
+            'AUTOCOMPLETE_INDEX_PATH': os.path.join(tmp, 'autocomplete', 'index.bin'),
+            'STRIPE_API_BASE': f'http://127.0.0.1:{stub.server_address[1]}',
+            'STRIPE_SECRET_KEY': 'sk_test_bench',
+            'DEBUG': 'False',
+            'SECURE_SSL_REDIRECT': 'False',
+            'ALLOWED_HOSTS': '127.0.0.1',
+            'PAGE_CACHE_ENABLED': 'False' if options['no_page_cache'] else 'True',
+        }
+
+    def _run(self, mode, env, load, options):
+        port = _free_port()
+        workers = ['--workers', str(options['workers'])] if options['workers'] else []
+        server = subprocess.Popen(
+            [sys.executable, '-m', 'gunicorn', '--config', 'gunicorn.conf.py', '--bind', f'127.0.0.1:{port}',
+             *workers, '--log-level', 'warning'],
+            cwd=settings.BASE_DIR, env={**env, 'GUNICORN_PROFILE': mode},
+        )
+        try:
+            self._wait_until_up(port)
+            # Warm the page cache, autocomplete index and DB connections.
+            asyncio.run(load.run(port, options['workers'] or 3, 1.0))
+            return asyncio.run(load.run(port, options['concurrency'], options['duration']))
+        finally:
+            server.terminate()
+            server.wait(timeout=30)
+
+    def _wait_until_up(self, port):
+        deadline = time.monotonic() + 30
+        while time.monotonic() < deadline:
+            try:
+                asyncio.run(_fetch(port, 'GET', '/'))
+                return
+            except (OSError, ValueError, IndexError):
+                time.sleep(0.2)
+        raise RuntimeError(f'Server on port {port} did not start')
+
+    def _report(self, mode, results, options):
+        duration = options['duration']
+        total = sum(len(samples) for samples in results.values())
+        self.stdout.write(
+            f'{mode}: {total / duration:.1f} req/s ({options["workers"] or "autotuned"} workers, '
+            f'{options["concurrency"]} clients, {duration}s)'
+        )
+        for kind, samples in results.items():
+            if not samples:
+                continue
+            latencies = sorted(latency for latency, _ in samples)
+            ok = sum(1 for _, status in samples if status in (200, 304))
+            p95 = latencies[int(len(latencies) * 0.95) - 1] if len(latencies) > 1 else latencies[0]
+            self.stdout.write(
+                f'  {kind:9s} {len(samples) / duration:8.1f} req/s  '
+                f'p50 {statistics.median(latencies) * 1000:7.1f} ms  p95 {p95 * 1000:7.1f} ms  '
+                f'{len(samples) - ok} failed'
+            )
@@ -0,0 +1,93 @@
+import multiprocessing
+import os
+import sqlite3
+import tempfile
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import DEFAULT_DB_ALIAS, OperationalError, connections, transaction
+from django.db.utils import load_backend
+
+from sqlite_backend.base import DEFAULT_PRAGMAS
+
+
+ALIAS = 'bench'
+
+
+def _setup(path):
+    conn = sqlite3.connect(path)
+    conn.execute('CREATE TABLE product (id INTEGER PRIMARY KEY, stock INTEGER, views INTEGER)')
+    conn.execute('CREATE TABLE order_item (id INTEGER PRIMARY KEY, product_id INTEGER, quantity INTEGER)')
+    conn.executemany('INSERT INTO product (id, stock, views) VALUES (?, 1000000, 0)', [(i,) for i in range(1, 51)])
+    conn.commit()
+    conn.close()
+
+
+def _connect(path, tuned):
+    """A connection to ``path`` through the stock or the project backend, as ``bench``."""
+    engine = 'sqlite_backend' if tuned else 'django.db.backends.sqlite3'
+    settings_dict = {
+        **connections[DEFAULT_DB_ALIAS].settings_dict,
+        'ENGINE': engine, 'NAME': path, 'CONN_MAX_AGE': None,
+        # The stock backend gets the same busy timeout as the tuned one.
+        'OPTIONS': {} if tuned else {'timeout': DEFAULT_PRAGMAS['busy_timeout'] / 1000},
+    }
+    connections[ALIAS] = load_backend(engine).DatabaseWrapper(settings_dict, ALIAS)
+    return connections[ALIAS]
+
+
+def _worker(path, tuned, duration, worker_id, results):
+    """Run checkout-like read/write transactions until the deadline."""
+    connection = _connect(path, tuned)
+    done = errors = 0
+    product_id = worker_id % 50 + 1
+    deadline = time.perf_counter() + duration
+    with connection.cursor() as cursor:
+        while time.perf_counter() < deadline:
+            try:
+                # The backend starts the transaction (BEGIN IMMEDIATE when tuned).
+                with transaction.atomic(using=ALIAS):
+                    cursor.execute('SELECT stock FROM product WHERE id = %s', [product_id]).fetchone()
+                    cursor.execute('UPDATE product SET stock = stock - 1 WHERE id = %s', [product_id])
+                    cursor.execute('INSERT INTO order_item (product_id, quantity) VALUES (%s, 1)', [product_id])
+                done += 1
+            except OperationalError:
+                errors += 1
+            # Interleave some catalog reads, as real traffic does.
+            cursor.execute('SELECT id, stock FROM product WHERE stock > 0 LIMIT 20').fetchall()
+    connection.close()
+    results.put((done, errors))
+
+
+class Command(BaseCommand):
+    help = 'Benchmark concurrent SQLite writes with default vs tuned (sqlite_backend) settings'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=3, help='Concurrent writer processes')
+        parser.add_argument('--duration', type=float, default=5.0, help='Seconds per run')
+
+    def handle(self, *args, **options):
+        workers = options['workers']
+        duration = options['duration']
+        for label, tuned in (('default', False), ('tuned', True)):
+            with tempfile.TemporaryDirectory() as tmp:
+                path = os.path.join(tmp, 'bench.sqlite3')
+                _setup(path)
+                results = multiprocessing.Queue()
+                procs = [
+                    multiprocessing.Process(target=_worker, args=(path, tuned, duration, i, results))
+                    for i in range(workers)
+                ]
+                for proc in procs:
+                    proc.start()
+                totals = [results.get() for _ in procs]
+                for proc in procs:
+                    proc.join()
+
+            done = sum(t[0] for t in totals)
+            errors = sum(t[1] for t in totals)
+            self.stdout.write(
+                f'{label:8s} {done / duration:10.1f} tx/s  '
+                f'{errors} "database is locked" errors ({workers} workers, {duration}s)'
+            )
+        self.stdout.write(self.style.SUCCESS('Benchmark complete'))
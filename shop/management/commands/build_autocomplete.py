@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+
+from shop.autocomplete import build_index
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the search box autocomplete snapshot (picks up new popular queries)'
+
+    def handle(self, *args, **options):
+        count = build_index()
+        self.stdout.write(self.style.SUCCESS(f'Wrote {count} autocomplete keys'))
@@ -0,0 +1,26 @@
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+
+class Command(BaseCommand):
+    help = 'Build "frequently bought together" recommendations from paid orders'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--full', action='store_true',
+                            help='Recount every paid order instead of only the new ones')
+        parser.add_argument('--top', type=int, default=getattr(settings, 'RECOMMENDATIONS_PER_PRODUCT', 4),
+                            help='Recommendations stored per product')
+
+    def handle(self, *args, **options):
+        # Imported here so the rest of the project does not need NumPy/SciPy.
+        from shop.recommendations import rebuild_recommendations, update_pair_counts
+
+        start = time.perf_counter()
+        added = update_pair_counts(full=options['full'])
+        changed = rebuild_recommendations(k=options['top'])
+        self.stdout.write(self.style.SUCCESS(
+            f'Counted {added} new paid orders; updated recommendations for {len(changed)} products '
+            f'in {time.perf_counter() - start:.2f}s'
+        ))
@@ -0,0 +1,46 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from shop import cleanup
+
+
+class Command(BaseCommand):
+    help = 'Delete stale carts, abandoned orders, expired sessions and idempotency keys in small batches'
+
+    def add_arguments(self, parser):
+        parser.add_argument('tasks', nargs='*', help=f'Tasks to run (default: all of {", ".join(cleanup.TASKS)})')
+        parser.add_argument('--batch-size', type=int, help='Most rows per transaction (default: CLEANUP_BATCH_SIZE)')
+        parser.add_argument('--max-batch-seconds', type=float,
+                            help='Shrink batches that take longer (default: CLEANUP_MAX_BATCH_SECONDS)')
+        parser.add_argument('--pause', type=float, default=0.0, help='Seconds to sleep between batches')
+        parser.add_argument('--loop', type=float, metavar='SECONDS',
+                            help='Keep running, starting a new round this many seconds after the last')
+        parser.add_argument('--dry-run', action='store_true', help='Only count what would be deleted')
+
+    def handle(self, *args, **options):
+        tasks = options['tasks'] or list(cleanup.TASKS)
+        unknown = set(tasks) - set(cleanup.TASKS)
+        if unknown:
+            raise CommandError(f'Unknown tasks: {", ".join(sorted(unknown))}')
+        while True:
+            for task in tasks:
+                self._run(task, options)
+            if options['loop'] is None:
+                break
+            time.sleep(options['loop'])
+
+    def _run(self, task, options):
+        if options['dry_run']:
+            count = cleanup.TASKS[task](timezone.now()).count()
+            self.stdout.write(f'{task}: {count} rows to delete, not counting cascades')
+            return
+        rows, batches, seconds = cleanup.run(
+            task, batch_size=options['batch_size'], max_seconds=options['max_batch_seconds'],
+            pause=options['pause'],
+        )
+        rate = rows / seconds if seconds else 0
+        self.stdout.write(
+            f'{task}: deleted {rows} rows in {batches} batches, {seconds:.2f}s ({rate:.0f} rows/s)'
+        )
@@ -0,0 +1,41 @@
+import datetime
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+
+class Command(BaseCommand):
+    help = 'Forecast demand per product from paid orders and write the bake plan'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--date', type=datetime.date.fromisoformat,
+                            help='First bake date, YYYY-MM-DD (default: tomorrow)')
+        parser.add_argument('--days', type=int, default=1, help='Days to plan from --date')
+        parser.add_argument('--history-days', type=int, default=getattr(settings, 'FORECAST_HISTORY_DAYS', 365),
+                            help='Days of order history to learn from')
+        parser.add_argument('--alpha', type=float, default=getattr(settings, 'FORECAST_SMOOTHING', 0.3),
+                            help='Smoothing factor, between 0 and 1; higher follows recent days more closely')
+        parser.add_argument('--service-level', type=float, default=getattr(settings, 'FORECAST_SERVICE_LEVEL', 0.9),
+                            help='Chance that the plan covers the demand of a day')
+
+    def handle(self, *args, **options):
+        # Imported here so the rest of the project does not need NumPy/SciPy.
+        from shop.forecast import plan
+
+        if options['days'] < 1 or options['history_days'] < 7:
+            raise CommandError('--days must be at least 1 and --history-days at least 7')
+        if not 0 < options['alpha'] <= 1 or not 0.5 <= options['service_level'] < 1:
+            raise CommandError('--alpha must be in (0, 1] and --service-level in [0.5, 1)')
+        first_date = options['date'] or timezone.localdate() + datetime.timedelta(days=1)
+
+        start = time.perf_counter()
+        products = plan(
+            first_date, days=options['days'], history_days=options['history_days'],
+            alpha=options['alpha'], service_level=options['service_level'],
+        )
+        self.stdout.write(self.style.SUCCESS(
+            f'Planned {products} products for {options["days"]} days from {first_date} '
+            f'in {time.perf_counter() - start:.2f}s'
+        ))
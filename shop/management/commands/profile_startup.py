@@ -0,0 +1,100 @@
+import collections
+import json
+import os
+import subprocess
+import sys
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+
+# Runs in a fresh interpreter under ``python -X importtime``. Phase markers
+# go to stderr so that imports can be attributed to the phase they ran in.
+BOOT = '''
+import json, os, sys, time
+start = time.perf_counter()
+
+def phase(name):
+    print(f'phase: {name}', file=sys.stderr, flush=True)
+
+phase('boot')
+from django.core.wsgi import get_wsgi_application
+get_wsgi_application()
+timings = {'boot': time.perf_counter() - start}
+if os.environ['WARMUP'] == 'True':
+    phase('warmup')
+    from shop.warmup import warm
+    start = time.perf_counter()
+    timings['steps'] = warm()
+    timings['warmup'] = time.perf_counter() - start
+from django.test import Client
+client = Client(HTTP_HOST=os.environ['PROFILE_HOST'])
+phase('requests')
+for name in ('first_request', 'second_request'):
+    start = time.perf_counter()
+    timings['status'] = client.get(os.environ['PROFILE_PATH']).status_code
+    timings[name] = time.perf_counter() - start
+print(json.dumps(timings))
+'''
+
+
+def _imports(stderr):
+    """Self time of imports in microseconds, by phase and top-level package."""
+    phases = collections.defaultdict(collections.Counter)
+    phase = 'interpreter'
+    for line in stderr.splitlines():
+        if line.startswith('phase: '):
+            phase = line[len('phase: '):]
+        elif line.startswith('import time:') and not line.endswith('imported package'):
+            self_us, _, name = line[len('import time:'):].split('|')
+            phases[phase][name.strip().split('.')[0]] += int(self_us)
+    return phases
+
+
+class Command(BaseCommand):
+    help = 'Measure worker start-up: import time by package, warm-up steps and the first requests'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--path', default='/about/', help='Page to request after start-up')
+        parser.add_argument('--top', type=int, default=12, help='Packages to list')
+
+    def handle(self, *args, **options):
+        for warmup in (False, True):
+            timings, phases = self._run(warmup, options['path'])
+            self._report(warmup, timings, phases, options)
+
+    def _run(self, warmup, path):
+        env = {
+            **os.environ,
+            'DJANGO_SETTINGS_MODULE': os.environ.get('DJANGO_SETTINGS_MODULE', 'goodluck_bakery.settings'),
+            'WARMUP': str(warmup),
+            'METRICS_ENABLED': 'False',
+            'PROFILE_HOST': settings.ALLOWED_HOSTS[0] if settings.ALLOWED_HOSTS else 'localhost',
+            'PROFILE_PATH': path,
+        }
+        result = subprocess.run(
+            [sys.executable, '-X', 'importtime', '-c', BOOT],
+            cwd=settings.BASE_DIR, env=env, capture_output=True, text=True,
+        )
+        if result.returncode:
+            self.stderr.write(result.stderr[-2000:])
+            raise SystemExit(result.returncode)
+        return json.loads(result.stdout.splitlines()[-1]), _imports(result.stderr)
+
+    def _report(self, warmup, timings, phases, options):
+        self.stdout.write(self.style.MIGRATE_HEADING('With warm-up' if warmup else 'Without warm-up'))
+        boot_imports = phases['boot']
+        self.stdout.write(
+            f'  boot {timings["boot"] * 1000:7.1f} ms, of which imports '
+            f'{sum(boot_imports.values()) / 1000:.1f} ms:'
+        )
+        for package, micros in boot_imports.most_common(options['top']):
+            self.stdout.write(f'    {package:24s} {micros / 1000:7.1f} ms')
+        if warmup:
+            steps = ', '.join(f'{name} {seconds * 1000:.1f} ms' for name, seconds in timings['steps'].items())
+            self.stdout.write(f'  warm-up {timings["warmup"] * 1000:7.1f} ms ({steps})')
+        request_imports = sum(phases['requests'].values()) / 1000
+        self.stdout.write(
+            f'  GET {options["path"]} -> {timings["status"]}: first {timings["first_request"] * 1000:.1f} ms '
+            f'({request_imports:.1f} ms importing), second {timings["second_request"] * 1000:.1f} ms'
+        )
@@ -0,0 +1,179 @@
+"""Serving uploaded media files.
+
+``MediaFilesMiddleware`` answers requests under ``MEDIA_URL`` before the
+session, auth and CSRF middleware run. ``serve_media`` handles them:
+
+* Whole files go out as a ``FileResponse``, which the WSGI server sends
+  with ``sendfile`` (gunicorn uses ``wsgi.file_wrapper``).
+* Single ``Range`` requests get a 206 with just those bytes, and
+  ``If-Range`` is honoured.
+* ``ETag``/``Last-Modified`` validators let browsers revalidate with a 304.
+* Uploads are stored under content-hashed names (see ``shop.storage``), so
+  hashed paths are cached for a year as ``immutable``. Other files are
+  cached for ``MEDIA_MAX_AGE`` seconds.
+
+With ``MEDIA_SENDFILE_HEADER`` set to ``X-Accel-Redirect`` (nginx) or
+``X-Sendfile`` (Apache, lighttpd), the response only carries headers and
+the proxy in front sends the file, ranges and all.
+"""
+import mimetypes
+import os
+import re
+import stat
+from urllib.parse import quote
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.http import FileResponse, Http404, HttpResponse
+from django.utils._os import safe_join
+from django.utils.cache import get_conditional_response, patch_cache_control
+from django.utils.http import http_date, parse_http_date_safe
+
+
+IMMUTABLE_MAX_AGE = 365 * 24 * 60 * 60
+HASHED_NAME = re.compile(r'\.[0-9a-f]{12}\.[^./]+$')
+RANGE = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+
+class _FileRange:
+    """Read at most ``length`` bytes of ``file`` from where it is positioned.
+
+    Keeps ``fileno`` so servers can still ``sendfile`` the range; they send
+    ``Content-Length`` bytes from the current offset.
+    """
+
+    def __init__(self, file, length):
+        self.file = file
+        self.remaining = length
+
+    def read(self, size=-1):
+        size = self.remaining if size < 0 else min(size, self.remaining)
+        data = self.file.read(size)
+        self.remaining -= len(data)
+        return data
+
+    def fileno(self):
+        return self.file.fileno()
+
+    def close(self):
+        self.file.close()
+
+
+def _etag(st):
+    return f'"{st.st_mtime_ns:x}-{st.st_size:x}"'
+
+
+def _parse_range(header, size):
+    """``(start, end)`` of a single satisfiable byte range, ``None`` to send
+    the whole file, or ``False`` when the range cannot be satisfied."""
+    match = RANGE.match(header.replace(' ', ''))
+    if not match or match.groups() == ('', ''):
+        # Several ranges or a malformed header: send the whole file.
+        return None
+    first, last = match.groups()
+    if not first:
+        start, end = max(size - int(last), 0), size - 1
+    else:
+        start, end = int(first), min(int(last), size - 1) if last else size - 1
+    if start > end or start >= size:
+        return False
+    return start, end
+
+
+def _range_applies(request, etag, last_modified):
+    if_range = request.META.get('HTTP_IF_RANGE')
+    if not if_range:
+        return True
+    if if_range.startswith(('"', 'W/')):
+        return if_range == etag
+    return parse_http_date_safe(if_range) == last_modified
+
+
+def _cache_headers(response, path):
+    if HASHED_NAME.search(path):
+        patch_cache_control(response, public=True, max_age=IMMUTABLE_MAX_AGE, immutable=True)
+    else:
+        patch_cache_control(response, public=True, max_age=getattr(settings, 'MEDIA_MAX_AGE', 86400))
+
+
+def serve_media(request, path):
+    """Serve the file at ``path`` below ``MEDIA_ROOT``"""
+    try:
+        full_path = safe_join(settings.MEDIA_ROOT, path)
+        st = os.stat(full_path)
+    except (ValueError, OSError):
+        raise Http404('Media file not found')
+    if not stat.S_ISREG(st.st_mode):
+        raise Http404('Media file not found')
+
+    etag, last_modified = _etag(st), int(st.st_mtime)
+    response = get_conditional_response(request, etag=etag, last_modified=last_modified)
+    if response is None:
+        content_type, _ = mimetypes.guess_type(full_path)
+        content_type = content_type or 'application/octet-stream'
+        sendfile_header = getattr(settings, 'MEDIA_SENDFILE_HEADER', '')
+        if sendfile_header:
+            response = HttpResponse(content_type=content_type)
+            if sendfile_header.lower() == 'x-accel-redirect':
+                response[sendfile_header] = quote(settings.MEDIA_ACCEL_REDIRECT_PREFIX + path)
+            else:
+                response[sendfile_header] = full_path
+        else:
+            response = _file_response(request, full_path, st, content_type, etag, last_modified)
+    response['ETag'] = etag
+    response['Last-Modified'] = http_date(last_modified)
+    _cache_headers(response, path)
+    return response
+
+
+def _file_response(request, full_path, st, content_type, etag, last_modified):
+    byte_range = None
+    if 'HTTP_RANGE' in request.META and _range_applies(request, etag, last_modified):
+        byte_range = _parse_range(request.META['HTTP_RANGE'], st.st_size)
+    if byte_range is False:
+        response = HttpResponse(status=416)
+        response['Content-Range'] = f'bytes */{st.st_size}'
+        return response
+
+    file = open(full_path, 'rb')
+    if byte_range is None:
+        response = FileResponse(file, content_type=content_type)
+    else:
+        start, end = byte_range
+        file.seek(start)
+        response = FileResponse(_FileRange(file, end - start + 1), status=206, content_type=content_type)
+        response['Content-Length'] = end - start + 1
+        response['Content-Range'] = f'bytes {start}-{end}/{st.st_size}'
+    response['Accept-Ranges'] = 'bytes'
+    return response
+
+
+class MediaFilesMiddleware:
+    """Serve ``MEDIA_URL`` requests without running the rest of the stack"""
+
+    async_capable = True
+    sync_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.prefix = settings.MEDIA_URL
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        response = self._serve(request)
+        return self.get_response(request) if response is None else response
+
+    async def __acall__(self, request):
+        response = self._serve(request)
+        return await self.get_response(request) if response is None else response
+
+    def _serve(self, request):
+        if request.path_info.startswith(self.prefix) and request.method in ('GET', 'HEAD'):
+            try:
+                return serve_media(request, request.path_info[len(self.prefix):])
+            except Http404:
+                return HttpResponse('Not Found', status=404, content_type='text/plain')
+        return None
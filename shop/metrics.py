@@ -0,0 +1,439 @@
+"""Prometheus metrics shared across gunicorn workers.
+
+Every process records into its own memory-mapped file under
+``settings.METRICS_DIR``; recording a sample is a dict lookup plus a
+``struct.pack_into`` on the mapping, so it is cheap enough to leave on.
+The ``/metrics`` view reads all files and merges them into one
+Prometheus text-format exposition.
+
+When a process exits, it folds its counters and histograms into
+``values_aggregate.db`` and deletes its files; gunicorn's master does the
+same for workers that died without running ``atexit`` hooks. The
+directory therefore holds one file per live process rather than one per
+worker, test run or cron command ever started. Folding holds an exclusive lock on the directory and ``collect``
+a shared one, so a scrape never counts a worker twice or not at all.
+"""
+import atexit
+import contextlib
+import fcntl
+import glob
+import json
+import math
+import mmap
+import os
+import struct
+import threading
+
+from django.conf import settings
+
+
+_HEADER = struct.Struct('i')
+_KEY_LEN = struct.Struct('i')
+_VALUE = struct.Struct('d')
+_INITIAL_SIZE = 1 << 16
+
+
+class MmapValues:
+    """Append-only map of string keys to doubles backed by an mmap'd file.
+
+    Layout: a 4 byte "used bytes" header, then entries of
+    ``<int key length><utf-8 key padded to 8 bytes><double value>``.
+    """
+
+    def __init__(self, path):
+        self._lock = threading.Lock()
+        self._file = open(path, 'a+b')
+        fileno = self._file.fileno()
+        self._capacity = os.fstat(fileno).st_size
+        if self._capacity == 0:
+            self._file.truncate(_INITIAL_SIZE)
+            self._capacity = _INITIAL_SIZE
+        self._map = mmap.mmap(fileno, self._capacity)
+        self._positions = {}
+        self._used = _HEADER.unpack_from(self._map, 0)[0]
+        if self._used == 0:
+            self._used = 8
+            _HEADER.pack_into(self._map, 0, self._used)
+        else:
+            for key, _, pos in iter_entries(self._map, self._used):
+                self._positions[key] = pos
+
+    def _grow(self, needed):
+        while self._capacity < needed:
+            self._capacity *= 2
+        self._map.close()
+        self._file.truncate(self._capacity)
+        self._map = mmap.mmap(self._file.fileno(), self._capacity)
+
+    def _position(self, key):
+        pos = self._positions.get(key)
+        if pos is None:
+            encoded = key.encode('utf-8')
+            padded = encoded + b' ' * (8 - (len(encoded) + 4) % 8)
+            size = _KEY_LEN.size + len(padded) + _VALUE.size
+            if self._used + size > self._capacity:
+                self._grow(self._used + size)
+            _KEY_LEN.pack_into(self._map, self._used, len(encoded))
+            self._map[self._used + 4:self._used + 4 + len(padded)] = padded
+            pos = self._used + 4 + len(padded)
+            _VALUE.pack_into(self._map, pos, 0.0)
+            self._used += size
+            _HEADER.pack_into(self._map, 0, self._used)
+            self._positions[key] = pos
+        return pos
+
+    def inc(self, key, amount):
+        with self._lock:
+            pos = self._position(key)
+            value = _VALUE.unpack_from(self._map, pos)[0]
+            _VALUE.pack_into(self._map, pos, value + amount)
+
+    def set(self, key, value):
+        with self._lock:
+            _VALUE.pack_into(self._map, self._position(key), value)
+
+    def close(self):
+        with self._lock:
+            self._map.close()
+            self._file.close()
+
+
+def iter_entries(data, used):
+    """Yield ``(key, value, value_position)`` for every entry in a buffer."""
+    pos = 8
+    while pos < used:
+        length = _KEY_LEN.unpack_from(data, pos)[0]
+        key = bytes(data[pos + 4:pos + 4 + length]).decode('utf-8')
+        padded = length + (8 - (length + 4) % 8)
+        value_pos = pos + 4 + padded
+        yield key, _VALUE.unpack_from(data, value_pos)[0], value_pos
+        pos = value_pos + _VALUE.size
+
+
+def read_entries(path):
+    """Yield ``(key, value)`` for every entry in the file at ``path``."""
+    try:
+        with open(path, 'rb') as f:
+            data = f.read()
+    except OSError:
+        return
+    if len(data) < 8:
+        return
+    for key, value, _ in iter_entries(data, _HEADER.unpack_from(data, 0)[0]):
+        yield key, value
+
+
+# ============================================
+# PER-PROCESS STORAGE
+# ============================================
+
+_stores = {}
+_stores_pid = None
+_stores_lock = threading.Lock()
+
+
+def metrics_dir():
+    return str(getattr(settings, 'METRICS_DIR', ''))
+
+
+def _store(kind):
+    """Return this process's store for ``kind`` ('values' or 'gauges')."""
+    global _stores_pid
+    pid = os.getpid()
+    if _stores_pid != pid:
+        # First use, or we are a freshly forked worker: never share the
+        # parent's mapping.
+        with _stores_lock:
+            if _stores_pid != pid:
+                _stores.clear()
+                _stores_pid = pid
+                atexit.register(_fold_at_exit, pid)
+    store = _stores.get(kind)
+    if store is None:
+        with _stores_lock:
+            store = _stores.get(kind)
+            if store is None:
+                directory = metrics_dir()
+                os.makedirs(directory, exist_ok=True)
+                store = MmapValues(os.path.join(directory, f'{kind}_{pid}.db'))
+                _stores[kind] = store
+    return store
+
+
+def enabled():
+    return getattr(settings, 'METRICS_ENABLED', True) and bool(metrics_dir())
+
+
+@contextlib.contextmanager
+def _directory_lock(exclusive):
+    directory = metrics_dir()
+    os.makedirs(directory, exist_ok=True)
+    with open(os.path.join(directory, '.lock'), 'a+b') as f:
+        fcntl.flock(f, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+        yield
+
+
+def _fold_at_exit(pid):
+    # Forked children inherit the parent's hook; only the owner folds.
+    if os.getpid() == pid:
+        mark_process_dead(pid)
+
+
+def mark_process_dead(pid):
+    """Fold an exited worker's counters into the aggregate file and remove its files."""
+    directory = metrics_dir()
+    if not directory:
+        return
+    values = os.path.join(directory, f'values_{pid}.db')
+    with _directory_lock(exclusive=True):
+        if os.path.exists(values):
+            aggregate = MmapValues(os.path.join(directory, 'values_aggregate.db'))
+            try:
+                for key, value in read_entries(values):
+                    aggregate.inc(key, value)
+            finally:
+                aggregate.close()
+            os.remove(values)
+        # Gauges only describe live processes.
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(os.path.join(directory, f'gauges_{pid}.db'))
+
+
+# ============================================
+# METRIC TYPES
+# ============================================
+
+REGISTRY = []
+
+
+class Metric:
+    """Base class for a named metric with a fixed set of label names."""
+    kind = None
+    store_kind = 'values'
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._keys = {}
+        REGISTRY.append(self)
+
+    def _key(self, suffix, labels, extra=()):
+        cache_key = (suffix, tuple(labels.get(n, '') for n in self.labelnames), extra)
+        key = self._keys.get(cache_key)
+        if key is None:
+            pairs = [[n, str(labels.get(n, ''))] for n in self.labelnames]
+            pairs.extend([list(p) for p in extra])
+            key = json.dumps([self.name, self.name + suffix, pairs])
+            self._keys[cache_key] = key
+        return key
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        if enabled():
+            _store(self.store_kind).inc(self._key('_total', labels), amount)
+
+
+class Gauge(Metric):
+    """Gauge summed over live processes."""
+    kind = 'gauge'
+    store_kind = 'gauges'
+
+    def set(self, value, **labels):
+        if enabled():
+            _store(self.store_kind).set(self._key('', labels), value)
+
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+        self._bucket_labels = [(('le', _format_bound(b)),) for b in self.buckets]
+
+    def observe(self, value, **labels):
+        if not enabled():
+            return
+        store = _store(self.store_kind)
+        for index, bound in enumerate(self.buckets):
+            if value <= bound:
+                break
+        # Only the bucket the value falls in is incremented; the
+        # cumulative counts are produced at exposition time.
+        store.inc(self._key('_bucket', labels, self._bucket_labels[index]), 1)
+        store.inc(self._key('_sum', labels), value)
+
+
+def _format_bound(bound):
+    return '+Inf' if bound == math.inf else repr(float(bound))
+
+
+# ============================================
+# EXPOSITION
+# ============================================
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def collect():
+    """Merge every process file into ``{(sample, labels): value}``."""
+    samples = {}
+    if not metrics_dir():
+        return samples
+    with _directory_lock(exclusive=False):
+        for path in glob.glob(os.path.join(metrics_dir(), '*.db')):
+            kind, _, pid = os.path.basename(path)[:-3].rpartition('_')
+            if kind == 'gauges' and pid.isdigit() and not _pid_alive(int(pid)):
+                continue
+            for key, value in read_entries(path):
+                _, sample, labels = json.loads(key)
+                sample_key = (sample, tuple(tuple(p) for p in labels))
+                samples[sample_key] = samples.get(sample_key, 0.0) + value
+    return samples
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    escaped = (
+        '{}="{}"'.format(k, str(v).replace('\\', r'\\').replace('\n', r'\n').replace('"', r'\"'))
+        for k, v in labels
+    )
+    return '{' + ','.join(escaped) + '}'
+
+
+def _format_value(value):
+    if value == int(value):
+        return str(int(value))
+    return repr(value)
+
+
+def generate_latest():
+    """Render all registered metrics in Prometheus text format 0.0.4."""
+    samples = collect()
+    lines = []
+    for metric in REGISTRY:
+        lines.append(f'# HELP {metric.name} {metric.documentation}')
+        lines.append(f'# TYPE {metric.name} {metric.kind}')
+        if metric.kind != 'histogram':
+            for (sample, labels), value in sorted(samples.items()):
+                if sample in (metric.name, metric.name + '_total'):
+                    lines.append(f'{sample}{_format_labels(labels)} {_format_value(value)}')
+            continue
+
+        # Group bucket/sum samples by their non-"le" labels.
+        series = {}
+        for (sample, labels), value in samples.items():
+            if sample == metric.name + '_bucket':
+                base = labels[:-1]
+                series.setdefault(base, {'buckets': {}, 'sum': 0.0})['buckets'][labels[-1][1]] = value
+            elif sample == metric.name + '_sum':
+                series.setdefault(labels, {'buckets': {}, 'sum': 0.0})['sum'] = value
+        for base in sorted(series):
+            data = series[base]
+            cumulative = 0.0
+            for bound in metric.buckets:
+                le = _format_bound(bound)
+                cumulative += data['buckets'].get(le, 0.0)
+                labels = base + (('le', le),)
+                lines.append(f'{metric.name}_bucket{_format_labels(labels)} {_format_value(cumulative)}')
+            lines.append(f'{metric.name}_count{_format_labels(base)} {_format_value(cumulative)}')
+            lines.append(f'{metric.name}_sum{_format_labels(base)} {_format_value(data["sum"])}')
+    return '\n'.join(lines) + '\n'
+
+
+# ============================================
+# APPLICATION METRICS
+# ============================================
+
+REQUEST_LATENCY = Histogram(
+    'bakery_http_request_duration_seconds',
+    'Request latency by URL name.',
+    ['view', 'method'],
+)
+RESPONSES = Counter(
+    'bakery_http_responses',
+    'HTTP responses by URL name and status code.',
+    ['view', 'status'],
+)
+DB_QUERY_LATENCY = Histogram(
+    'bakery_db_query_duration_seconds',
+    'Database query time by statement type.',
+    ['alias', 'type'],
+    buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1.0),
+)
+DB_QUERIES_PER_REQUEST = Histogram(
+    'bakery_db_queries_per_request',
+    'Number of database queries issued per request.',
+    ['view'],
+    buckets=(0, 1, 2, 5, 10, 20, 50, 100),
+)
+CACHE_REQUESTS = Counter(
+    'bakery_cache_requests',
+    'Cache lookups by cache name and result (hit/miss).',
+    ['cache', 'result'],
+)
+CHECKOUTS = Counter(
+    'bakery_checkout',
+    'Checkout submissions by outcome.',
+    ['outcome'],
+)
+PAYMENTS = Counter(
+    'bakery_payment_events',
+    'Payment webhook events by outcome.',
+    ['outcome'],
+)
+IDEMPOTENT_REQUESTS = Counter(
+    'bakery_idempotent_requests',
+    'Submissions sent with an idempotency key, by outcome.',
+    ['outcome'],
+)
+TASK_QUEUE_DEPTH = Gauge(
+    'bakery_task_queue_depth',
+    'Pending items in background queues, summed over live workers.',
+    ['queue'],
+)
+CLEANUP_DELETED_ROWS = Counter(
+    'bakery_cleanup_deleted_rows',
+    'Rows deleted by the cleanup command, by task (cascades included).',
+    ['task'],
+)
+ORDERS_ARCHIVED = Counter(
+    'bakery_orders_archived',
+    'Orders moved to the archive tables by archive_orders.',
+)
+
+# Recorded by the hooks in gunicorn.conf.py.
+WORKER_EVENTS = Counter(
+    'bakery_gunicorn_worker_events',
+    'Gunicorn worker lifecycle events (started, recycled, timeout, exited).',
+    ['event'],
+)
+WORKER_BOOT = Histogram(
+    'bakery_gunicorn_worker_boot_seconds',
+    'Time from forking a worker to it being ready for requests.',
+    buckets=(0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0),
+)
+WORKERS = Gauge(
+    'bakery_gunicorn_workers',
+    'Workers the gunicorn master is configured to run.',
+)
+
+
+def record_cache_lookup(cache, hit):
+    """Count a cache hit or miss; the hit ratio is hits / (hits + misses)."""
+    CACHE_REQUESTS.inc(cache=cache, result='hit' if hit else 'miss')
@@ -0,0 +1,127 @@
+import contextvars
+import time
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.db import connections
+from django.db.backends.signals import connection_created
+from whitenoise.middleware import WhiteNoiseMiddleware
+
+from . import metrics
+
+
+# Queries run for the current request. A context variable rather than a
+# per-connection wrapper, because under ASGI the ORM runs on other threads
+# with their own connections; sync_to_async carries the context over.
+_request_queries = contextvars.ContextVar('request_queries', default=None)
+
+
+def _statement_type(sql):
+    verb = sql.lstrip()[:6].upper()
+    if verb in ('SELECT', 'INSERT', 'UPDATE', 'DELETE'):
+        return verb.lower()
+    return 'other'
+
+
+def record_query(execute, sql, params, many, context):
+    queries = _request_queries.get()
+    if queries is None:
+        return execute(sql, params, many, context)
+    start = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        queries.append(None)
+        metrics.DB_QUERY_LATENCY.observe(
+            time.perf_counter() - start,
+            alias=context['connection'].alias,
+            type=_statement_type(sql),
+        )
+
+
+def install_query_recorder(connection, **kwargs):
+    if record_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(record_query)
+
+
+class MetricsMiddleware:
+    """Record request latency, status codes and per-request DB query stats"""
+
+    async_capable = True
+    sync_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+        connection_created.connect(install_query_recorder)
+        for connection in connections.all(initialized_only=True):
+            install_query_recorder(connection)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        if not metrics.enabled():
+            return self.get_response(request)
+        queries, token = self._start()
+        start = time.perf_counter()
+        try:
+            response = self.get_response(request)
+        finally:
+            _request_queries.reset(token)
+        self._record(request, response, time.perf_counter() - start, len(queries))
+        return response
+
+    async def __acall__(self, request):
+        if not metrics.enabled():
+            return await self.get_response(request)
+        queries, token = self._start()
+        start = time.perf_counter()
+        try:
+            response = await self.get_response(request)
+        finally:
+            _request_queries.reset(token)
+        self._record(request, response, time.perf_counter() - start, len(queries))
+        return response
+
+    def _start(self):
+        queries = []
+        return queries, _request_queries.set(queries)
+
+    def _record(self, request, response, duration, query_count):
+        match = getattr(request, 'resolver_match', None)
+        view = (match.url_name or match.view_name) if match else 'unresolved'
+        metrics.REQUEST_LATENCY.observe(duration, view=view, method=request.method)
+        metrics.RESPONSES.inc(view=view, status=response.status_code)
+        metrics.DB_QUERIES_PER_REQUEST.observe(query_count, view=view)
+
+
+class StaticFilesMiddleware(WhiteNoiseMiddleware):
+    """WhiteNoise, runnable in the event loop under ASGI
+
+    Finding a static file is a dict lookup and opening it does not block
+    for long, so static requests need not hold a thread under ASGI.
+    """
+
+    async_capable = True
+    sync_capable = True
+
+    def __init__(self, get_response=None, *args, **kwargs):
+        super().__init__(get_response, *args, **kwargs)
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        return super().__call__(request)
+
+    async def __acall__(self, request):
+        static_file = self._find(request.path_info)
+        if static_file is not None:
+            return self.serve(static_file, request)
+        return await self.get_response(request)
+
+    def _find(self, path):
+        if self.autorefresh:
+            return self.find_file(path)
+        return self.files.get(path)
@@ -0,0 +1,22 @@
+# Generated by Django 5.2.18 on 2026-10-19 07:04
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shop', '0002_catalog_order_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='product',
+            name='trending_score',
+            field=models.FloatField(default=0, help_text='Time-decayed view count maintained by the view counter', verbose_name='Trending Score'),
+        ),
+        migrations.AddIndex(
+            model_name='product',
+            index=models.Index(fields=['-trending_score'], name='product_trending_idx'),
+        ),
+    ]
@@ -0,0 +1,49 @@
+# Generated by Django 5.2.18 on 2026-10-19 07:08
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shop', '0003_product_trending_score'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='order',
+            name='counted_in_recommendations',
+            field=models.BooleanField(default=False, help_text='Set once build_recommendations has added this paid order', verbose_name='Counted in Recommendations'),
+        ),
+        migrations.CreateModel(
+            name='ProductPairCount',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('orders', models.PositiveIntegerField(default=0, verbose_name='Orders')),
+                ('product_a', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='shop.product', verbose_name='Product A')),
+                ('product_b', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='shop.product', verbose_name='Product B')),
+            ],
+            options={
+                'verbose_name': 'Product Pair Count',
+                'verbose_name_plural': 'Product Pair Counts',
+                'unique_together': {('product_a', 'product_b')},
+            },
+        ),
+        migrations.CreateModel(
+            name='ProductRecommendation',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('rank', models.PositiveSmallIntegerField(verbose_name='Rank')),
+                ('score', models.FloatField(verbose_name='Similarity')),
+                ('product', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='recommendations', to='shop.product', verbose_name='Product')),
+                ('recommended', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='shop.product', verbose_name='Recommended Product')),
+            ],
+            options={
+                'verbose_name': 'Product Recommendation',
+                'verbose_name_plural': 'Product Recommendations',
+                'ordering': ['product', 'rank'],
+                'unique_together': {('product', 'rank')},
+            },
+        ),
+    ]
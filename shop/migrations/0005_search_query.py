@@ -0,0 +1,27 @@
+# Generated by Django 5.2.18 on 2026-10-19 07:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shop', '0004_product_recommendations'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SearchQuery',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('query', models.CharField(max_length=100, unique=True, verbose_name='Query')),
+                ('count', models.PositiveIntegerField(default=1, verbose_name='Searches')),
+                ('last_searched_at', models.DateTimeField(auto_now=True, verbose_name='Last Searched At')),
+            ],
+            options={
+                'verbose_name': 'Search Query',
+                'verbose_name_plural': 'Search Queries',
+                'ordering': ['-count'],
+            },
+        ),
+    ]
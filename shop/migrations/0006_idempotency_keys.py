@@ -0,0 +1,34 @@
+# Generated by Django 5.2.18 on 2026-10-19 07:20
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shop', '0005_search_query'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='IdempotencyKey',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('owner', models.CharField(max_length=40, verbose_name='Owner')),
+                ('key', models.CharField(max_length=64, verbose_name='Key')),
+                ('fingerprint', models.CharField(max_length=64, verbose_name='Request Fingerprint')),
+                ('status_code', models.PositiveSmallIntegerField(blank=True, null=True, verbose_name='Status Code')),
+                ('content_type', models.CharField(blank=True, max_length=100, verbose_name='Content Type')),
+                ('location', models.CharField(blank=True, max_length=500, verbose_name='Location')),
+                ('body', models.BinaryField(blank=True, default=b'', verbose_name='Body')),
+                ('cookie_cart', models.JSONField(blank=True, null=True, verbose_name='Cookie Cart')),
+                ('created_at', models.DateTimeField(auto_now_add=True, verbose_name='Created At')),
+                ('expires_at', models.DateTimeField(db_index=True, verbose_name='Expires At')),
+            ],
+            options={
+                'verbose_name': 'Idempotency Key',
+                'verbose_name_plural': 'Idempotency Keys',
+                'unique_together': {('owner', 'key')},
+            },
+        ),
+    ]
@@ -0,0 +1,86 @@
+# Generated by Django 5.2.18 on 2026-10-19 08:08
+
+import django.core.validators
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shop', '0006_idempotency_keys'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ArchivedOrder',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('order_number', models.CharField(max_length=50, unique=True, verbose_name='Order Number')),
+                ('status', models.CharField(choices=[('pending', 'Pending'), ('confirmed', 'Confirmed'), ('processing', 'Processing'), ('baking', 'Baking'), ('ready', 'Ready for Pickup/Delivery'), ('shipped', 'Shipped'), ('delivered', 'Delivered'), ('cancelled', 'Cancelled'), ('refunded', 'Refunded')], default='pending', max_length=20, verbose_name='Order Status')),
+                ('payment_status', models.CharField(choices=[('pending', 'Pending'), ('paid', 'Paid'), ('failed', 'Failed'), ('refunded', 'Refunded')], default='pending', max_length=20, verbose_name='Payment Status')),
+                ('payment_id', models.CharField(blank=True, max_length=255, null=True, verbose_name='Payment ID')),
+                ('payment_method', models.CharField(default='stripe', max_length=50, verbose_name='Payment Method')),
+                ('customer_name', models.CharField(max_length=200, verbose_name='Customer Name')),
+                ('customer_email', models.EmailField(max_length=254, verbose_name='Customer Email')),
+                ('customer_phone', models.CharField(max_length=20, verbose_name='Customer Phone')),
+                ('shipping_address', models.TextField(verbose_name='Shipping Address')),
+                ('shipping_city', models.CharField(max_length=100, verbose_name='City')),
+                ('shipping_state', models.CharField(max_length=100, verbose_name='State')),
+                ('shipping_postal_code', models.CharField(max_length=20, verbose_name='Postal Code')),
+                ('shipping_method', models.CharField(default='standard', max_length=50, verbose_name='Shipping Method')),
+                ('shipping_cost', models.DecimalField(decimal_places=2, default=0, max_digits=10, verbose_name='Shipping Cost')),
+                ('subtotal', models.DecimalField(decimal_places=2, max_digits=10, verbose_name='Subtotal')),
+                ('tax', models.DecimalField(decimal_places=2, default=0, max_digits=10, verbose_name='Tax')),
+                ('discount', models.DecimalField(decimal_places=2, default=0, max_digits=10, verbose_name='Discount')),
+                ('total', models.DecimalField(decimal_places=2, max_digits=10, verbose_name='Total')),
+                ('notes', models.TextField(blank=True, verbose_name='Order Notes')),
+                ('admin_notes', models.TextField(blank=True, verbose_name='Admin Notes')),
+                ('special_instructions', models.TextField(blank=True, verbose_name='Special Instructions')),
+                ('confirmed_at', models.DateTimeField(blank=True, null=True, verbose_name='Confirmed At')),
+                ('shipped_at', models.DateTimeField(blank=True, null=True, verbose_name='Shipped At')),
+                ('delivered_at', models.DateTimeField(blank=True, null=True, verbose_name='Delivered At')),
+                ('counted_in_recommendations', models.BooleanField(default=False, help_text='Set once build_recommendations has added this paid order', verbose_name='Counted in Recommendations')),
+                ('created_at', models.DateTimeField(verbose_name='Created At')),
+                ('updated_at', models.DateTimeField(verbose_name='Updated At')),
+                ('archived_at', models.DateTimeField(auto_now_add=True, verbose_name='Archived At')),
+                ('user', models.ForeignKey(null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='archived_orders', to=settings.AUTH_USER_MODEL, verbose_name='User')),
+            ],
+            options={
+                'verbose_name': 'Archived Order',
+                'verbose_name_plural': 'Archived Orders',
+                'ordering': ['-created_at'],
+            },
+        ),
+        migrations.CreateModel(
+            name='ArchivedOrderItem',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('product_name', models.CharField(max_length=200, verbose_name='Product Name')),
+                ('product_slug', models.CharField(max_length=200, verbose_name='Product Slug')),
+                ('quantity', models.IntegerField(validators=[django.core.validators.MinValueValidator(1)], verbose_name='Quantity')),
+                ('price', models.DecimalField(decimal_places=2, max_digits=10, verbose_name='Unit Price')),
+                ('subtotal', models.DecimalField(decimal_places=2, max_digits=10, verbose_name='Subtotal')),
+                ('special_requests', models.TextField(blank=True, verbose_name='Special Requests')),
+                ('order', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='items', to='shop.archivedorder', verbose_name='Order')),
+                ('product', models.ForeignKey(null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='archived_order_items', to='shop.product', verbose_name='Product')),
+            ],
+            options={
+                'verbose_name': 'Archived Order Item',
+                'verbose_name_plural': 'Archived Order Items',
+            },
+        ),
+        migrations.AddIndex(
+            model_name='archivedorder',
+            index=models.Index(fields=['user', '-created_at'], name='archived_order_user_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='archivedorder',
+            index=models.Index(fields=['payment_status', 'created_at'], name='archived_order_payment_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='archivedorder',
+            index=models.Index(fields=['-created_at'], name='archived_order_created_idx'),
+        ),
+    ]
@@ -0,0 +1,32 @@
+# Generated by Django 5.2.18 on 2026-10-19 08:13
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shop', '0007_order_archive'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='BakePlan',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('bake_date', models.DateField(verbose_name='Bake Date')),
+                ('forecast', models.FloatField(verbose_name='Expected Demand')),
+                ('quantity', models.PositiveIntegerField(verbose_name='Quantity to Bake')),
+                ('last_week', models.PositiveIntegerField(default=0, help_text='Units sold on the same weekday a week before', verbose_name='Sold Last Week')),
+                ('planned_at', models.DateTimeField(auto_now=True, verbose_name='Planned At')),
+                ('product', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='bake_plans', to='shop.product', verbose_name='Product')),
+            ],
+            options={
+                'verbose_name': 'Bake Plan',
+                'verbose_name_plural': 'Bake Plan',
+                'ordering': ['bake_date', '-quantity'],
+                'unique_together': {('bake_date', 'product')},
+            },
+        ),
+    ]
@@ -0,0 +1,31 @@
+# Generated by Django 5.2.18 on 2026-10-19 08:28
+
+from django.db import migrations, models
+
+
+def create_epoch(apps, schema_editor):
+    # The epoch scores were written against before it was stored.
+    TrendingEpoch = apps.get_model('shop', 'TrendingEpoch')
+    TrendingEpoch.objects.using(schema_editor.connection.alias).create(pk=1, epoch=1767225600)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shop', '0008_bake_plan'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TrendingEpoch',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('epoch', models.FloatField(help_text='Unix time; moved forward by the view counter', verbose_name='Epoch')),
+            ],
+            options={
+                'verbose_name': 'Trending Epoch',
+                'verbose_name_plural': 'Trending Epoch',
+            },
+        ),
+        migrations.RunPython(create_epoch, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-19 08:36
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shop', '0009_trending_epoch'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='bakeplan',
+            name='adjusted',
+            field=models.BooleanField(default=False, help_text='Quantity set by staff; planning again keeps it', verbose_name='Adjusted'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-19 08:48
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shop', '0010_bake_plan_adjusted'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='idempotencykey',
+            name='messages',
+            field=models.JSONField(blank=True, null=True, verbose_name='Flash Messages'),
+        ),
+    ]
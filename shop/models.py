@@ -4,6 +4,44 @@ from django.core.validators import MinValueValidator, MaxValueValidator
 from django.utils import timezone
 import os
 
+from . import invalidation
+
+
+class CacheTaggedQuerySet(models.QuerySet):
+    """QuerySet whose bulk writes invalidate the cache tags of the rows
+
+    ``save()`` and ``delete()`` invalidate through signals (see
+    ``signals.py``); ``update()``, ``bulk_update()`` and ``bulk_create()``
+    send none, so they invalidate here, and also set ``auto_now`` fields,
+    which cached fragments are keyed on. Updates that only touch the
+    model's ``cache_ignored_fields`` are left alone.
+    """
+
+    def update(self, **kwargs):
+        if set(kwargs) <= set(getattr(self.model, 'cache_ignored_fields', ())):
+            return super().update(**kwargs)
+        for field in self.model._meta.concrete_fields:
+            if getattr(field, 'auto_now', False):
+                kwargs.setdefault(field.attname, timezone.now())
+        pks = list(self.values_list('pk', flat=True))
+        if not pks:
+            return 0
+        rows = self.model._base_manager.filter(pk__in=pks)
+        # Before and after, in case the rows moved to another category.
+        tags = self.model.cache_tags_for(rows)
+        updated = super().update(**kwargs)
+        invalidation.invalidate(*tags | self.model.cache_tags_for(rows))
+        return updated
+
+    update.alters_data = True
+
+    def bulk_create(self, objs, *args, **kwargs):
+        objs = super().bulk_create(objs, *args, **kwargs)
+        invalidation.invalidate(*set().union(*(obj.cache_tags() for obj in objs)))
+        return objs
+
+    bulk_create.alters_data = True
+
 
 def get_product_image_path(instance, filename):
     """Generate path for product images"""
@@ -60,6 +98,8 @@ class Category(models.Model):
     created_at = models.DateTimeField(auto_now_add=True, verbose_name='Created At')
     updated_at = models.DateTimeField(auto_now=True, verbose_name='Updated At')
 
+    objects = CacheTaggedQuerySet.as_manager()
+
     class Meta:
         verbose_name = 'Category'
         verbose_name_plural = 'Categories'
@@ -72,6 +112,15 @@ class Category(models.Model):
         """Return count of active products in this category"""
         return self.products.filter(is_active=True).count()
 
+    def cache_tags(self):
+        """Every page shows the category navigation"""
+        return {'catalog', 'categories', f'category:{self.pk}'}
+
+    @classmethod
+    def cache_tags_for(cls, queryset):
+        tags = {'catalog', 'categories'}
+        return tags | {f'category:{pk}' for pk in queryset.values_list('pk', flat=True)}
+
 
 class Product(models.Model):
     """Product model"""
@@ -131,13 +180,31 @@ class Product(models.Model):
         help_text='Check if this item needs to be ordered in advance'
     )
     views = models.IntegerField(default=0, verbose_name='View Count')
+    trending_score = models.FloatField(
+        default=0,
+        verbose_name='Trending Score',
+        help_text='Time-decayed view count maintained by the view counter'
+    )
     created_at = models.DateTimeField(auto_now_add=True, verbose_name='Created At')
     updated_at = models.DateTimeField(auto_now=True, verbose_name='Updated At')
 
+    objects = CacheTaggedQuerySet.as_manager()
+    # Maintained by the view counter; pages do not show them.
+    cache_ignored_fields = ('views', 'trending_score')
+
     class Meta:
         verbose_name = 'Product'
         verbose_name_plural = 'Products'
         ordering = ['-is_featured', '-created_at']
+        # Indexes follow the sort order of the catalog queries so a LIMITed
+        # listing reads rows in index order and stops early.
+        indexes = [
+            models.Index(fields=['-is_featured', '-created_at'], name='product_featured_idx'),
+            models.Index(fields=['-created_at'], name='product_newest_idx'),
+            models.Index(fields=['category', '-is_featured', '-created_at'], name='product_category_idx'),
+            models.Index(fields=['name'], name='product_name_idx'),
+            models.Index(fields=['-trending_score'], name='product_trending_idx'),
+        ]
 
     def __str__(self):
         return self.name
@@ -171,6 +238,29 @@ class Product(models.Model):
         """Check if product is in stock"""
         return self.stock > 0
 
+    def cache_tags(self):
+        """Product listings, its own page and its category's pages"""
+        return {'catalog', f'product:{self.pk}', f'category:{self.category_id}'}
+
+    @classmethod
+    def cache_tags_for(cls, queryset):
+        tags = {'catalog'}
+        for pk, category_id in queryset.values_list('pk', 'category_id'):
+            tags |= {f'product:{pk}', f'category:{category_id}'}
+        return tags
+
+
+class TrendingEpoch(models.Model):
+    """Time that Product.trending_score weights are relative to (one row)"""
+    epoch = models.FloatField(verbose_name='Epoch', help_text='Unix time; moved forward by the view counter')
+
+    class Meta:
+        verbose_name = 'Trending Epoch'
+        verbose_name_plural = 'Trending Epoch'
+
+    def __str__(self):
+        return f"Trending epoch {self.epoch}"
+
 
 class Cart(models.Model):
     """Shopping cart model"""
@@ -243,8 +333,8 @@ class CartItem(models.Model):
         return self.product.get_current_price() * self.quantity
 
 
-class Order(models.Model):
-    """Order status choices"""
+class BaseOrder(models.Model):
+    """Fields shared by live and archived orders"""
     STATUS_CHOICES = [
         ('pending', 'Pending'),
         ('confirmed', 'Confirmed'),
@@ -266,13 +356,6 @@ class Order(models.Model):
 
     # Order fields
     order_number = models.CharField(max_length=50, unique=True, verbose_name='Order Number')
-    user = models.ForeignKey(
-        User,
-        on_delete=models.SET_NULL,
-        null=True,
-        related_name='orders',
-        verbose_name='User'
-    )
     status = models.CharField(
         max_length=20,
         choices=STATUS_CHOICES,
@@ -323,15 +406,44 @@ class Order(models.Model):
     confirmed_at = models.DateTimeField(blank=True, null=True, verbose_name='Confirmed At')
     shipped_at = models.DateTimeField(blank=True, null=True, verbose_name='Shipped At')
     delivered_at = models.DateTimeField(blank=True, null=True, verbose_name='Delivered At')
+    counted_in_recommendations = models.BooleanField(
+        default=False,
+        verbose_name='Counted in Recommendations',
+        help_text='Set once build_recommendations has added this paid order'
+    )
 
     class Meta:
-        verbose_name = 'Order'
-        verbose_name_plural = 'Orders'
-        ordering = ['-created_at']
+        abstract = True
 
     def __str__(self):
         return f"Order {self.order_number}"
 
+    def get_item_count(self):
+        """Return total number of items"""
+        return sum(item.quantity for item in self.items.all())
+
+
+class Order(BaseOrder):
+    """Order model"""
+    user = models.ForeignKey(
+        User,
+        on_delete=models.SET_NULL,
+        null=True,
+        related_name='orders',
+        verbose_name='User'
+    )
+
+    class Meta:
+        verbose_name = 'Order'
+        verbose_name_plural = 'Orders'
+        ordering = ['-created_at']
+        indexes = [
+            models.Index(fields=['user', '-created_at'], name='order_user_created_idx'),
+            models.Index(fields=['status'], name='order_status_idx'),
+            models.Index(fields=['payment_status', 'created_at'], name='order_payment_created_idx'),
+            models.Index(fields=['-created_at'], name='order_created_idx'),
+        ]
+
     def save(self, *args, **kwargs):
         """Generate order number if not exists"""
         if not self.order_number:
@@ -341,26 +453,34 @@ class Order(models.Model):
             self.order_number = f"GLB-{timestamp}-{random.randint(1000, 9999)}"
         super().save(*args, **kwargs)
 
-    def get_item_count(self):
-        """Return total number of items"""
-        return sum(item.quantity for item in self.items.all())
-
 
-class OrderItem(models.Model):
-    """Order item model"""
-    order = models.ForeignKey(
-        Order,
-        on_delete=models.CASCADE,
-        related_name='items',
-        verbose_name='Order'
-    )
-    product = models.ForeignKey(
-        Product,
+class ArchivedOrder(BaseOrder):
+    """A finished order moved out of the live tables by shop.archive"""
+    user = models.ForeignKey(
+        User,
         on_delete=models.SET_NULL,
         null=True,
-        related_name='order_items',
-        verbose_name='Product'
+        related_name='archived_orders',
+        verbose_name='User'
     )
+    # Copied from the live order, not set on insert.
+    created_at = models.DateTimeField(verbose_name='Created At')
+    updated_at = models.DateTimeField(verbose_name='Updated At')
+    archived_at = models.DateTimeField(auto_now_add=True, verbose_name='Archived At')
+
+    class Meta:
+        verbose_name = 'Archived Order'
+        verbose_name_plural = 'Archived Orders'
+        ordering = ['-created_at']
+        indexes = [
+            models.Index(fields=['user', '-created_at'], name='archived_order_user_idx'),
+            models.Index(fields=['payment_status', 'created_at'], name='archived_order_payment_idx'),
+            models.Index(fields=['-created_at'], name='archived_order_created_idx'),
+        ]
+
+
+class BaseOrderItem(models.Model):
+    """Fields shared by live and archived order items"""
     product_name = models.CharField(max_length=200, verbose_name='Product Name')
     product_slug = models.CharField(max_length=200, verbose_name='Product Slug')
     quantity = models.IntegerField(
@@ -372,8 +492,7 @@ class OrderItem(models.Model):
     special_requests = models.TextField(blank=True, verbose_name='Special Requests')
 
     class Meta:
-        verbose_name = 'Order Item'
-        verbose_name_plural = 'Order Items'
+        abstract = True
 
     def __str__(self):
         return f"{self.quantity} x {self.product_name}"
@@ -384,6 +503,124 @@ class OrderItem(models.Model):
         super().save(*args, **kwargs)
 
 
+class OrderItem(BaseOrderItem):
+    """Order item model"""
+    order = models.ForeignKey(
+        Order,
+        on_delete=models.CASCADE,
+        related_name='items',
+        verbose_name='Order'
+    )
+    product = models.ForeignKey(
+        Product,
+        on_delete=models.SET_NULL,
+        null=True,
+        related_name='order_items',
+        verbose_name='Product'
+    )
+
+    class Meta:
+        verbose_name = 'Order Item'
+        verbose_name_plural = 'Order Items'
+
+
+class ArchivedOrderItem(BaseOrderItem):
+    """An item of an archived order"""
+    order = models.ForeignKey(
+        ArchivedOrder,
+        on_delete=models.CASCADE,
+        related_name='items',
+        verbose_name='Order'
+    )
+    product = models.ForeignKey(
+        Product,
+        on_delete=models.SET_NULL,
+        null=True,
+        related_name='archived_order_items',
+        verbose_name='Product'
+    )
+
+    class Meta:
+        verbose_name = 'Archived Order Item'
+        verbose_name_plural = 'Archived Order Items'
+
+
+class ProductPairCount(models.Model):
+    """Number of paid orders containing both products, with product_a <= product_b"""
+    product_a = models.ForeignKey(Product, on_delete=models.CASCADE, related_name='+', verbose_name='Product A')
+    product_b = models.ForeignKey(Product, on_delete=models.CASCADE, related_name='+', verbose_name='Product B')
+    orders = models.PositiveIntegerField(default=0, verbose_name='Orders')
+
+    class Meta:
+        verbose_name = 'Product Pair Count'
+        verbose_name_plural = 'Product Pair Counts'
+        unique_together = ['product_a', 'product_b']
+
+    def __str__(self):
+        return f"{self.product_a_id} + {self.product_b_id}: {self.orders}"
+
+
+class ProductRecommendation(models.Model):
+    """Product frequently bought together with another, precomputed offline"""
+    product = models.ForeignKey(
+        Product,
+        on_delete=models.CASCADE,
+        related_name='recommendations',
+        verbose_name='Product'
+    )
+    recommended = models.ForeignKey(
+        Product,
+        on_delete=models.CASCADE,
+        related_name='+',
+        verbose_name='Recommended Product'
+    )
+    rank = models.PositiveSmallIntegerField(verbose_name='Rank')
+    score = models.FloatField(verbose_name='Similarity')
+
+    class Meta:
+        verbose_name = 'Product Recommendation'
+        verbose_name_plural = 'Product Recommendations'
+        ordering = ['product', 'rank']
+        # Also the index the product page reads its recommendations with.
+        unique_together = ['product', 'rank']
+
+    def __str__(self):
+        return f"{self.product_id} -> {self.recommended_id} ({self.score:.2f})"
+
+
+class BakePlan(models.Model):
+    """Units of a product to bake for a day, planned by forecast_demand"""
+    bake_date = models.DateField(verbose_name='Bake Date')
+    product = models.ForeignKey(
+        Product,
+        on_delete=models.CASCADE,
+        related_name='bake_plans',
+        verbose_name='Product'
+    )
+    forecast = models.FloatField(verbose_name='Expected Demand')
+    quantity = models.PositiveIntegerField(verbose_name='Quantity to Bake')
+    last_week = models.PositiveIntegerField(
+        default=0,
+        verbose_name='Sold Last Week',
+        help_text='Units sold on the same weekday a week before'
+    )
+    adjusted = models.BooleanField(
+        default=False,
+        verbose_name='Adjusted',
+        help_text='Quantity set by staff; planning again keeps it'
+    )
+    planned_at = models.DateTimeField(auto_now=True, verbose_name='Planned At')
+
+    class Meta:
+        verbose_name = 'Bake Plan'
+        verbose_name_plural = 'Bake Plan'
+        ordering = ['bake_date', '-quantity']
+        unique_together = ['bake_date', 'product']
+
+    def __str__(self):
+        return f"{self.bake_date}: {self.quantity} x {self.product_id}"
+
+
 class Review(models.Model):
     """Product review model"""
     product = models.ForeignKey(
@@ -408,15 +645,71 @@ class Review(models.Model):
     created_at = models.DateTimeField(auto_now_add=True, verbose_name='Created At')
     updated_at = models.DateTimeField(auto_now=True, verbose_name='Updated At')
 
+    objects = CacheTaggedQuerySet.as_manager()
+
     class Meta:
         verbose_name = 'Review'
         verbose_name_plural = 'Reviews'
         unique_together = ['product', 'user']
         ordering = ['-created_at']
+        indexes = [
+            # Covers the rating aggregates without touching the table.
+            models.Index(fields=['product', 'is_active', 'rating'], name='review_product_active_idx'),
+        ]
 
     def __str__(self):
         return f"{self.user.email} - {self.product.name} ({self.rating}/5)"
 
+    def cache_tags(self):
+        """Ratings appear on the product page and in every product listing"""
+        return {'catalog', f'product:{self.product_id}', f'category:{self.product.category_id}'}
+
+    @classmethod
+    def cache_tags_for(cls, queryset):
+        tags = {'catalog'}
+        for product_id, category_id in queryset.values_list('product_id', 'product__category_id'):
+            tags |= {f'product:{product_id}', f'category:{category_id}'}
+        return tags
+
+
+class SearchQuery(models.Model):
+    """Normalized search from the shop page, counted for autocomplete"""
+    query = models.CharField(max_length=100, unique=True, verbose_name='Query')
+    count = models.PositiveIntegerField(default=1, verbose_name='Searches')
+    last_searched_at = models.DateTimeField(auto_now=True, verbose_name='Last Searched At')
+
+    class Meta:
+        verbose_name = 'Search Query'
+        verbose_name_plural = 'Search Queries'
+        ordering = ['-count']
+
+    def __str__(self):
+        return f"{self.query} ({self.count})"
+
+
+class IdempotencyKey(models.Model):
+    """Response to a submission sent with an idempotency key, replayed on retries"""
+    owner = models.CharField(max_length=40, verbose_name='Owner')
+    key = models.CharField(max_length=64, verbose_name='Key')
+    fingerprint = models.CharField(max_length=64, verbose_name='Request Fingerprint')
+    # Empty until the first request has finished.
+    status_code = models.PositiveSmallIntegerField(null=True, blank=True, verbose_name='Status Code')
+    content_type = models.CharField(max_length=100, blank=True, verbose_name='Content Type')
+    location = models.CharField(max_length=500, blank=True, verbose_name='Location')
+    body = models.BinaryField(blank=True, default=b'', verbose_name='Body')
+    cookie_cart = models.JSONField(null=True, blank=True, verbose_name='Cookie Cart')
+    messages = models.JSONField(null=True, blank=True, verbose_name='Flash Messages')
+    created_at = models.DateTimeField(auto_now_add=True, verbose_name='Created At')
+    expires_at = models.DateTimeField(db_index=True, verbose_name='Expires At')
+
+    class Meta:
+        verbose_name = 'Idempotency Key'
+        verbose_name_plural = 'Idempotency Keys'
+        unique_together = ['owner', 'key']
+
+    def __str__(self):
+        return f"{self.owner} {self.key} ({self.status_code or 'pending'})"
+
 
 class Newsletter(models.Model):
     """Newsletter subscription model"""
@@ -0,0 +1,334 @@
+"""Full-page cache for anonymous catalog traffic.
+
+Pages are stored per path and normalized query string, together with the
+version of every tag they depend on (``catalog``, ``product:<id>``,
+``category:<id>``, ``categories``). Saving a product, category or review,
+one at a time or in bulk, bumps the matching tag versions on the
+invalidation bus (see ``shop.invalidation``), which marks the pages stale
+in every worker without having to know their keys.
+
+Stale pages are served immediately while a background thread renders a
+fresh copy (stale-while-revalidate), so only the very first request for a
+page pays for the ORM and template work.
+
+``conditional_page`` answers ``If-None-Match``/``If-Modified-Since`` from
+the same tag versions, after one indexed lookup and before any rendering.
+"""
+import copy
+import hashlib
+import math
+import re
+import threading
+import time
+from functools import wraps
+from urllib.parse import urlencode
+
+from asgiref.sync import async_to_sync, iscoroutinefunction, sync_to_async
+from django.conf import settings
+from django.core.cache import caches
+from django.db import connections
+from django.http import Http404, HttpResponse
+from django.middleware.csrf import get_token
+from django.utils.cache import get_conditional_response, patch_cache_control
+from django.utils.http import http_date
+
+from . import invalidation, metrics
+
+
+CACHED_QUERY_PARAMS = ('category', 'sort', 'q', 'page')
+CSRF_PLACEHOLDER = b'__page_cache_csrf_token__'
+_CSRF_INPUT = re.compile(rb'name="csrfmiddlewaretoken" value="([^"]+)"')
+
+
+def _cache():
+    return caches[getattr(settings, 'PAGE_CACHE_ALIAS', 'default')]
+
+
+# ============================================
+# TAGS
+# ============================================
+
+def tag_versions(tags):
+    """Return the current version of each tag."""
+    return invalidation.versions(tags)
+
+
+def invalidate_tags(*tags):
+    """Mark every cached page depending on any of ``tags`` as stale."""
+    invalidation.invalidate(*tags)
+
+
+def add_cache_tags(request, *tags):
+    """Declare extra tags the page being rendered depends on."""
+    request.page_cache_tags = getattr(request, 'page_cache_tags', set()) | set(tags)
+
+
+def set_page_meta(request, **meta):
+    """Keep ``meta`` with the cached page, for ``on_hit`` to read with ``page_meta``."""
+    request.page_cache_meta = {**page_meta(request), **meta}
+
+
+def page_meta(request):
+    return getattr(request, 'page_cache_meta', {})
+
+
+def is_background_refresh(request):
+    """True while a stale page is re-rendered; the visit was counted when it was served."""
+    return getattr(request, 'page_cache_refresh', False)
+
+
+# ============================================
+# KEYS & ENTRIES
+# ============================================
+
+def page_cache_key(request):
+    params = []
+    for name in CACHED_QUERY_PARAMS:
+        value = request.GET.get(name, '').strip()
+        if name == 'q':
+            value = ' '.join(value.lower().split())
+        if value:
+            params.append((name, value))
+    return f'page:{request.path}?{urlencode(params)}'
+
+
+def _has_pending_messages(request):
+    # Messages are kept in a cookie (CookieStorage), so the session need
+    # not be loaded to find out.
+    return 'messages' in request.COOKIES
+
+
+def _is_cacheable_request(request):
+    return (
+        getattr(settings, 'PAGE_CACHE_ENABLED', True)
+        and request.method in ('GET', 'HEAD')
+        and not request.user.is_authenticated
+        and not _has_pending_messages(request)
+        # The header shows the anonymous cart's item count.
+        and getattr(settings, 'CART_COOKIE_NAME', 'cart') not in request.COOKIES
+    )
+
+
+def _make_entry(request, response):
+    content = response.content
+    match = _CSRF_INPUT.search(content)
+    if match:
+        # Each visitor needs a token for their own CSRF cookie.
+        content = content.replace(match.group(1), CSRF_PLACEHOLDER)
+    tags = getattr(request, 'page_cache_tags', set()) | {'categories'}
+    return {
+        'content': content,
+        'content_type': response['Content-Type'],
+        'etag': '"%s"' % hashlib.md5(content).hexdigest(),
+        'tags': tag_versions(tags),
+        'meta': page_meta(request),
+        'created': time.time(),
+    }
+
+
+def _is_fresh(entry):
+    if time.time() - entry['created'] > getattr(settings, 'PAGE_CACHE_TTL', 300):
+        return False
+    return tag_versions(entry['tags']) == entry['tags']
+
+
+def _store(key, request, response):
+    if response.status_code != 200 or response.streaming or response.cookies:
+        return None
+    entry = _make_entry(request, response)
+    timeout = getattr(settings, 'PAGE_CACHE_TTL', 300) + getattr(settings, 'PAGE_CACHE_STALE_TTL', 3600)
+    _cache().set(key, entry, timeout)
+    return entry
+
+
+def _finalize(request, response, etag, status):
+    response['ETag'] = etag
+    response['X-Page-Cache'] = status
+    patch_cache_control(response, private=True, max_age=0, must_revalidate=True)
+    return get_conditional_response(request, etag=etag, response=response)
+
+
+def _response_from_entry(request, entry, status):
+    content = entry['content']
+    if CSRF_PLACEHOLDER in content:
+        content = content.replace(CSRF_PLACEHOLDER, get_token(request).encode())
+    response = HttpResponse(content, content_type=entry['content_type'])
+    return _finalize(request, response, entry['etag'], status)
+
+
+# ============================================
+# BACKGROUND REFRESH
+# ============================================
+
+def _refresh_in_background(key, view, request, args, kwargs):
+    """Re-render a stale page in a thread unless another worker already is."""
+    lock_key = f'pagelock:{key}'
+    if not _cache().add(lock_key, 1, timeout=30):
+        return
+    clone = copy.copy(request)
+    clone.META = dict(request.META)
+    clone.page_cache_tags = set()
+    clone.page_cache_refresh = True
+    if iscoroutinefunction(view):
+        view = async_to_sync(view)
+
+    def refresh():
+        try:
+            response = view(clone, *args, **kwargs)
+            # A page that is gone or failing must not be served stale.
+            if response.status_code != 200:
+                _cache().delete(key)
+            else:
+                _store(key, clone, response)
+        except Http404:
+            _cache().delete(key)
+        except Exception:
+            _cache().delete(key)
+            raise
+        finally:
+            _cache().delete(lock_key)
+            connections.close_all()
+
+    threading.Thread(target=refresh, daemon=True).start()
+
+
+# ============================================
+# DECORATOR
+# ============================================
+
+def _cached_response(request, view, args, kwargs, on_hit):
+    """The page from the cache, or None when the view has to render it."""
+    if not _is_cacheable_request(request):
+        return None
+    key = page_cache_key(request)
+    entry = _cache().get(key)
+    if entry is not None:
+        if _is_fresh(entry):
+            status = 'hit'
+        elif getattr(settings, 'PAGE_CACHE_STALE_WHILE_REVALIDATE', True):
+            _refresh_in_background(key, view, request, args, kwargs)
+            status = 'stale'
+        else:
+            status = None
+        if status:
+            metrics.record_cache_lookup('page', True)
+            if on_hit is not None:
+                request.page_cache_meta = entry.get('meta', {})
+                on_hit(request, *args, **kwargs)
+            return _response_from_entry(request, entry, status)
+    metrics.record_cache_lookup('page', False)
+    request.page_cache_key = key
+    return None
+
+
+def _store_rendered(request, response):
+    key = getattr(request, 'page_cache_key', None)
+    if key is None:
+        return response
+    entry = _store(key, request, response)
+    if entry is None:
+        return response
+    return _finalize(request, response, entry['etag'], 'miss')
+
+
+def cache_anonymous_page(on_hit=None):
+    """Serve the view from the page cache for anonymous GET requests.
+
+    ``on_hit`` is called with the view arguments when a cached copy is
+    served, for side effects the view would otherwise perform; what the
+    view stored with ``set_page_meta`` is available as ``page_meta``.
+    Works for sync and async views.
+    """
+    def decorator(view):
+        if iscoroutinefunction(view):
+            @wraps(view)
+            async def async_wrapper(request, *args, **kwargs):
+                response = await sync_to_async(_cached_response)(request, view, args, kwargs, on_hit)
+                if response is not None:
+                    return response
+                response = await view(request, *args, **kwargs)
+                return await sync_to_async(_store_rendered)(request, response)
+            return async_wrapper
+
+        @wraps(view)
+        def wrapper(request, *args, **kwargs):
+            response = _cached_response(request, view, args, kwargs, on_hit)
+            if response is not None:
+                return response
+            return _store_rendered(request, view(request, *args, **kwargs))
+        return wrapper
+    return decorator
+
+
+# ============================================
+# CONDITIONAL GET
+# ============================================
+
+def page_validators(tags):
+    """Return the ETag and Last-Modified timestamp for a page's tags."""
+    versions = tag_versions(set(tags) | {'categories'})
+    state = [getattr(settings, 'PAGE_CONTENT_VERSION', '')] + sorted(versions.items())
+    etag = '"v-%s"' % hashlib.md5(repr(state).encode()).hexdigest()
+    # Versions are nanosecond timestamps of the last change.
+    return etag, math.ceil(max(versions.values()) / 1e9)
+
+
+def _set_validators(response, etag, last_modified):
+    response['ETag'] = etag
+    response['Last-Modified'] = http_date(last_modified)
+    patch_cache_control(response, private=True, max_age=0, must_revalidate=True)
+
+
+def _not_modified(request, page_tags, on_not_modified, args, kwargs):
+    """A 304 when the client's copy is current, else the page validators."""
+    if not _is_cacheable_request(request):
+        return None, None
+    tags = page_tags(request, *args, **kwargs)
+    if tags is None:
+        return None, None
+
+    etag, last_modified = page_validators(tags)
+    response = get_conditional_response(request, etag=etag, last_modified=last_modified)
+    if response is not None:
+        if on_not_modified is not None:
+            on_not_modified(request, *args, **kwargs)
+        _set_validators(response, etag, last_modified)
+    return response, (etag, last_modified)
+
+
+def _add_validators(response, validators):
+    # A stale page-cache copy keeps its own content hash so the
+    # browser does not pin the old markup to the new version.
+    if validators and response.status_code == 200 and response.get('X-Page-Cache') != 'stale':
+        _set_validators(response, *validators)
+    return response
+
+
+def conditional_page(page_tags, on_not_modified=None):
+    """Answer conditional GETs for anonymous visitors without rendering.
+
+    ``page_tags`` is called with the view arguments and returns the tags
+    the page depends on, or None when the page does not exist, in which
+    case the view renders its 404. ``on_not_modified`` is called for side
+    effects when a 304 is sent. Works for sync and async views.
+    """
+    def decorator(view):
+        if iscoroutinefunction(view):
+            @wraps(view)
+            async def async_wrapper(request, *args, **kwargs):
+                response, validators = await sync_to_async(_not_modified)(
+                    request, page_tags, on_not_modified, args, kwargs
+                )
+                if response is not None:
+                    return response
+                return _add_validators(await view(request, *args, **kwargs), validators)
+            return async_wrapper
+
+        @wraps(view)
+        def wrapper(request, *args, **kwargs):
+            response, validators = _not_modified(request, page_tags, on_not_modified, args, kwargs)
+            if response is not None:
+                return response
+            return _add_validators(view(request, *args, **kwargs), validators)
+        return wrapper
+    return decorator
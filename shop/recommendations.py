@@ -0,0 +1,182 @@
+"""Offline "frequently bought together" recommendations.
+
+``update_pair_counts`` adds paid orders that have not been counted yet to
+``ProductPairCount``, the upper triangle of the product co-occurrence
+matrix (the diagonal holds the number of orders per product).
+``rebuild_recommendations`` turns the counts into cosine similarities
+
+    sim(i, j) = orders(i, j) / sqrt(orders(i) * orders(j))
+
+and stores the top K neighbours of each product in
+``ProductRecommendation``, rewriting only the products whose list changed.
+
+Requires NumPy and SciPy; only the ``build_recommendations`` management
+command imports this module, never the web workers.
+"""
+import numpy as np
+from scipy import sparse
+
+from django.db import transaction
+
+from .models import ArchivedOrder, ArchivedOrderItem, Order, OrderItem, Product, ProductPairCount, ProductRecommendation
+from .page_cache import invalidate_tags
+
+
+ORDER_BATCH_SIZE = 1000
+
+
+def cooccurrence(order_ids, product_ids):
+    """Co-occurrence counts of ``(order, product)`` pairs as a COO matrix.
+
+    Returns the matrix over the distinct products and those product ids.
+    """
+    orders, rows = np.unique(np.asarray(order_ids), return_inverse=True)
+    products, cols = np.unique(np.asarray(product_ids), return_inverse=True)
+    baskets = sparse.csr_matrix(
+        (np.ones(len(rows), dtype=np.int32), (rows, cols)),
+        shape=(len(orders), len(products)),
+    )
+    # A product listed twice in one order still counts once.
+    baskets.sum_duplicates()
+    baskets.data[:] = 1
+    return (baskets.T @ baskets).tocoo(), products
+
+
+def _add_pair_counts(counts, products):
+    upper = counts.row <= counts.col
+    increments = {
+        (int(products[i]), int(products[j])): int(n)
+        for i, j, n in zip(counts.row[upper], counts.col[upper], counts.data[upper])
+    }
+    existing = ProductPairCount.objects.filter(
+        product_a__in=[int(pk) for pk in products]
+    ).values_list('product_a_id', 'product_b_id', 'orders')
+    for a, b, n in existing:
+        if (a, b) in increments:
+            increments[a, b] += n
+    ProductPairCount.objects.bulk_create(
+        [ProductPairCount(product_a_id=a, product_b_id=b, orders=n) for (a, b), n in increments.items()],
+        update_conflicts=True,
+        unique_fields=['product_a', 'product_b'],
+        update_fields=['orders'],
+        batch_size=500,
+    )
+
+
+def _count_orders(order_model, item_model):
+    added = 0
+    while True:
+        with transaction.atomic():
+            order_ids = list(
+                order_model.objects.filter(payment_status='paid', counted_in_recommendations=False)
+                .order_by('pk').values_list('pk', flat=True)[:ORDER_BATCH_SIZE]
+            )
+            if not order_ids:
+                return added
+            items = list(
+                item_model.objects.filter(order_id__in=order_ids, product__isnull=False)
+                .values_list('order_id', 'product_id')
+            )
+            if items:
+                counts, products = cooccurrence(*zip(*items))
+                _add_pair_counts(counts, products)
+            order_model.objects.filter(pk__in=order_ids).update(counted_in_recommendations=True)
+            added += len(order_ids)
+
+
+def update_pair_counts(full=False):
+    """Add paid orders not counted yet; returns how many were added.
+
+    With ``full`` the counts are rebuilt from every paid order, archived
+    ones included. Paid orders are only archived once counted.
+    """
+    if not full:
+        return _count_orders(Order, OrderItem)
+    with transaction.atomic():
+        ProductPairCount.objects.all().delete()
+        for model in (Order, ArchivedOrder):
+            model.objects.filter(counted_in_recommendations=True).update(counted_in_recommendations=False)
+    return _count_orders(ArchivedOrder, ArchivedOrderItem) + _count_orders(Order, OrderItem)
+
+
+def similarity_matrix():
+    """Cosine similarity between products from the stored pair counts.
+
+    Returns a CSR matrix without the diagonal and the product id of each
+    row and column.
+    """
+    pairs = np.array(
+        list(ProductPairCount.objects.values_list('product_a_id', 'product_b_id', 'orders')),
+        dtype=np.int64,
+    ).reshape(-1, 3)
+    a, b, n = pairs.T
+    products, index = np.unique(np.concatenate([a, b]), return_inverse=True)
+    rows, cols = index[:len(a)], index[len(a):]
+    size = len(products)
+    upper = sparse.coo_matrix((n.astype(np.float64), (rows, cols)), shape=(size, size)).tocsr()
+    diagonal = upper.diagonal()
+    upper = upper - sparse.diags(diagonal)
+    counts = upper + upper.T
+    counts.eliminate_zeros()
+
+    # Products only ever counted alongside themselves have no neighbours.
+    norms = np.sqrt(diagonal)
+    norms[norms == 0] = 1
+    scale = sparse.diags(1 / norms)
+    return (scale @ counts @ scale).tocsr(), products
+
+
+def top_neighbours(similarity, products, k, allowed=None):
+    """Return ``{product_id: [(neighbour_id, score), ...]}`` with at most ``k``
+    neighbours per product, best first.
+
+    With ``allowed``, only those product ids get or appear as neighbours.
+    """
+    neighbours = {}
+    allowed_ids = None if allowed is None else np.fromiter(allowed, dtype=np.int64)
+    for row in range(similarity.shape[0]):
+        if allowed is not None and products[row] not in allowed:
+            continue
+        start, end = similarity.indptr[row], similarity.indptr[row + 1]
+        cols = products[similarity.indices[start:end]]
+        scores = similarity.data[start:end]
+        if allowed is not None:
+            keep = np.isin(cols, allowed_ids)
+            cols, scores = cols[keep], scores[keep]
+        if not len(cols):
+            continue
+        if len(cols) > k:
+            best = np.argpartition(-scores, k - 1)[:k]
+            cols, scores = cols[best], scores[best]
+        # Highest score first; ties go to the lower product id.
+        order = np.lexsort((cols, -scores))
+        neighbours[int(products[row])] = [(int(cols[i]), float(scores[i])) for i in order]
+    return neighbours
+
+
+def rebuild_recommendations(k=4):
+    """Store the top ``k`` neighbours of every product; returns the ids of
+    the products whose recommendations changed."""
+    similarity, products = similarity_matrix()
+    active = set(Product.objects.filter(is_active=True).values_list('pk', flat=True))
+    neighbours = top_neighbours(similarity, products, k, allowed=active)
+
+    current = {}
+    for product_id, recommended_id in ProductRecommendation.objects.values_list('product_id', 'recommended_id'):
+        current.setdefault(product_id, []).append(recommended_id)
+    changed = [
+        pk for pk in set(current) | set(neighbours)
+        if current.get(pk) != [neighbour for neighbour, _ in neighbours.get(pk, [])]
+    ]
+    if not changed:
+        return []
+
+    with transaction.atomic():
+        ProductRecommendation.objects.filter(product_id__in=changed).delete()
+        ProductRecommendation.objects.bulk_create([
+            ProductRecommendation(product_id=pk, recommended_id=neighbour, rank=rank, score=score)
+            for pk in changed
+            for rank, (neighbour, score) in enumerate(neighbours.get(pk, []))
+        ], batch_size=500)
+    invalidate_tags(*[f'product:{pk}' for pk in changed])
+    return changed
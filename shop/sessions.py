@@ -0,0 +1,116 @@
+"""Session engine: read through the cache, write only what changed.
+
+``SESSION_ENGINE = 'shop.sessions'``. Sessions live in the database as
+with Django's ``cached_db`` engine and are read through the tiered cache
+(``SESSION_CACHE_ALIAS``):
+
+* Cached copies are tagged ``session:<key>``. A write bumps the tag on
+  the invalidation bus without moving its global generation, so every
+  worker sees the new data straight away and none has to empty its L1.
+* ``save`` compares the data with what was loaded and skips the database
+  and the cache when nothing changed. Django saves whenever a key was
+  assigned, even to the value it already had.
+* Expired sessions are deleted by ``clear_expired`` (``manage.py
+  clearsessions``, or the ``sessions`` task of ``manage.py cleanup``) in
+  batches (``shop.cleanup.delete_in_batches``), each in its own short
+  transaction, instead of one DELETE over the whole table.
+"""
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.contrib.sessions.backends.db import SessionStore as DBStore
+from django.core.cache import caches
+from django.utils import timezone
+
+from .cleanup import delete_in_batches
+
+
+KEY_PREFIX = 'shop.sessions:'
+
+
+def _tag(session_key):
+    return f'session:{session_key}'
+
+
+class SessionStore(DBStore):
+    """Database sessions cached with tags, saved only when changed"""
+
+    def __init__(self, session_key=None):
+        self._cache = caches[settings.SESSION_CACHE_ALIAS]
+        self._saved_state = None
+        super().__init__(session_key)
+
+    def _state(self, data):
+        return self.serializer().dumps(data)
+
+    def load(self):
+        data = self._cache.get(KEY_PREFIX + self.session_key) if self.session_key else None
+        if data is None:
+            s = self._get_session_from_db()
+            if s:
+                data = self.decode(s.session_data)
+                self._cache.set(
+                    KEY_PREFIX + s.session_key, data, self.get_expiry_age(expiry=s.expire_date),
+                    tags=[_tag(s.session_key)],
+                )
+            else:
+                data = {}
+        # _get_session_from_db drops the key of a missing session.
+        self._saved_state = self._state(data) if self.session_key else None
+        return data
+
+    def save(self, must_create=False):
+        if self.session_key is None:
+            return self.create()
+        data = self._get_session(no_load=must_create)
+        state = self._state(data)
+        if not must_create and state == self._saved_state:
+            return
+        super().save(must_create)
+        self._cache.invalidate_tags(_tag(self.session_key), generation=False)
+        self._cache.set(KEY_PREFIX + self.session_key, data, self.get_expiry_age(), tags=[_tag(self.session_key)])
+        self._saved_state = state
+
+    def exists(self, session_key):
+        return bool(session_key) and (KEY_PREFIX + session_key in self._cache or super().exists(session_key))
+
+    def delete(self, session_key=None):
+        if session_key is None:
+            session_key = self.session_key
+        super().delete(session_key)
+        if session_key is not None:
+            self._cache.delete(KEY_PREFIX + session_key)
+            self._cache.invalidate_tags(_tag(session_key), generation=False)
+
+    def flush(self):
+        self.clear()
+        self.delete(self.session_key)
+        self._session_key = None
+        self._saved_state = None
+
+    # The async API runs the sync code on a thread.
+
+    async def aload(self):
+        return await sync_to_async(self.load)()
+
+    async def asave(self, must_create=False):
+        await sync_to_async(self.save)(must_create)
+
+    async def aexists(self, session_key):
+        return await sync_to_async(self.exists)(session_key)
+
+    async def adelete(self, session_key=None):
+        await sync_to_async(self.delete)(session_key)
+
+    async def aflush(self):
+        await sync_to_async(self.flush)()
+
+    @classmethod
+    def sweep_expired(cls, batch_size=None):
+        """Delete expired sessions a batch at a time, yielding each batch's count."""
+        expired = cls.get_model_class().objects.filter(expire_date__lt=timezone.now())
+        yield from delete_in_batches(expired, batch_size)
+
+    @classmethod
+    def clear_expired(cls):
+        for _ in cls.sweep_expired():
+            pass
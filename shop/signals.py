@@ -0,0 +1,46 @@
+from django.contrib.auth.signals import user_logged_in
+from django.db import connections, transaction
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from . import autocomplete
+from .carts import merge_cookie_cart
+from .models import Category, Product, Review
+from .page_cache import invalidate_tags
+
+
+@receiver([post_save, post_delete], sender=Product)
+@receiver([post_save, post_delete], sender=Category)
+@receiver([post_save, post_delete], sender=Review)
+def invalidate_pages(sender, instance, **kwargs):
+    """Pages showing the saved or deleted row go stale in every worker"""
+    invalidate_tags(*instance.cache_tags())
+
+
+@receiver([post_save, post_delete], sender=Product)
+@receiver([post_save, post_delete], sender=Category)
+def rebuild_autocomplete_index(sender, instance, using, **kwargs):
+    """Names in the search box suggestions come from products and categories.
+
+    Rows saved in one transaction share a single rebuild after it commits.
+    """
+    connection = connections[using]
+    queued = getattr(connection, 'autocomplete_rebuild', None)
+    # A rolled back transaction drops its callbacks, so the rebuild is only
+    # pending while it is still in run_on_commit.
+    if queued is not None and any(func is queued for _, func, _ in connection.run_on_commit):
+        return
+
+    def rebuild():
+        connection.autocomplete_rebuild = None
+        autocomplete.build_index()
+
+    connection.autocomplete_rebuild = rebuild
+    transaction.on_commit(rebuild, using=using)
+
+
+@receiver(user_logged_in)
+def merge_anonymous_cart(sender, request, user, **kwargs):
+    """Keep what the visitor put in their cart before signing in"""
+    if request is not None:
+        merge_cookie_cart(request, user)
@@ -0,0 +1,68 @@
+"""File storages for static files and uploaded media.
+
+``IncrementalCompressedManifestStorage`` is the static files storage for
+``collectstatic``.
+
+Files are written under content-hashed names (``main.3f2a9c1b.js``) listed
+in ``staticfiles.json``, with gzip and Brotli copies next to them, so
+WhiteNoise can serve them with far-future immutable cache headers and the
+best encoding the browser accepts.
+
+Compressing is the slow part of ``collectstatic``, and most files have not
+changed since the last run. A hashed file whose compressed copy exists is
+compressed already, since its name changes with its content; an unhashed
+file is compressed again only when its copy is older than the file.
+
+``ContentHashedMediaStorage`` stores uploads under names that include a
+hash of their content (``cake.3f2a9c1b07de.jpg``), so a media URL always
+refers to the same bytes and can be cached as immutable (see
+``shop.media``). Uploading the same file twice stores it once.
+"""
+import hashlib
+import os
+
+from django.core.files import File
+from django.core.files.storage import FileSystemStorage
+
+from whitenoise.compress import brotli_installed
+from whitenoise.storage import CompressedManifestStaticFilesStorage
+
+
+class IncrementalCompressedManifestStorage(CompressedManifestStaticFilesStorage):
+    """Hashed, pre-compressed static files, compressing only what changed"""
+
+    def compress_files(self, paths):
+        hashed = set(self.hashed_files.values())
+        return super().compress_files([path for path in paths if self._needs_compressing(path, path in hashed)])
+
+    def _needs_compressing(self, path, is_hashed):
+        # Compressor writes the Brotli copy first and gives up on gzip too
+        # if Brotli does not pay off, so one copy tells whether it is current.
+        full_path = self.path(path)
+        suffix = '.br' if brotli_installed else '.gz'
+        try:
+            # CSS and JS are rewritten on every run, so hashed files are
+            # judged by name rather than modification time.
+            compressed = os.stat(full_path + suffix)
+            return not is_hashed and compressed.st_mtime < os.stat(full_path).st_mtime
+        except FileNotFoundError:
+            return True
+
+
+class ContentHashedMediaStorage(FileSystemStorage):
+    """Uploads named after a hash of their content"""
+
+    def save(self, name, content, max_length=None):
+        if name is None:
+            name = content.name
+        if not hasattr(content, 'chunks'):
+            content = File(content, name)
+        digest = hashlib.md5(usedforsecurity=False)
+        for chunk in content.chunks():
+            digest.update(chunk)
+        content.seek(0)
+        root, ext = os.path.splitext(name)
+        name = f'{root}.{digest.hexdigest()[:12]}{ext}'
+        if self.exists(name):
+            return name
+        return super().save(name, content, max_length)
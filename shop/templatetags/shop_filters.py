@@ -1,4 +1,8 @@
 from django import template
+from django.conf import settings
+from django.contrib.staticfiles import finders
+from django.contrib.staticfiles.storage import staticfiles_storage
+from django.templatetags.static import static
 from decimal import Decimal
 
 register = template.Library()
@@ -58,3 +62,11 @@ def add(value, arg):
         return float(value) + float(arg)
     except (ValueError, TypeError):
         return 0
+
+
+@register.simple_tag
+def optional_static(path):
+    """URL of a static file that may not be there, or '' when it is missing"""
+    if staticfiles_storage.exists(path) or (settings.DEBUG and finders.find(path)):
+        return static(path)
+    return ''
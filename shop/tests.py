@@ -1,3 +1,1475 @@
-from django.test import TestCase
+import glob
+import json
+import os
+import runpy
+import shutil
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
 
-# Create your tests here.
+from datetime import timedelta
+from io import StringIO
+from types import SimpleNamespace
+from unittest.mock import patch
+
+from django.conf import settings
+from django.contrib.staticfiles.storage import staticfiles_storage
+from django.core.cache import cache, caches
+from django.core.exceptions import ImproperlyConfigured
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.core.management import call_command
+from django.db import connection, connections, transaction
+from django.db.utils import load_backend
+from django.template import engines
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+
+import numpy as np
+from mysql_backend.pool import ConnectionPool, PoolTimeout
+
+from django.utils import timezone
+
+from .db_router import reset_pinning
+from . import archive, autocomplete, cleanup, invalidation, metrics, page_cache, view_counter, warmup
+from .cache import TieredCache
+from .sessions import SessionStore
+from .admin import get_dashboard_stats
+from .views import with_ratings
+from .models import (
+    ArchivedOrder, ArchivedOrderItem, BakePlan, Cart, CartItem, Category, IdempotencyKey, Order, OrderItem, Product,
+    ProductRecommendation, Review, SearchQuery, TrendingEpoch, User,
+)
+
+
+# Write product views straight away so none are still buffered, waiting for
+# the exit-time flush, once the test database has been destroyed.
+_unbuffered_views = override_settings(VIEW_COUNTER_BUFFERED=False)
+_module_overrides = []
+
+
+def setUpModule():
+    _unbuffered_views.enable()
+    # Pages and fragments built from the test database must not end up in
+    # the shared cache, or on the invalidation bus, of a dev server, nor
+    # metrics files in its METRICS_DIR.
+    directory = tempfile.mkdtemp(prefix='shop-tests-')
+    cache_dir = os.path.join(directory, 'cache')
+    shared = {**settings.CACHES['shared'], 'LOCATION': os.path.join(cache_dir, 'shared')}
+    isolated = override_settings(
+        CACHE_DIR=cache_dir,
+        INVALIDATION_BUS_PATH=os.path.join(cache_dir, 'invalidation.bus'),
+        CACHES={**settings.CACHES, 'shared': shared},
+        AUTOCOMPLETE_INDEX_PATH=os.path.join(directory, 'autocomplete', 'index.bin'),
+        METRICS_DIR=os.path.join(directory, 'metrics'),
+    )
+    isolated.enable()
+    _module_overrides.append((isolated, directory))
+
+
+def tearDownModule():
+    _unbuffered_views.disable()
+    for isolated, directory in _module_overrides:
+        isolated.disable()
+        shutil.rmtree(directory, ignore_errors=True)
+    _module_overrides.clear()
+
+
+class FakeConnection:
+    """Stand-in for a mysql-connector connection"""
+    instances = 0
+
+    def __init__(self):
+        FakeConnection.instances += 1
+        self.closed = False
+        self.alive = True
+
+    def ping(self):
+        if not self.alive:
+            raise ConnectionError('server has gone away')
+
+    def close(self):
+        self.closed = True
+
+
+class ConnectionPoolTests(SimpleTestCase):
+    """Tests for the mysql_backend connection pool"""
+
+    def test_concurrent_threads_never_exceed_size_plus_overflow(self):
+        pool = ConnectionPool(FakeConnection, size=2, max_overflow=2, timeout=5)
+        lock = threading.Lock()
+        in_use = set()
+        peak = [0]
+        errors = []
+
+        def worker():
+            try:
+                for _ in range(20):
+                    conn = pool.acquire()
+                    with lock:
+                        self.assertNotIn(id(conn), in_use)
+                        in_use.add(id(conn))
+                        peak[0] = max(peak[0], len(in_use))
+                    time.sleep(0.001)
+                    with lock:
+                        in_use.discard(id(conn))
+                    pool.release(conn)
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=worker) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(errors, [])
+        self.assertLessEqual(peak[0], 4)
+        self.assertEqual(pool.checked_out, 0)
+        # Overflow connections are closed when returned.
+        self.assertLessEqual(pool.open_connections, 2)
+
+    def test_idle_connection_is_reused(self):
+        pool = ConnectionPool(FakeConnection, size=1, max_overflow=0)
+        conn = pool.acquire()
+        pool.release(conn)
+        self.assertIs(pool.acquire(), conn)
+        self.assertEqual(pool.stats['created'], 1)
+
+    def test_dead_connection_is_replaced_on_pre_ping(self):
+        pool = ConnectionPool(FakeConnection, size=1, max_overflow=0)
+        conn = pool.acquire()
+        pool.release(conn)
+        conn.alive = False
+        fresh = pool.acquire()
+        self.assertIsNot(fresh, conn)
+        self.assertTrue(conn.closed)
+        self.assertEqual(pool.stats['ping_failures'], 1)
+
+    def test_old_connection_is_recycled(self):
+        pool = ConnectionPool(FakeConnection, size=1, max_overflow=0, recycle=0)
+        conn = pool.acquire()
+        pool.release(conn)
+        time.sleep(0.01)
+        self.assertIsNot(pool.acquire(), conn)
+        self.assertEqual(pool.stats['recycled'], 1)
+
+    def test_exhausted_pool_times_out(self):
+        pool = ConnectionPool(FakeConnection, size=1, max_overflow=0, timeout=0.05)
+        pool.acquire()
+        with self.assertRaises(PoolTimeout):
+            pool.acquire()
+
+
+class SQLiteBackendTests(TestCase):
+    """Connections from sqlite_backend are tuned and write-lock on BEGIN"""
+
+    def test_default_connection(self):
+        with connection.cursor() as cursor:
+            pragmas = {
+                name: cursor.execute(f'PRAGMA {name}').fetchone()[0]
+                for name in ('busy_timeout', 'synchronous', 'temp_store', 'cache_size')
+            }
+        # synchronous NORMAL is 1, temp_store MEMORY is 2.
+        self.assertEqual(pragmas, {'busy_timeout': 5000, 'synchronous': 1, 'temp_store': 2, 'cache_size': -64000})
+        self.assertEqual(connection.transaction_mode, 'IMMEDIATE')
+
+    def test_file_database(self):
+        # The test database lives in memory, where WAL does not apply.
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path = os.path.join(directory, 'db.sqlite3')
+        settings_dict = {**connection.settings_dict, 'NAME': path, 'OPTIONS': {}}
+        connections['backend_test'] = load_backend('sqlite_backend').DatabaseWrapper(settings_dict, 'backend_test')
+        self.addCleanup(connections.__delitem__, 'backend_test')
+        self.addCleanup(connections['backend_test'].close)
+        with connections['backend_test'].cursor() as cursor:
+            self.assertEqual(cursor.execute('PRAGMA journal_mode').fetchone()[0], 'wal')
+            cursor.execute('CREATE TABLE loaf (id INTEGER PRIMARY KEY)')
+
+        other = sqlite3.connect(path, timeout=0, isolation_level=None)
+        self.addCleanup(other.close)
+        with transaction.atomic(using='backend_test'):
+            # The write lock is taken on BEGIN, before anything is written.
+            with self.assertRaisesMessage(sqlite3.OperationalError, 'database is locked'):
+                other.execute('BEGIN IMMEDIATE')
+        other.execute('BEGIN IMMEDIATE')
+        other.execute('ROLLBACK')
+
+
+@override_settings(DATABASE_REPLICAS=['replica'], PAGE_CACHE_ENABLED=False)
+class ReplicaRoutingTests(TestCase):
+    """Catalog reads use the replica until the session writes"""
+    # Resolved in setUpClass, after the replica alias has been added.
+    databases = '__all__'
+
+    @classmethod
+    def setUpClass(cls):
+        # A second SQLite file stands in for the replica; it is not kept in
+        # sync with the primary, which lets us see where reads are served.
+        cls.replica_dir = tempfile.mkdtemp()
+        connections.settings['replica'] = {
+            **connections.settings['default'],
+            'NAME': os.path.join(cls.replica_dir, 'replica.sqlite3'),
+        }
+        call_command('migrate', database='replica', verbosity=0)
+        super().setUpClass()
+
+    @classmethod
+    def tearDownClass(cls):
+        super().tearDownClass()
+        connections['replica'].close()
+        del connections['replica']
+        del connections.settings['replica']
+        shutil.rmtree(cls.replica_dir)
+
+    def setUp(self):
+        reset_pinning()
+        Category.objects.using('replica').create(
+            name='Cakes', slug='cakes', category_type='cakes'
+        )
+
+    def test_catalog_reads_go_to_replica(self):
+        self.assertTrue(Category.objects.filter(slug='cakes').exists())
+        self.assertFalse(Category.objects.using('default').filter(slug='cakes').exists())
+        self.assertEqual(self.client.get('/shop/?category=cakes').status_code, 200)
+
+    def test_session_sticks_to_primary_after_write(self):
+        self.client.post('/newsletter/subscribe/', {'email': 'reader@example.com'})
+        self.assertEqual(self.client.get('/shop/?category=cakes').status_code, 404)
+
+
+class QueryPlanTests(TestCase):
+    """Hot catalog and order queries must be served by an index"""
+
+    def assertUsesIndex(self, queryset):
+        sql, params = queryset.query.sql_with_params()
+        with connection.cursor() as cursor:
+            cursor.execute('EXPLAIN QUERY PLAN ' + sql, params)
+            plan = [row[-1] for row in cursor.fetchall()]
+        for step in plan:
+            if step.startswith('SCAN') and 'USING' not in step:
+                self.fail(f'Full table scan in plan {plan} for:\n{sql}')
+        self.assertTrue(any('INDEX' in step for step in plan), plan)
+        return plan
+
+    def test_home_featured_products(self):
+        self.assertUsesIndex(Product.objects.filter(is_active=True, is_featured=True)[:8])
+
+    def test_home_new_products(self):
+        self.assertUsesIndex(Product.objects.filter(is_active=True).order_by('-created_at')[:8])
+
+    def test_category_products(self):
+        plan = self.assertUsesIndex(Product.objects.filter(category_id=1, is_active=True))
+        self.assertFalse(any('TEMP B-TREE' in step for step in plan), plan)
+
+    def test_shop_sorted_by_name(self):
+        self.assertUsesIndex(Product.objects.filter(is_active=True).order_by('name')[:24])
+
+    def test_user_order_history(self):
+        plan = self.assertUsesIndex(Order.objects.filter(user_id=1).order_by('-created_at'))
+        self.assertFalse(any('TEMP B-TREE' in step for step in plan), plan)
+
+    def test_dashboard_pending_orders(self):
+        self.assertUsesIndex(Order.objects.filter(status='pending').values('id'))
+
+    def test_dashboard_recent_revenue(self):
+        since = timezone.now() - timedelta(days=30)
+        self.assertUsesIndex(
+            Order.objects.filter(payment_status='paid', created_at__gte=since).values('total')
+        )
+
+    def test_product_ratings(self):
+        self.assertUsesIndex(Review.objects.filter(product_id=1, is_active=True).values('rating'))
+
+
+@override_settings(PAGE_CACHE_STALE_WHILE_REVALIDATE=False)
+class PageCacheTests(TestCase):
+    """Anonymous catalog pages are served from the page cache"""
+
+    def setUp(self):
+        cache.clear()
+        view_counter.take_pending()
+        # Nothing may be left for the exit-time flush, which would write to the real database.
+        self.addCleanup(view_counter.take_pending)
+        self.category = Category.objects.create(name='Breads', slug='breads', category_type='breads')
+        self.product = Product.objects.create(
+            name='Sourdough', slug='sourdough', category=self.category,
+            description='Tangy loaf', price=180, stock=5, image='products/sourdough.jpg',
+        )
+
+    def test_second_request_is_a_hit(self):
+        self.assertEqual(self.client.get('/shop/')['X-Page-Cache'], 'miss')
+        response = self.client.get('/shop/?utm_source=mail')
+        self.assertEqual(response['X-Page-Cache'], 'hit')
+        self.assertContains(response, 'Sourdough')
+
+    def test_matching_etag_returns_not_modified(self):
+        etag = self.client.get('/shop/')['ETag']
+        response = self.client.get('/shop/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+
+    def test_product_change_invalidates_listing(self):
+        self.client.get('/shop/')
+        self.product.name = 'Country Sourdough'
+        self.product.save()
+        response = self.client.get('/shop/')
+        self.assertEqual(response['X-Page-Cache'], 'miss')
+        self.assertContains(response, 'Country Sourdough')
+
+    def test_unchanged_product_page_is_not_modified_without_rendering(self):
+        response = self.client.get('/product/sourdough/')
+        self.assertEqual(response.status_code, 200)
+        view_counter.take_pending()
+        with self.settings(VIEW_COUNTER_BUFFERED=True, VIEW_COUNTER_FLUSH_INTERVAL=0), self.assertNumQueries(1):
+            not_modified = self.client.get('/product/sourdough/', HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(view_counter.take_pending(), {'sourdough': 1})
+        self.assertEqual(not_modified.status_code, 304)
+        self.assertEqual(not_modified['ETag'], response['ETag'])
+
+        since = self.client.get('/product/sourdough/', HTTP_IF_MODIFIED_SINCE=response['Last-Modified'])
+        self.assertEqual(since.status_code, 304)
+
+    def test_review_changes_category_page_validator(self):
+        etag = self.client.get('/category/breads/')['ETag']
+        user = User.objects.create_user('taster', 'taster@example.com', 'crumb-pass-123')
+        Review.objects.create(product=self.product, user=user, rating=5, title='Great', comment='Great crust')
+        response = self.client.get('/category/breads/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+
+    def test_logged_in_users_bypass_cache(self):
+        self.client.get('/shop/')
+        user = User.objects.create_user('baker', 'baker@example.com', 'crumb-pass-123')
+        self.client.force_login(user)
+        self.assertNotIn('X-Page-Cache', self.client.get('/shop/'))
+
+    def test_cached_searches_count_only_with_results(self):
+        for query in ('Sourdough', 'sourdogh'):
+            for status in ('miss', 'hit'):
+                self.assertEqual(self.client.get('/shop/', {'q': query})['X-Page-Cache'], status)
+        self.assertEqual(dict(SearchQuery.objects.values_list('query', 'count')), {'sourdough': 2})
+
+    def refresh_inline(self):
+        self.enterContext(override_settings(PAGE_CACHE_STALE_WHILE_REVALIDATE=True))
+        # The refresh thread would run on its own connection, outside the test transaction.
+        thread = lambda target, daemon: SimpleNamespace(start=target)  # noqa: E731
+        self.enterContext(patch.object(page_cache, 'threading', SimpleNamespace(Thread=thread)))
+        self.enterContext(patch.object(page_cache.connections, 'close_all'))
+
+    @override_settings(VIEW_COUNTER_BUFFERED=True, VIEW_COUNTER_FLUSH_INTERVAL=0, VIEW_COUNTER_MAX_PENDING=1000)
+    def test_stale_hit_counts_one_view(self):
+        self.refresh_inline()
+        self.client.get('/product/sourdough/')
+        view_counter.take_pending()
+        invalidation.invalidate(f'product:{self.product.pk}')
+        self.assertEqual(self.client.get('/product/sourdough/')['X-Page-Cache'], 'stale')
+        self.assertEqual(view_counter.take_pending(), {'sourdough': 1})
+        self.assertEqual(self.client.get('/product/sourdough/')['X-Page-Cache'], 'hit')
+
+    def test_stale_page_that_is_gone_is_dropped(self):
+        self.refresh_inline()
+        self.client.get('/product/sourdough/')
+        Product.objects.filter(pk=self.product.pk).update(is_active=False)
+        self.assertEqual(self.client.get('/product/sourdough/')['X-Page-Cache'], 'stale')
+        self.assertEqual(self.client.get('/product/sourdough/').status_code, 404)
+
+
+@override_settings(PAGE_CACHE_ENABLED=False)
+class FragmentCacheTests(TestCase):
+    """Catalog pages reuse cached fragments until the catalog changes"""
+
+    def setUp(self):
+        cache.clear()
+        self.category = Category.objects.create(name='Breads', slug='breads', category_type='breads')
+        self.products = [
+            Product.objects.create(
+                name=name, slug=name.lower(), category=self.category, description=name, price=price, stock=5,
+                image='products/bread.jpg', is_featured=True,
+            )
+            for name, price in (('Sourdough', 180), ('Rye', 120), ('Brioche', 150))
+        ]
+        user = User.objects.create_user('taster', 'taster@example.com', 'crumb-pass-123')
+        other = User.objects.create_user('critic', 'critic@example.com', 'crumb-pass-123')
+        sourdough, rye, _ = self.products
+        Review.objects.create(product=sourdough, user=user, rating=5, title='Great', comment='Great crust')
+        Review.objects.create(product=sourdough, user=other, rating=4, title='Good', comment='Good crumb')
+        Review.objects.create(product=rye, user=user, rating=3, title='Fine', comment='Dense')
+        Review.objects.create(product=rye, user=other, rating=1, title='Hidden', comment='Hidden', is_active=False)
+
+    def test_second_render_runs_fewer_queries(self):
+        # Only the product lists are read again; cards, categories and the
+        # footer come from the fragment cache.
+        for path, queries in (('/', 3), ('/shop/', 1)):
+            with CaptureQueriesContext(connection) as first:
+                self.assertContains(self.client.get(path), 'Sourdough')
+            with self.assertNumQueries(queries):
+                self.assertContains(self.client.get(path), 'Sourdough')
+            self.assertLess(queries, len(first))
+
+    def test_changes_invalidate_fragments(self):
+        self.client.get('/')
+        self.client.get('/shop/')
+        self.category.name = 'Loaves'
+        self.category.save()
+        sourdough = self.products[0]
+        sourdough.name = 'Country Sourdough'
+        sourdough.save()
+        for path in ('/', '/shop/'):
+            response = self.client.get(path)
+            self.assertContains(response, 'Loaves')
+            self.assertNotContains(response, 'Breads')
+            self.assertContains(response, 'Country Sourdough')
+
+    def test_ratings_match_product_methods(self):
+        for product in with_ratings(Product.objects.all()):
+            self.assertEqual(round(product.average_rating or 0, 1), product.get_average_rating())
+            self.assertEqual(product.review_count, product.get_review_count())
+        response = self.client.get('/shop/', {'sort': 'rating'})
+        self.assertEqual([p.name for p in response.context['products']], ['Sourdough', 'Rye', 'Brioche'])
+
+
+@override_settings(VIEW_COUNTER_BUFFERED=True, VIEW_COUNTER_FLUSH_INTERVAL=0, VIEW_COUNTER_MAX_PENDING=1000)
+class ViewCounterTests(TestCase):
+    """Product views are buffered and written in one batch"""
+
+    def setUp(self):
+        view_counter.take_pending()
+        self.enterContext(patch.object(view_counter, '_epoch', view_counter.TRENDING_EPOCH))
+        category = Category.objects.create(name='Cookies', slug='cookies', category_type='cookies')
+        self.products = [
+            Product.objects.create(
+                name=name, slug=name.lower(), category=category, description=name,
+                price=60, stock=10, image='products/cookie.jpg',
+            )
+            for name in ('Shortbread', 'Macaron')
+        ]
+
+    def test_views_are_written_on_flush(self):
+        for _ in range(3):
+            view_counter.record_view('shortbread')
+        view_counter.record_view('macaron')
+        self.assertEqual(Product.objects.get(slug='shortbread').views, 0)
+
+        with self.assertNumQueries(1):
+            self.assertEqual(view_counter.flush(), 2)
+        self.assertEqual(Product.objects.get(slug='shortbread').views, 3)
+        self.assertEqual(Product.objects.get(slug='macaron').views, 1)
+
+    def test_recent_views_outweigh_older_ones(self):
+        day = 86400
+        view_counter.write_counts({'shortbread': 10}, now=view_counter.TRENDING_EPOCH + 30 * day)
+        view_counter.write_counts({'macaron': 4}, now=view_counter.TRENDING_EPOCH + 40 * day)
+        trending = Product.objects.order_by('-trending_score').values_list('slug', flat=True)
+        self.assertEqual(list(trending), ['macaron', 'shortbread'])
+
+    @override_settings(TRENDING_HALF_LIFE_HOURS=1)
+    def test_scores_are_rebased_long_after_the_epoch(self):
+        # 2 ** (100 years / 1 hour) is far past the float range.
+        now = view_counter.TRENDING_EPOCH + 100 * 365 * 86400
+        view_counter.write_counts({'shortbread': 10}, now=now)
+        view_counter.write_counts({'macaron': 4}, now=now + 7200)
+        epoch = TrendingEpoch.objects.get().epoch
+        self.assertGreater(epoch, now - 3600 * view_counter.REBASE_HALVINGS)
+        self.assertEqual(view_counter._epoch, epoch)
+        shortbread, macaron = (Product.objects.get(slug=slug).trending_score for slug in ('shortbread', 'macaron'))
+        self.assertAlmostEqual(macaron / shortbread, 4 / 10 * 2 ** 2)
+
+        # A second process that has not seen the rebase reads the stored epoch.
+        with patch.object(view_counter, '_epoch', epoch - 3600):
+            view_counter.write_counts({'shortbread': 1}, now=now + 7200)
+        self.assertAlmostEqual(Product.objects.get(slug='shortbread').trending_score / shortbread, 1.4)
+
+    @override_settings(TRENDING_HALF_LIFE_HOURS=0)
+    def test_half_life_must_be_positive(self):
+        with self.assertRaises(ImproperlyConfigured):
+            view_counter.write_counts({'shortbread': 1})
+
+
+@override_settings(PAGE_CACHE_ENABLED=False)
+class RecommendationTests(TestCase):
+    """Frequently bought together products come from paid orders"""
+
+    def setUp(self):
+        category = Category.objects.create(name='Pastries', slug='pastries', category_type='pastries')
+        self.products = {
+            name: Product.objects.create(
+                name=name.title(), slug=name, category=category, description=name,
+                price=90, stock=20, image='products/pastry.jpg',
+            )
+            for name in ('croissant', 'coffee-cake', 'danish', 'eclair')
+        }
+
+    def order(self, *names, payment_status='paid'):
+        order = Order.objects.create(
+            customer_name='Ada', customer_email='ada@example.com', customer_phone='1',
+            shipping_address='1 Street', shipping_city='Pune', shipping_state='MH',
+            shipping_postal_code='411001', subtotal=0, total=0, payment_status=payment_status,
+        )
+        for name in names:
+            product = self.products[name]
+            OrderItem.objects.create(
+                order=order, product=product, product_name=product.name,
+                product_slug=product.slug, quantity=1, price=product.price,
+            )
+
+    def recommended(self, name):
+        return list(
+            ProductRecommendation.objects.filter(product=self.products[name])
+            .values_list('recommended__slug', flat=True)
+        )
+
+    def test_builds_neighbours_incrementally(self):
+        self.order('croissant', 'coffee-cake')
+        self.order('croissant', 'coffee-cake', 'danish')
+        self.order('croissant', 'eclair', payment_status='failed')
+        call_command('build_recommendations', verbosity=0, stdout=open(os.devnull, 'w'))
+        self.assertEqual(self.recommended('croissant'), ['coffee-cake', 'danish'])
+        self.assertEqual(self.recommended('eclair'), [])
+
+        self.order('croissant', 'eclair')
+        self.order('croissant', 'eclair')
+        self.order('croissant', 'eclair')
+        call_command('build_recommendations', verbosity=0, stdout=open(os.devnull, 'w'))
+        self.assertEqual(self.recommended('croissant'), ['eclair', 'coffee-cake', 'danish'])
+        self.assertFalse(Order.objects.filter(payment_status='paid', counted_in_recommendations=False).exists())
+
+        call_command('build_recommendations', full=True, verbosity=0, stdout=open(os.devnull, 'w'))
+        self.assertEqual(self.recommended('croissant'), ['eclair', 'coffee-cake', 'danish'])
+
+    def test_product_page_shows_recommendations(self):
+        self.order('croissant', 'danish')
+        call_command('build_recommendations', verbosity=0, stdout=open(os.devnull, 'w'))
+        response = self.client.get('/product/croissant/')
+        self.assertContains(response, 'Frequently Bought Together')
+        self.assertEqual([p.slug for p in response.context['related_products']], ['danish'])
+
+
+class AutocompleteTests(TestCase):
+    """Search box suggestions come from the memory-mapped snapshot"""
+
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.enterContext(override_settings(AUTOCOMPLETE_INDEX_PATH=os.path.join(directory, 'index.bin')))
+        SearchQuery.objects.create(query='birthday cake', count=12)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.cakes = Category.objects.create(name='Cakes', slug='cakes', category_type='cakes')
+            for name, slug, views in (
+                ('Chocolate Cake', 'chocolate-cake', 40),
+                ('Chocolate Chip Cookie', 'chocolate-chip-cookie', 90),
+                ('Crème Brûlée', 'creme-brulee', 5),
+            ):
+                Product.objects.create(
+                    name=name, slug=slug, category=self.cakes, description=name,
+                    price=250, stock=3, views=views, image='products/cake.jpg',
+                )
+
+    def labels(self, query):
+        return [suggestion['label'] for suggestion in autocomplete.suggest(query)]
+
+    def test_prefix_matches_any_word_ranked_by_popularity(self):
+        self.assertEqual(self.labels('choc'), ['Chocolate Chip Cookie', 'Chocolate Cake'])
+        self.assertEqual(self.labels('cak'), ['Cakes', 'Chocolate Cake', 'birthday cake'])
+        self.assertEqual(self.labels('creme'), ['Crème Brûlée'])
+
+    def test_typo_falls_back_to_close_matches(self):
+        self.assertEqual(self.labels('chocolte'), ['Chocolate Chip Cookie', 'Chocolate Cake'])
+        self.assertEqual(self.labels('xyzzy'), [])
+
+    def test_product_change_rebuilds_snapshot(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            Product.objects.filter(slug='creme-brulee').get().delete()
+        self.assertEqual(self.labels('creme'), [])
+
+    def test_transaction_rebuilds_snapshot_once(self):
+        with patch.object(autocomplete, 'build_index') as build_index, self.captureOnCommitCallbacks(execute=True):
+            with transaction.atomic():
+                for product in Product.objects.all():
+                    product.name += ' Slice'
+                    product.save()
+                self.cakes.delete()
+        build_index.assert_called_once_with()
+
+        # The next transaction gets its own rebuild.
+        with self.captureOnCommitCallbacks(execute=True):
+            Category.objects.create(name='Tarts', slug='tarts', category_type='pastries')
+        self.assertEqual(self.labels('tart'), ['Tarts'])
+
+    def test_rolled_back_transaction_does_not_block_rebuilds(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            with self.assertRaises(ValueError), transaction.atomic():
+                Category.objects.create(name='Tarts', slug='tarts', category_type='pastries')
+                raise ValueError
+            Category.objects.create(name='Pies', slug='pies', category_type='pastries')
+        self.assertEqual(self.labels('pie'), ['Pies'])
+
+    def test_endpoint_returns_json(self):
+        response = self.client.get('/search/suggest/', {'q': 'Birth'})
+        self.assertEqual(response.json()['suggestions'], [
+            {'label': 'birthday cake', 'url': '/shop/?q=birthday+cake', 'type': 'query'},
+        ])
+        self.assertIn('public', response['Cache-Control'])
+
+
+class CartApiTests(TestCase):
+    """Batches of cart line operations apply atomically"""
+
+    def setUp(self):
+        self.user = User.objects.create_user('shopper', 'shopper@example.com', 'crumb-pass-123')
+        self.client.force_login(self.user)
+        category = Category.objects.create(name='Breads', slug='breads', category_type='breads')
+        self.loaf = Product.objects.create(
+            name='Rye Loaf', slug='rye-loaf', category=category, description='Rye',
+            price=120, stock=5, image='products/rye.jpg',
+        )
+        self.bun = Product.objects.create(
+            name='Milk Bun', slug='milk-bun', category=category, description='Bun',
+            price=30, sale_price=25, stock=2, image='products/bun.jpg',
+        )
+
+    def post(self, *operations):
+        return self.client.post('/cart/api/', {'operations': list(operations)}, content_type='application/json')
+
+    def quantities(self):
+        return dict(CartItem.objects.filter(cart__user=self.user).values_list('product__slug', 'quantity'))
+
+    def test_batch_returns_lines_and_totals(self):
+        response = self.post(
+            {'product_id': self.loaf.pk, 'quantity': 2},
+            {'product_id': self.bun.pk, 'delta': 1},
+            {'product_id': self.loaf.pk, 'delta': 1},
+        )
+        self.assertEqual(response.status_code, 200)
+        data = response.json()
+        self.assertEqual(data['total_items'], 4)
+        self.assertEqual(data['subtotal'], '385.00')
+        self.assertEqual(self.quantities(), {'rye-loaf': 3, 'milk-bun': 1})
+
+        self.post({'product_id': self.bun.pk, 'delta': -1})
+        self.assertEqual(self.quantities(), {'rye-loaf': 3})
+
+    def test_stock_conflict_rolls_back_whole_batch(self):
+        self.post({'product_id': self.loaf.pk, 'quantity': 1})
+        response = self.post(
+            {'product_id': self.loaf.pk, 'delta': 2},
+            {'product_id': self.bun.pk, 'quantity': 3},
+        )
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(response.json()['index'], 1)
+        self.assertIn('only 2', response.json()['error'])
+        self.assertEqual(self.quantities(), {'rye-loaf': 1})
+
+    def test_decrease_ignores_stock(self):
+        self.post({'product_id': self.loaf.pk, 'quantity': 4})
+        Product.objects.filter(pk=self.loaf.pk).update(stock=1)
+        self.assertEqual(self.post({'product_id': self.loaf.pk, 'delta': -1}).status_code, 200)
+        self.assertEqual(self.quantities(), {'rye-loaf': 3})
+
+        Product.objects.filter(pk=self.loaf.pk).update(is_active=False)
+        self.assertEqual(self.post({'product_id': self.loaf.pk, 'delta': -1}).status_code, 200)
+        self.assertEqual(self.quantities(), {'rye-loaf': 2})
+        self.assertEqual(self.post({'product_id': self.loaf.pk, 'delta': 1}).status_code, 409)
+
+    def test_malformed_batch_is_rejected(self):
+        self.assertEqual(self.post({'product_id': self.loaf.pk, 'quantity': True}).status_code, 400)
+        self.assertEqual(self.post({'product_id': self.loaf.pk}).status_code, 400)
+        self.assertEqual(self.client.post('/cart/api/', 'nope', content_type='application/json').status_code, 400)
+
+
+class AnonymousCartTests(TestCase):
+    """Visitors keep a cart in a signed cookie until they sign in"""
+
+    def setUp(self):
+        cache.clear()
+        category = Category.objects.create(name='Cakes', slug='cakes', category_type='cakes')
+        self.cake = Product.objects.create(
+            name='Black Forest', slug='black-forest', category=category, description='Cake',
+            price=600, stock=4, image='products/cake.jpg',
+        )
+        self.tart = Product.objects.create(
+            name='Lemon Tart', slug='lemon-tart', category=category, description='Tart',
+            price=150, stock=10, image='products/tart.jpg',
+        )
+
+    def test_anonymous_cart_lives_in_cookie(self):
+        self.client.post('/cart/add/', {'product_id': self.cake.pk, 'quantity': 2})
+        self.assertIn('cart', self.client.cookies)
+        self.assertFalse(Cart.objects.exists())
+
+        response = self.client.get('/shop/')
+        # Pages showing a cart badge are not served from the page cache.
+        self.assertNotIn('X-Page-Cache', response)
+        self.assertEqual(response.context['cart_items_count'], 2)
+
+        data = self.client.post('/cart/api/', {'operations': [
+            {'product_id': self.tart.pk, 'quantity': 3},
+            {'product_id': self.cake.pk, 'delta': 3},
+        ]}, content_type='application/json')
+        self.assertEqual(data.status_code, 409)
+        self.assertEqual(self.client.get('/cart/api/').json()['total_items'], 2)
+
+    def test_decrease_ignores_stock(self):
+        self.client.post('/cart/add/', {'product_id': self.cake.pk, 'quantity': 4})
+        Product.objects.filter(pk=self.cake.pk).update(stock=1)
+        response = self.client.post('/cart/api/', {'operations': [{'product_id': self.cake.pk, 'delta': -1}]},
+                                    content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['total_items'], 3)
+
+        self.client.post('/cart/update/', {'product_id': self.cake.pk, 'action': 'decrease'})
+        self.assertEqual(self.client.get('/cart/api/').json()['total_items'], 2)
+
+    def test_product_page_sells_to_visitors(self):
+        response = self.client.get('/product/black-forest/')
+        self.assertContains(response, 'action="/cart/add/"')
+        self.assertNotContains(response, 'Login to Purchase')
+
+        self.client.post('/cart/add/', {'product_id': self.cake.pk, 'quantity': 2})
+        self.client.post('/cart/add/', {'product_id': self.tart.pk, 'quantity': 1})
+        self.client.post(reverse('remove_from_cart', args=[self.cake.pk]))
+        lines = self.client.get('/cart/api/').json()['lines']
+        self.assertEqual([line['product_id'] for line in lines], [self.tart.pk])
+
+    def test_tampered_cookie_is_ignored(self):
+        self.client.cookies['cart'] = f'{self.cake.pk}-3'
+        self.assertEqual(self.client.get('/cart/api/').json()['lines'], [])
+
+    def test_cart_is_merged_on_login(self):
+        user = User.objects.create_user('baker', 'baker@example.com', 'crumb-pass-123')
+        CartItem.objects.create(cart=Cart.objects.create(user=user), product=self.cake, quantity=3)
+        self.client.post('/cart/add/', {'product_id': self.cake.pk, 'quantity': 2})
+        self.client.post('/cart/add/', {'product_id': self.tart.pk, 'quantity': 1})
+
+        self.client.post('/login/', {'username': 'baker', 'password': 'crumb-pass-123'})
+        quantities = dict(CartItem.objects.filter(cart__user=user).values_list('product__slug', 'quantity'))
+        # Capped at the 4 in stock.
+        self.assertEqual(quantities, {'black-forest': 4, 'lemon-tart': 1})
+        self.assertEqual(self.client.cookies['cart'].value, '')
+
+
+class IdempotencyTests(TestCase):
+    """Repeated submissions with one idempotency key run once"""
+
+    def setUp(self):
+        self.user = User.objects.create_user('regular', 'regular@example.com', 'crumb-pass-123')
+        self.client.force_login(self.user)
+        category = Category.objects.create(name='Pastries', slug='pastries', category_type='pastries')
+        self.croissant = Product.objects.create(
+            name='Croissant', slug='croissant', category=category, description='Butter',
+            price=80, stock=10, image='products/croissant.jpg',
+        )
+
+    def test_cart_api_retry_is_replayed(self):
+        body = {'operations': [{'product_id': self.croissant.pk, 'delta': 2}]}
+        headers = {'HTTP_IDEMPOTENCY_KEY': 'retry-key-0000000001'}
+        first = self.client.post('/cart/api/', body, content_type='application/json', **headers)
+        second = self.client.post('/cart/api/', body, content_type='application/json', **headers)
+        self.assertEqual(second.json(), first.json())
+        self.assertEqual(second['Idempotent-Replayed'], 'true')
+        self.assertEqual(CartItem.objects.get(cart__user=self.user).quantity, 2)
+
+        body['operations'][0]['delta'] = 3
+        reused = self.client.post('/cart/api/', body, content_type='application/json', **headers)
+        self.assertEqual(reused.status_code, 422)
+
+    def test_anonymous_replay_restores_cookie_cart(self):
+        self.client.logout()
+        data = {'product_id': self.croissant.pk, 'quantity': 1, 'idempotency_key': 'double-click-00000001'}
+        self.client.post('/cart/add/', data)
+        # A retry that still carries the old cookie gets the new one back.
+        del self.client.cookies['cart']
+        response = self.client.post('/cart/add/', data)
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(response['Idempotent-Replayed'], 'true')
+        self.assertEqual(self.client.get('/cart/api/').json()['total_items'], 1)
+
+    def test_replay_restores_flash_messages(self):
+        data = {'product_id': self.croissant.pk, 'quantity': 1, 'idempotency_key': 'double-click-00000002'}
+        self.client.post('/cart/add/', data)
+        # The first response's messages cookie never arrived.
+        del self.client.cookies['messages']
+        replayed = self.client.post('/cart/add/', data)
+        self.assertEqual(replayed['Idempotent-Replayed'], 'true')
+        response = self.client.get(replayed['Location'])
+        self.assertEqual([str(message) for message in response.context['messages']], ['Croissant added to cart!'])
+        self.assertEqual(CartItem.objects.get(cart__user=self.user).quantity, 1)
+
+    @patch('stripe.PaymentIntent.create')
+    def test_double_submitted_checkout_creates_one_order(self, create_intent):
+        create_intent.return_value = SimpleNamespace(client_secret='pi_secret')
+        CartItem.objects.create(cart=Cart.objects.create(user=self.user), product=self.croissant, quantity=3)
+        data = {
+            'shipping_name': 'Regular', 'shipping_email': 'regular@example.com', 'shipping_phone': '9800000000',
+            'shipping_address': '1 Bakery Lane', 'shipping_city': 'Kathmandu', 'shipping_state': 'Bagmati',
+            'shipping_postal_code': '44600', 'shipping_method': 'standard', 'cardholder_name': 'Regular',
+            'idempotency_key': self.client.get('/checkout/').context['idempotency_key'],
+        }
+        first = self.client.post('/checkout/', data)
+        second = self.client.post('/checkout/', data)
+        self.assertEqual(first.status_code, 200)
+        self.assertEqual(second.content, first.content)
+        self.assertEqual(Order.objects.filter(user=self.user).count(), 1)
+        self.assertEqual(create_intent.call_count, 1)
+
+
+class StaticPipelineTests(SimpleTestCase):
+    """collectstatic writes hashed, pre-compressed files once"""
+
+    def setUp(self):
+        self.static_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.static_root)
+
+    def test_hashed_compressed_files_served_immutable(self):
+        # Only the site's own files; the admin's would make this slow.
+        finders = ['django.contrib.staticfiles.finders.FileSystemFinder']
+        with override_settings(STATIC_ROOT=self.static_root, STATICFILES_FINDERS=finders):
+            call_command('collectstatic', interactive=False, verbosity=0)
+            url = staticfiles_storage.url('js/main.js')
+            self.assertRegex(url, r'^/static/js/main\.[0-9a-f]{12}\.js$')
+            hashed_path = os.path.join(self.static_root, url[len('/static/'):])
+            self.assertTrue(os.path.exists(hashed_path + '.gz'))
+            self.assertTrue(os.path.exists(hashed_path + '.br'))
+
+            compressed_at = os.stat(hashed_path + '.br').st_mtime_ns
+            call_command('collectstatic', interactive=False, verbosity=0)
+            self.assertEqual(os.stat(hashed_path + '.br').st_mtime_ns, compressed_at)
+
+            response = self.client.get(url, HTTP_ACCEPT_ENCODING='gzip, br')
+            self.assertEqual(response['Content-Encoding'], 'br')
+            self.assertIn('immutable', response['Cache-Control'])
+
+    def test_only_optional_files_may_be_missing(self):
+        template = engines['django'].from_string("{% load shop_filters %}{% optional_static 'images/logo.png' %}")
+        with override_settings(STATIC_ROOT=self.static_root):
+            with self.assertRaises(ValueError):
+                staticfiles_storage.url('images/missing.png')
+            self.assertEqual(template.render(), '')
+
+            os.makedirs(os.path.join(self.static_root, 'images'))
+            with open(os.path.join(self.static_root, 'images', 'logo.png'), 'wb') as f:
+                f.write(b'logo')
+            self.assertRegex(template.render(), r'^/static/images/logo\.[0-9a-f]{12}\.png$')
+
+
+class MediaServingTests(SimpleTestCase):
+    """Media files are served with ranges, validators and cache headers"""
+
+    def setUp(self):
+        media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media_root)
+        settings_override = override_settings(MEDIA_ROOT=media_root, MEDIA_SENDFILE_HEADER='')
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        self.name = default_storage.save('products/croissant.jpg', ContentFile(bytes(range(256)) * 4))
+
+    def test_uploads_get_content_hashed_immutable_urls(self):
+        self.assertRegex(self.name, r'^products/croissant\.[0-9a-f]{12}\.jpg$')
+        self.assertEqual(default_storage.save('products/croissant.jpg', ContentFile(bytes(range(256)) * 4)), self.name)
+
+        response = self.client.get(default_storage.url(self.name))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'image/jpeg')
+        self.assertIn('immutable', response['Cache-Control'])
+        self.assertEqual(len(b''.join(response.streaming_content)), 1024)
+
+        not_modified = self.client.get(default_storage.url(self.name), HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(not_modified.status_code, 304)
+
+    def test_range_requests(self):
+        url = default_storage.url(self.name)
+        response = self.client.get(url, HTTP_RANGE='bytes=10-19')
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(response['Content-Range'], 'bytes 10-19/1024')
+        self.assertEqual(b''.join(response.streaming_content), bytes(range(10, 20)))
+
+        self.assertEqual(self.client.get(url, HTTP_RANGE='bytes=-4')['Content-Range'], 'bytes 1020-1023/1024')
+        self.assertEqual(self.client.get(url, HTTP_RANGE='bytes=2000-').status_code, 416)
+        # A range for an older version of the file is ignored.
+        self.assertEqual(self.client.get(url, HTTP_RANGE='bytes=0-1', HTTP_IF_RANGE='"stale"').status_code, 200)
+
+    def test_proxy_sendfile_and_missing_files(self):
+        with override_settings(MEDIA_SENDFILE_HEADER='X-Accel-Redirect'):
+            response = self.client.get(default_storage.url(self.name))
+        self.assertEqual(response['X-Accel-Redirect'], '/protected-media/' + self.name)
+        self.assertEqual(response.content, b'')
+        self.assertEqual(self.client.get('/media/%2e%2e/manage.py').status_code, 400)
+        self.assertEqual(self.client.get('/media/products/missing.jpg').status_code, 404)
+
+
+class TieredCacheTests(SimpleTestCase):
+    """Per-worker LRUs in front of a shared cache stay consistent"""
+
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.cache_dir)
+        caches_override = override_settings(CACHES={
+            'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'},
+            'shared': {'BACKEND': 'shop.cache.SharedFileCache', 'LOCATION': self.cache_dir},
+        }, INVALIDATION_BUS_PATH=os.path.join(self.cache_dir, 'invalidation.bus'))
+        caches_override.enable()
+        self.addCleanup(caches_override.disable)
+
+    def worker(self):
+        """A TieredCache as another gunicorn worker would have it"""
+        return TieredCache('test', {'OPTIONS': {
+            'L2': 'shared', 'L1_TIMEOUT': 60,
+        }})
+
+    def test_tag_invalidation_reaches_other_workers(self):
+        first, second = self.worker(), self.worker()
+        first.set('menu', ['rye', 'bun'], tags=['catalog'])
+        second.set('motd', 'fresh bread')
+        self.assertEqual(second.get('menu'), ['rye', 'bun'])
+        caches['shared'].set('motd', 'stale bread')
+        # Served from the second worker's own LRU.
+        self.assertEqual(second.get('motd'), 'fresh bread')
+
+        first.invalidate_tags('catalog')
+        self.assertIsNone(second.get('menu'))
+        self.assertEqual(second.get('motd'), 'stale bread')
+
+    def test_get_or_set_computes_once(self):
+        calls = []
+
+        def bake():
+            calls.append(1)
+            time.sleep(0.1)
+            return 'croissant'
+
+        workers = [self.worker() for _ in range(3)]
+        results = []
+        threads = [
+            threading.Thread(target=lambda c=c: results.append(c.get_or_set('special', bake)))
+            for c in workers * 2
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(results, ['croissant'] * 6)
+        self.assertEqual(len(calls), 1)
+
+    def test_shared_add_is_exclusive(self):
+        shared = caches['shared']
+        self.assertTrue(shared.add('lock', 1))
+        self.assertFalse(shared.add('lock', 2))
+        shared.set('lock', 3, timeout=-1)
+        self.assertTrue(shared.add('lock', 4))
+        self.assertEqual(shared.get('lock'), 4)
+
+
+@override_settings(PAGE_CACHE_STALE_WHILE_REVALIDATE=False)
+class InvalidationBusTests(TestCase):
+    """Bulk writes bump the same cache tags as saves"""
+
+    def setUp(self):
+        cache.clear()
+        self.breads = Category.objects.create(name='Breads', slug='breads', category_type='breads')
+        self.cakes = Category.objects.create(name='Cakes', slug='cakes', category_type='cakes')
+        self.rye = Product.objects.create(
+            name='Rye', slug='rye', category=self.breads,
+            description='Dark loaf', price=150, stock=4, image='products/rye.jpg',
+        )
+
+    def test_bulk_update_invalidates_listing(self):
+        self.client.get('/shop/')
+        Product.objects.filter(category=self.breads).update(name='Seeded Rye')
+        response = self.client.get('/shop/')
+        self.assertEqual(response['X-Page-Cache'], 'miss')
+        self.assertContains(response, 'Seeded Rye')
+
+    def test_moving_products_bumps_both_categories(self):
+        tags = ['category:breads', f'category:{self.breads.pk}', f'category:{self.cakes.pk}']
+        before = invalidation.versions(tags)
+        Product.objects.filter(pk=self.rye.pk).update(category=self.cakes)
+        after = invalidation.versions(tags)
+        self.assertNotEqual(before[tags[1]], after[tags[1]])
+        self.assertNotEqual(before[tags[2]], after[tags[2]])
+
+    def test_view_counts_do_not_invalidate(self):
+        before = invalidation.generation()
+        view_counter.write_counts({'rye': 3})
+        self.assertEqual(invalidation.generation(), before)
+        Product.objects.bulk_update([Product(pk=self.rye.pk, stock=0)], ['stock'])
+        self.assertGreater(invalidation.generation(), before)
+
+    def test_bump_is_seen_through_another_mapping(self):
+        path = os.path.join(tempfile.mkdtemp(), 'invalidation.bus')
+        self.addCleanup(shutil.rmtree, os.path.dirname(path))
+        first, second = invalidation.Bus(path), invalidation.Bus(path)
+        before = second.versions(['product:1'])['product:1']
+        first.bump(['product:1'])
+        self.assertGreater(second.versions(['product:1'])['product:1'], before)
+        self.assertEqual(second.generation, 1)
+
+
+@override_settings(PAGE_CACHE_STALE_WHILE_REVALIDATE=False)
+class AsyncViewTests(TestCase):
+    """Catalog pages and the cart API run as async views under ASGI"""
+
+    def setUp(self):
+        cache.clear()
+        category = Category.objects.create(name='Cakes', slug='cakes', category_type='cakes')
+        self.cake = Product.objects.create(
+            name='Black Forest', slug='black-forest', category=category, description='Cherry cake',
+            price=650, stock=3, image='products/black-forest.jpg',
+        )
+        user = User.objects.create_user('critic', 'critic@example.com', 'crumb-pass-123')
+        Review.objects.create(product=self.cake, user=user, rating=4, title='Good', comment='Rich')
+
+    async def test_catalog_pages(self):
+        response = await self.async_client.get('/product/black-forest/')
+        self.assertContains(response, 'Black Forest')
+        self.assertEqual(response.context['average_rating'], 4)
+        self.assertEqual(response.context['review_count'], 1)
+        self.assertEqual((await self.async_client.get('/category/cakes/'))['X-Page-Cache'], 'miss')
+        self.assertEqual((await self.async_client.get('/category/cakes/'))['X-Page-Cache'], 'hit')
+        not_found = await self.async_client.get('/shop/', {'category': 'nope'})
+        self.assertEqual(not_found.status_code, 404)
+
+    async def test_cart_api(self):
+        response = await self.async_client.post(
+            '/cart/api/', {'operations': [{'product_id': self.cake.pk, 'quantity': 2}]},
+            content_type='application/json',
+        )
+        self.assertEqual(response.json()['total_items'], 2)
+        conflict = await self.async_client.post(
+            '/cart/api/', {'operations': [{'product_id': self.cake.pk, 'delta': 5}]},
+            content_type='application/json',
+        )
+        self.assertEqual(conflict.status_code, 409)
+        self.assertEqual(conflict.json()['cart']['total_items'], 2)
+
+
+
+class StartupTests(TestCase):
+    """Workers start without Stripe and warm up before taking traffic"""
+
+    def test_stripe_is_imported_on_first_use(self):
+        script = 'import django, sys; django.setup(); import shop.views; print("stripe" in sys.modules)'
+        result = subprocess.run(
+            [sys.executable, '-c', script], cwd=settings.BASE_DIR, capture_output=True, text=True, check=True,
+            env={**os.environ, 'DJANGO_SETTINGS_MODULE': 'goodluck_bakery.settings'},
+        )
+        self.assertEqual(result.stdout.strip(), 'False')
+
+    def test_warm(self):
+        index = os.path.join(tempfile.mkdtemp(), 'index.bin')
+        self.addCleanup(shutil.rmtree, os.path.dirname(index))
+        options = settings.TEMPLATES[0]['OPTIONS']
+        templates = [{**settings.TEMPLATES[0], 'OPTIONS': {
+            **options, 'loaders': [('django.template.loaders.cached.Loader', options['loaders'])],
+        }}]
+        with override_settings(AUTOCOMPLETE_INDEX_PATH=index, TEMPLATES=templates):
+            with self.assertNoLogs('shop.warmup'), patch.object(warmup.connections, 'close_all') as close_all:
+                timings = warmup.warm()
+            cached = engines['django'].engine.template_loaders[0].get_template_cache
+        self.assertEqual(list(timings), [name for name, _ in warmup.STEPS])
+        self.assertIn('base.html', cached)
+        self.assertIn('shop/checkout.html', cached)
+        self.assertTrue(os.path.exists(index))
+        # Connections opened in the gunicorn master must not reach the workers.
+        close_all.assert_called_once()
+
+
+class GunicornConfigTests(SimpleTestCase):
+    """gunicorn.conf.py sizes workers from CPUs and memory"""
+
+    def load(self, **env):
+        with patch.dict(os.environ, env):
+            return runpy.run_path(os.path.join(settings.BASE_DIR, 'gunicorn.conf.py'))
+
+    def test_profiles(self):
+        threaded = self.load(GUNICORN_PROFILE='threaded', GUNICORN_WORKERS='5')
+        self.assertEqual((threaded['worker_class'], threaded['workers'], threaded['threads']), ('gthread', 5, 4))
+        self.assertTrue(threaded['preload_app'])
+        self.assertEqual(self.load(GUNICORN_PROFILE='async')['wsgi_app'], 'goodluck_bakery.asgi:application')
+        with self.assertRaises(RuntimeError):
+            self.load(GUNICORN_PROFILE='eventlet')
+
+    def test_worker_count(self):
+        worker_count = self.load()['worker_count']
+        self.assertEqual(worker_count('threaded', 4, None), 9)
+        self.assertEqual(worker_count('async', 4, 64 * 1024), 5)
+        # Half of 1 GB at 128 MB per worker.
+        self.assertEqual(worker_count('threaded', 4, 1024), 4)
+        self.assertEqual(worker_count('sync', 1, 100), 1)
+
+
+class SessionStoreTests(TestCase):
+    """Sessions are read through the tiered cache and written when changed"""
+
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.cache_dir)
+        caches_override = override_settings(CACHES={
+            'default': {'BACKEND': 'shop.cache.TieredCache', 'OPTIONS': {'L2': 'shared'}},
+            'shared': {'BACKEND': 'shop.cache.SharedFileCache', 'LOCATION': self.cache_dir},
+        }, INVALIDATION_BUS_PATH=os.path.join(self.cache_dir, 'invalidation.bus'))
+        caches_override.enable()
+        self.addCleanup(caches_override.disable)
+        # The caches of two gunicorn workers
+        self.workers = [TieredCache('test', {'OPTIONS': {'L2': 'shared', 'L1_TIMEOUT': 60}}) for _ in range(2)]
+
+    def session(self, worker, session_key=None):
+        session = SessionStore(session_key)
+        session._cache = self.workers[worker]
+        return session
+
+    def test_unchanged_session_is_not_written(self):
+        session = self.session(0)
+        session['shipping_method'] = 'pickup'
+        session.save()
+        session = self.session(0, session.session_key)
+        with self.assertNumQueries(0):
+            session['shipping_method'] = 'pickup'
+            session.save()
+        session['shipping_method'] = 'express'
+        session.save()
+        stored = SessionStore.get_model_class().objects.get(session_key=session.session_key)
+        self.assertEqual(stored.get_decoded(), {'shipping_method': 'express'})
+
+    def test_writes_reach_other_workers(self):
+        first = self.session(0)
+        first['step'] = 1
+        first.save()
+        self.assertEqual(self.session(1, first.session_key)['step'], 1)
+        generation = invalidation.generation()
+        first['step'] = 2
+        first.save()
+        with self.assertNumQueries(0):
+            self.assertEqual(self.session(1, first.session_key)['step'], 2)
+        # Only the session's tag moved; other workers keep their L1.
+        self.assertEqual(invalidation.generation(), generation)
+
+    def test_expired_sessions_are_swept_in_batches(self):
+        model = SessionStore.get_model_class()
+        for i in range(5):
+            model.objects.create(
+                session_key=f'expired{i}', session_data='', expire_date=timezone.now() - timedelta(days=1),
+            )
+        live = self.session(0)
+        live['step'] = 1
+        live.save()
+        self.assertEqual(list(SessionStore.sweep_expired(batch_size=2)), [2, 2, 1])
+        self.assertEqual(list(model.objects.values_list('session_key', flat=True)), [live.session_key])
+
+    def test_messages_use_a_cookie(self):
+        category = Category.objects.create(name='Cakes', slug='cakes', category_type='cakes')
+        cake = Product.objects.create(
+            name='Black Forest', slug='black-forest', category=category, description='Cake',
+            price=600, stock=4, image='products/cake.jpg',
+        )
+        response = self.client.post('/cart/add/', {'product_id': cake.pk, 'quantity': 1})
+        self.assertIn('messages', response.cookies)
+        self.assertFalse(SessionStore.get_model_class().objects.exists())
+
+
+class CleanupTests(TestCase):
+    """cleanup deletes stale rows in small batches and leaves live ones"""
+
+    def setUp(self):
+        self.old = timezone.now() - timedelta(days=60)
+        category = Category.objects.create(name='Breads', slug='breads', category_type='breads')
+        self.loaf = Product.objects.create(
+            name='Rye', slug='rye', category=category, description='Rye loaf', price=120, stock=5,
+            image='products/rye.jpg',
+        )
+
+    def order(self, number, **fields):
+        order = Order.objects.create(
+            order_number=number, customer_name='Baker', customer_email='baker@example.com', customer_phone='1',
+            shipping_address='1 Oven Lane', shipping_city='Varanasi', shipping_state='UP',
+            shipping_postal_code='221003', subtotal=120, total=120, **fields,
+        )
+        OrderItem.objects.create(
+            order=order, product=self.loaf, product_name='Rye', product_slug='rye', quantity=1, price=120,
+        )
+        Order.objects.filter(pk=order.pk).update(created_at=self.old)
+        return order
+
+    def test_cleanup(self):
+        abandoned = Cart.objects.create(user=User.objects.create_user('gone', 'gone@example.com', 'crumb-pass-1'))
+        CartItem.objects.create(cart=abandoned, product=self.loaf)
+        active = Cart.objects.create(user=User.objects.create_user('back', 'back@example.com', 'crumb-pass-1'))
+        item = CartItem.objects.create(cart=active, product=self.loaf)
+        Cart.objects.update(updated_at=self.old)
+        CartItem.objects.exclude(pk=item.pk).update(updated_at=self.old)
+        self.order('GLB-ABANDONED')
+        self.order('GLB-PAID', status='confirmed', payment_status='paid')
+        IdempotencyKey.objects.create(owner='u1', key='old', fingerprint='f', expires_at=self.old)
+        IdempotencyKey.objects.create(
+            owner='u1', key='new', fingerprint='f', expires_at=timezone.now() + timedelta(hours=1),
+        )
+
+        out = StringIO()
+        call_command('cleanup', batch_size=1, stdout=out)
+        self.assertIn('carts: deleted 2 rows in 1 batches', out.getvalue())
+        self.assertEqual(list(Cart.objects.all()), [active])
+        self.assertEqual(list(Order.objects.values_list('order_number', flat=True)), ['GLB-PAID'])
+        self.assertEqual(OrderItem.objects.count(), 1)
+        self.assertEqual(list(IdempotencyKey.objects.values_list('key', flat=True)), ['new'])
+
+    def test_slow_batches_shrink(self):
+        IdempotencyKey.objects.bulk_create([
+            IdempotencyKey(owner='u1', key=str(i), fingerprint='f', expires_at=self.old) for i in range(16)
+        ])
+        batches = cleanup.delete_in_batches(IdempotencyKey.objects.all(), batch_size=8, max_seconds=1e-9)
+        self.assertEqual(list(batches), [8, 4, 2, 1, 1])
+
+
+class ArchiveTests(TestCase):
+    """Finished orders move to the archive and can still be read"""
+
+    def setUp(self):
+        self.old = timezone.now() - timedelta(days=120)
+        self.user = User.objects.create_user('regular', 'regular@example.com', 'crumb-pass-1')
+        category = Category.objects.create(name='Breads', slug='breads', category_type='breads')
+        self.loaf = Product.objects.create(
+            name='Rye', slug='rye', category=category, description='Rye loaf', price=120, stock=5,
+            image='products/rye.jpg',
+        )
+
+    def order(self, number, created_at, **fields):
+        order = Order.objects.create(
+            order_number=number, user=self.user, customer_name='Baker', customer_email='baker@example.com',
+            customer_phone='1', shipping_address='1 Oven Lane', shipping_city='Varanasi', shipping_state='UP',
+            shipping_postal_code='221003', subtotal=120, total=120, **fields,
+        )
+        OrderItem.objects.create(
+            order=order, product=self.loaf, product_name='Rye', product_slug='rye', quantity=2, price=60,
+        )
+        Order.objects.filter(pk=order.pk).update(created_at=created_at, updated_at=created_at)
+        return order
+
+    def archive(self):
+        self.delivered = self.order(
+            'GLB-DELIVERED', self.old, status='delivered', payment_status='paid', counted_in_recommendations=True,
+        )
+        self.order('GLB-CANCELLED', self.old - timedelta(days=1), status='cancelled', payment_status='failed')
+        self.order('GLB-UNCOUNTED', self.old + timedelta(hours=1), status='delivered', payment_status='paid')
+        self.order('GLB-PENDING', self.old + timedelta(hours=2), status='pending')
+        self.order('GLB-RECENT', timezone.now(), status='delivered', payment_status='paid')
+        out = StringIO()
+        call_command('archive_orders', batch_size=1, stdout=out)
+        self.assertIn('archived 2 orders in 2 batches', out.getvalue())
+
+    def test_archive_orders(self):
+        self.archive()
+        self.assertEqual(
+            set(Order.objects.values_list('order_number', flat=True)), {'GLB-UNCOUNTED', 'GLB-PENDING', 'GLB-RECENT'},
+        )
+        archived = ArchivedOrder.objects.get(order_number='GLB-DELIVERED')
+        self.assertEqual((archived.pk, archived.created_at), (self.delivered.pk, self.old))
+        self.assertEqual(ArchivedOrderItem.objects.filter(order=archived).get().subtotal, 120)
+        self.assertEqual(OrderItem.objects.count(), 3)
+
+    def test_reads_include_archive(self):
+        self.archive()
+        self.client.force_login(self.user)
+        response = self.client.get(reverse('order_detail', args=['GLB-DELIVERED']))
+        self.assertContains(response, 'Rye')
+        response = self.client.get(reverse('user_orders'))
+        self.assertEqual(
+            [order.order_number for order in response.context['orders']],
+            ['GLB-RECENT', 'GLB-PENDING', 'GLB-UNCOUNTED', 'GLB-DELIVERED', 'GLB-CANCELLED'],
+        )
+        stats = get_dashboard_stats()
+        self.assertEqual((stats['total_orders'], stats['total_revenue']), (5, 360))
+        self.assertEqual(stats['average_order_value'], 120)
+
+    def test_admin_finds_archived_orders(self):
+        self.archive()
+        self.client.force_login(User.objects.create_superuser('admin', 'admin@example.com', 'crumb-pass-1'))
+        response = self.client.get(reverse('admin:shop_order_changelist'), {'q': 'GLB-DELIVERED'})
+        self.assertContains(response, '1 archived orders also match')
+        response = self.client.get(reverse('admin:shop_order_change', args=[self.delivered.pk]))
+        self.assertRedirects(response, reverse('admin:shop_archivedorder_change', args=[self.delivered.pk]))
+
+
+class ForecastTests(TestCase):
+    """forecast_demand plans each product's weekday pattern from paid orders"""
+
+    # Units sold from Monday to Sunday.
+    WEEK = [4, 4, 4, 4, 4, 8, 0]
+
+    def test_forecast(self):
+        from .forecast import forecast
+
+        history = np.array([self.WEEK * 8, [3] * 56], dtype=np.float64)
+        history[1, -7:] = 6
+        expected, quantity = forecast(history, first_weekday=0, horizon=7, alpha=0.5, service_level=0.9)
+        np.testing.assert_allclose(expected[0], self.WEEK)
+        self.assertEqual(quantity[0].tolist(), self.WEEK)
+        # A jump in sales raises the level and the margin.
+        self.assertTrue((expected[1] > 5).all() and (quantity[1] > expected[1]).all())
+
+    def test_forecast_demand(self):
+        category = Category.objects.create(name='Pastries', slug='pastries', category_type='pastries')
+        croissant, retired = (
+            Product.objects.create(
+                name=name.title(), slug=name, category=category, description=name, price=90, stock=20,
+                image='products/pastry.jpg', is_active=active,
+            )
+            for name, active in (('croissant', True), ('retired', False))
+        )
+        noon = timezone.localtime().replace(hour=12, minute=0, second=0, microsecond=0)
+        for days_ago in range(1, 29):
+            day = noon - timedelta(days=days_ago)
+            order = Order.objects.create(
+                order_number=f'GLB-{days_ago}', status='delivered', payment_status='paid',
+                counted_in_recommendations=True, customer_name='Ada', customer_email='ada@example.com',
+                customer_phone='1', shipping_address='1 Street', shipping_city='Pune', shipping_state='MH',
+                shipping_postal_code='411001', subtotal=0, total=0,
+            )
+            for product, units in ((croissant, self.WEEK[day.weekday()]), (retired, 1)):
+                if units:
+                    OrderItem.objects.create(
+                        order=order, product=product, product_name=product.name, product_slug=product.slug,
+                        quantity=units, price=90,
+                    )
+            Order.objects.filter(pk=order.pk).update(created_at=day, updated_at=day)
+        with override_settings(ORDER_ARCHIVE_DAYS=14):
+            self.assertEqual(sum(archive.archive_orders()), 14)
+
+        call_command('forecast_demand', days=7, history_days=28, stdout=open(os.devnull, 'w'))
+        plans = list(BakePlan.objects.order_by('bake_date'))
+        self.assertEqual({plan.product for plan in plans}, {croissant})
+        self.assertEqual([plan.quantity for plan in plans], [self.WEEK[plan.bake_date.weekday()] for plan in plans])
+        self.assertEqual([plan.last_week for plan in plans], [plan.quantity for plan in plans])
+
+        self.client.force_login(User.objects.create_superuser('admin', 'admin@example.com', 'crumb-pass-1'))
+        response = self.client.get(reverse('admin:shop_bakeplan_changelist'))
+        self.assertContains(response, 'Croissant')
+
+        # A quantity staff changed survives planning again; the others are updated in place.
+        edited = plans[0]
+        self.client.post(reverse('admin:shop_bakeplan_changelist'), {
+            'form-TOTAL_FORMS': '1', 'form-INITIAL_FORMS': '1',
+            'form-0-id': edited.pk, 'form-0-quantity': edited.quantity + 5, '_save': 'Save',
+        })
+        BakePlan.objects.exclude(pk=edited.pk).update(quantity=0)
+        call_command('forecast_demand', days=7, history_days=28, stdout=open(os.devnull, 'w'))
+        replanned = list(BakePlan.objects.order_by('bake_date'))
+        self.assertEqual([plan.pk for plan in replanned], [plan.pk for plan in plans])
+        self.assertEqual([plan.adjusted for plan in replanned], [True] + [False] * 6)
+        self.assertEqual(
+            [plan.quantity for plan in replanned], [edited.quantity + 5] + [plan.quantity for plan in plans[1:]]
+        )
+        self.assertEqual(replanned[0].forecast, edited.forecast)
+
+
+class MetricsTests(SimpleTestCase):
+    """Worker metric files merge into one Prometheus exposition"""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.enterContext(override_settings(METRICS_ENABLED=True, METRICS_DIR=self.directory))
+        # Stores of this process would still point at the default directory.
+        self.enterContext(patch.dict(metrics._stores, clear=True))
+        self.enterContext(patch.object(metrics, 'REGISTRY', []))
+
+    def store(self, kind, pid):
+        return metrics.MmapValues(os.path.join(self.directory, f'{kind}_{pid}.db'))
+
+    def test_collect_merges_processes(self):
+        key = json.dumps(['requests', 'requests_total', [['view', 'home']]])
+        self.store('values', 1).inc(key, 2)
+        self.store('values', 2).inc(key, 3)
+        self.assertEqual(metrics.collect(), {('requests_total', (('view', 'home'),)): 5.0})
+
+    def test_file_grows(self):
+        store = self.store('values', 1)
+        keys = [json.dumps(['m', 'm_total', [['n', str(i) * 40]]]) for i in range(2000)]
+        for i, key in enumerate(keys):
+            store.inc(key, i)
+        self.assertGreater(os.path.getsize(os.path.join(self.directory, 'values_1.db')), metrics._INITIAL_SIZE)
+        # A new mapping of the same file finds every entry.
+        reopened = self.store('values', 1)
+        reopened.inc(keys[-1], 1)
+        self.assertEqual(len(metrics.collect()), 2000)
+        self.assertEqual(metrics.collect()[('m_total', (('n', '1999' * 40),))], 2000)
+
+    def test_dead_process_gauges_dropped(self):
+        dead = subprocess.run([sys.executable, '-c', 'import os; print(os.getpid())'], capture_output=True, text=True)
+        pid = int(dead.stdout)
+        self.store('gauges', pid).set(json.dumps(['depth', 'depth', []]), 4)
+        self.store('values', pid).inc(json.dumps(['done', 'done_total', []]), 7)
+        self.store('gauges', os.getpid()).set(json.dumps(['depth', 'depth', []]), 1)
+        self.assertEqual(metrics.collect(), {('depth', ()): 1.0, ('done_total', ()): 7.0})
+        metrics.mark_process_dead(pid)
+        self.assertFalse(os.path.exists(os.path.join(self.directory, f'gauges_{pid}.db')))
+        self.assertEqual(metrics.collect(), {('depth', ()): 1.0, ('done_total', ()): 7.0})
+
+    def test_recycled_workers_fold_into_one_file(self):
+        done = json.dumps(['done', 'done_total', []])
+        bucket = json.dumps(['latency', 'latency_bucket', [['le', '0.1']]])
+        self.store('values', os.getpid()).inc(done, 1)
+        for pid in range(100, 110):
+            store = self.store('values', pid)
+            store.inc(done, 2)
+            store.inc(bucket, 1)
+            self.store('gauges', pid).set(json.dumps(['depth', 'depth', []]), 4)
+            metrics.mark_process_dead(pid)
+        self.assertEqual(metrics.collect(), {('done_total', ()): 21.0, ('latency_bucket', (('le', '0.1'),)): 10.0})
+        files = sorted(glob.glob('*.db', root_dir=self.directory))
+        self.assertEqual(files, sorted([f'values_{os.getpid()}.db', 'values_aggregate.db']))
+
+    def test_exiting_process_folds_its_files(self):
+        code = 'import django; django.setup(); from shop import metrics; metrics.ORDERS_ARCHIVED.inc(3)'
+        env = {**os.environ, 'DJANGO_SETTINGS_MODULE': 'goodluck_bakery.settings', 'METRICS_DIR': self.directory}
+        subprocess.run([sys.executable, '-c', code], cwd=settings.BASE_DIR, env=env, check=True)
+        self.assertEqual(glob.glob('*.db', root_dir=self.directory), ['values_aggregate.db'])
+        self.assertEqual(metrics.collect(), {('bakery_orders_archived_total', ()): 3.0})
+
+    def test_exposition(self):
+        latency = metrics.Histogram('latency_seconds', 'Latency.', ['view'], buckets=(0.1, 1.0))
+        responses = metrics.Counter('responses', 'Responses.', ['view'])
+        for value in (0.05, 0.5, 5):
+            latency.observe(value, view='home')
+        responses.inc(view='say "hi"\\\n')
+        self.assertEqual(metrics.generate_latest().splitlines(), [
+            '# HELP latency_seconds Latency.',
+            '# TYPE latency_seconds histogram',
+            'latency_seconds_bucket{view="home",le="0.1"} 1',
+            'latency_seconds_bucket{view="home",le="1.0"} 2',
+            'latency_seconds_bucket{view="home",le="+Inf"} 3',
+            'latency_seconds_count{view="home"} 3',
+            'latency_seconds_sum{view="home"} 5.55',
+            '# HELP responses Responses.',
+            '# TYPE responses counter',
+            'responses_total{view="say \\"hi\\"\\\\\\n"} 1',
+        ])
+
+
+@override_settings(METRICS_ALLOWED_IPS=['10.0.0.9'])
+class MetricsViewTests(TestCase):
+    """Requests are recorded and /metrics is only served to allowed IPs and staff"""
+
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.enterContext(override_settings(METRICS_ENABLED=True, METRICS_DIR=directory))
+        self.enterContext(patch.dict(metrics._stores, clear=True))
+
+    def test_middleware_records_requests(self):
+        self.client.get('/about/')
+        response = self.client.get('/metrics', REMOTE_ADDR='10.0.0.9')
+        self.assertContains(response, 'bakery_http_responses_total{view="about",status="200"} 1\n')
+        self.assertContains(response, 'bakery_http_request_duration_seconds_count{view="about",method="GET"} 1\n')
+
+    def test_access(self):
+        self.assertEqual(self.client.get('/metrics').status_code, 403)
+        self.assertEqual(self.client.get('/metrics', REMOTE_ADDR='10.0.0.9').status_code, 200)
+        self.client.force_login(User.objects.create_user('regular', 'regular@example.com', 'crumb-pass-1'))
+        self.assertEqual(self.client.get('/metrics').status_code, 403)
+        self.client.force_login(User.objects.create_user('staff', 'staff@example.com', 'crumb-pass-1', is_staff=True))
+        response = self.client.get('/metrics')
+        self.assertEqual(response.status_code, 200)
+        self.assertContains(response, '# TYPE bakery_http_responses counter')
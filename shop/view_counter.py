@@ -0,0 +1,174 @@
+"""Write-behind buffer for product view counts.
+
+Product page views are counted in memory per worker process and written
+in one batched ``UPDATE ... CASE`` statement by a background thread every
+``VIEW_COUNTER_FLUSH_INTERVAL`` seconds, or sooner once
+``VIEW_COUNTER_MAX_PENDING`` views are waiting. Those two settings bound
+how many views a crashed worker can lose; an interval of 0 disables the
+thread and flushes inline whenever the pending limit is reached.
+
+The same flush feeds ``Product.trending_score``, a forward-decayed view
+count: each view adds ``2 ** ((t - epoch) / half_life)``, so ordering by
+the stored score is the same as ordering by an exponentially decayed
+count, without rewriting old rows on every view. The weights grow without
+bound, so once they pass ``2 ** REBASE_HALVINGS`` ``rebase`` moves the
+epoch (``TrendingEpoch``) forward by whole half-lives and halves every
+score as many times, in one transaction. The flush reads the epoch in its
+UPDATE, so a worker that has not seen a rebase yet still writes the right
+weights.
+"""
+import atexit
+import collections
+import logging
+import math
+import os
+import threading
+import time
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.db import connections, transaction
+from django.db.models import Case, ExpressionWrapper, F, FloatField, IntegerField, Subquery, Value, When
+from django.db.models.functions import Coalesce, Power
+
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+TRENDING_EPOCH = 1767225600  # 2026-01-01 00:00 UTC, the first epoch
+# Weights stay below 2 ** REBASE_HALVINGS, far from the float limit of 2 ** 1024.
+REBASE_HALVINGS = 256
+BATCH_SIZE = 500
+
+_lock = threading.Lock()
+_wake = threading.Event()
+_pending = collections.Counter()
+_pending_events = 0
+_pid = None
+_flusher_running = False
+_epoch = TRENDING_EPOCH
+
+
+def _setting(name, default):
+    return getattr(settings, name, default)
+
+
+def half_life_seconds():
+    hours = _setting('TRENDING_HALF_LIFE_HOURS', 72)
+    if not hours > 0:
+        raise ImproperlyConfigured(f'TRENDING_HALF_LIFE_HOURS must be positive, not {hours!r}')
+    return hours * 3600
+
+
+def rebase(now=None):
+    """Move the epoch forward to ``now`` in whole half-lives, halving the scores to match."""
+    global _epoch
+    from .models import Product, TrendingEpoch
+
+    now = time.time() if now is None else now
+    half_life = half_life_seconds()
+    with transaction.atomic():
+        state, _ = TrendingEpoch.objects.select_for_update().get_or_create(pk=1, defaults={'epoch': TRENDING_EPOCH})
+        halvings = math.floor((now - state.epoch) / half_life)
+        if halvings > 0:
+            # Scores far enough below the rest become 0.
+            Product.objects.update(trending_score=F('trending_score') * 2.0 ** -halvings)
+            state.epoch += halvings * half_life
+            state.save(update_fields=['epoch'])
+    _epoch = state.epoch
+    return halvings
+
+
+def write_counts(counts, now=None):
+    """Add ``{slug: views}`` to the views and trending score columns."""
+    from .models import Product, TrendingEpoch
+
+    now = time.time() if now is None else now
+    half_life = half_life_seconds()
+    # The last epoch seen here is never ahead of the stored one.
+    if (now - _epoch) / half_life > REBASE_HALVINGS:
+        rebase(now)
+    epoch = Coalesce(Subquery(TrendingEpoch.objects.filter(pk=1).values('epoch')), Value(float(TRENDING_EPOCH)))
+    weight = Power(Value(2.0), (Value(float(now)) - epoch) / Value(float(half_life)))
+    items = list(counts.items())
+    for start in range(0, len(items), BATCH_SIZE):
+        batch = items[start:start + BATCH_SIZE]
+        views = Case(
+            *[When(slug=slug, then=Value(count)) for slug, count in batch],
+            default=Value(0), output_field=IntegerField(),
+        )
+        Product.objects.filter(slug__in=[slug for slug, _ in batch]).update(
+            views=F('views') + views,
+            trending_score=F('trending_score') + ExpressionWrapper(views * weight, output_field=FloatField()),
+        )
+
+
+def take_pending():
+    """Swap out and return the buffered counts."""
+    global _pending, _pending_events
+    with _lock:
+        counts, _pending = _pending, collections.Counter()
+        _pending_events = 0
+    metrics.TASK_QUEUE_DEPTH.set(0, queue='view_counter')
+    return counts
+
+
+def flush():
+    """Write buffered views now; returns the number of products updated."""
+    counts = take_pending()
+    if counts:
+        write_counts(counts)
+    return len(counts)
+
+
+def _flush_loop(interval):
+    while True:
+        _wake.wait(interval)
+        _wake.clear()
+        try:
+            flush()
+        except Exception:
+            # Keep the worker's flusher alive; the views are lost, which is
+            # within the configured durability bound.
+            logger.exception('Failed to flush product view counts')
+        finally:
+            connections.close_all()
+
+
+def _start_flusher():
+    """Start the flush thread once per process (again after a fork)."""
+    global _pid, _pending, _pending_events, _flusher_running
+    interval = _setting('VIEW_COUNTER_FLUSH_INTERVAL', 5)
+    with _lock:
+        if _pid == os.getpid():
+            return
+        if _pid is not None:
+            # Forked from a process that had counted views: those are the
+            # parent's to flush.
+            _pending = collections.Counter()
+            _pending_events = 0
+        _pid = os.getpid()
+    _flusher_running = interval > 0
+    if _flusher_running:
+        threading.Thread(target=_flush_loop, args=(interval,), daemon=True).start()
+    atexit.register(flush)
+
+
+def record_view(slug):
+    """Count one view of the product with ``slug``."""
+    global _pending_events
+    if not _setting('VIEW_COUNTER_BUFFERED', True):
+        write_counts({slug: 1})
+        return
+    if _pid != os.getpid():
+        _start_flusher()
+    with _lock:
+        _pending[slug] += 1
+        _pending_events += 1
+        pending = _pending_events
+    metrics.TASK_QUEUE_DEPTH.set(pending, queue='view_counter')
+    if pending >= _setting('VIEW_COUNTER_MAX_PENDING', 500):
+        if _flusher_running:
+            _wake.set()
+        else:
+            flush()
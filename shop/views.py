@@ -1,65 +1,115 @@
-from django.shortcuts import render, redirect, get_object_or_404
+from django.conf import settings
+from asgiref.sync import sync_to_async
+from django.shortcuts import render, redirect, get_object_or_404, aget_object_or_404
 from django.contrib.auth import login, authenticate, logout
 from django.contrib.auth.decorators import login_required
 from django.contrib.auth.views import PasswordResetView, PasswordResetConfirmView
 from django.contrib import messages
 from django.urls import reverse_lazy
-from django.db.models import Q, F, Sum, Avg, Count, Prefetch
+from django.db.models import Q, F, Sum, Avg, Count, Prefetch, OuterRef, Subquery
+from django.db.models.functions import Coalesce
 from django.utils import timezone
-from django.http import JsonResponse, HttpResponseBadRequest
-from django.views.decorators.http import require_POST
+from django.utils.cache import patch_cache_control
+from django.http import Http404, JsonResponse, HttpResponse, HttpResponseBadRequest, HttpResponseForbidden
+from django.views.decorators.http import require_POST, require_http_methods
 from django.views.decorators.csrf import csrf_exempt
-import stripe
+from decimal import Decimal
 import json
 import os
 
 from .models import (
-    Product, Category, Cart, CartItem, Order, OrderItem,
-    Review, Newsletter, ContactMessage
+    Product, Category, Cart, Order, OrderItem,
+    Review, Newsletter, ContactMessage, ProductRecommendation
 )
+from .archive import get_order_or_404, orders_for_user
+from . import autocomplete, metrics
+from .page_cache import (
+    add_cache_tags, cache_anonymous_page, conditional_page, is_background_refresh, page_meta, set_page_meta,
+)
+from .view_counter import record_view
+from .idempotency import idempotent, new_key
+from .carts import CartOperationError, acart_lines, aget_cart, apply_operations, cart_lines, get_cart
+from .templatetags.shop_filters import inr_price
 from .forms import (
     CustomUserCreationForm, UserProfileForm, ReviewForm,
     ContactForm, CheckoutForm, AddToCartForm, NewsletterForm
 )
-from goodluck_bakery.settings import STRIPE_SECRET_KEY, SITE_URL
 
 
-# Stripe Configuration
-stripe.api_key = STRIPE_SECRET_KEY
+def get_stripe():
+    """The ``stripe`` module, configured; imported on first use.
+
+    It pulls in ``requests`` and ``urllib3``, which only checkout and the
+    webhook need, so management commands and cold workers skip them.
+    """
+    import stripe
+    stripe.api_key = settings.STRIPE_SECRET_KEY
+    stripe.api_base = settings.STRIPE_API_BASE
+    return stripe
+
+
+# Operations accepted in one cart API request
+CART_MAX_OPERATIONS = 50
 
 
 # ============================================
 # HOME & GENERAL VIEWS
 # ============================================
 
-def home(request):
+async def arender(request, template_name, context=None):
+    """``render`` for async views.
+
+    Templates may still run queries (context processors, lazy querysets
+    behind fragment caches), so rendering happens on a worker thread.
+    """
+    return await sync_to_async(render)(request, template_name, context)
+
+
+def with_prices(products):
+    """Set current_price and is_on_sale on each product"""
+    for product in products:
+        product.current_price = product.get_current_price()
+        product.is_on_sale = product.is_on_sale()
+    return products
+
+
+def with_ratings(products):
+    """Annotate average_rating and review_count from active reviews"""
+    reviews = Review.objects.filter(product=OuterRef('pk'), is_active=True).order_by().values('product')
+    return products.annotate(
+        average_rating=Subquery(reviews.annotate(avg=Avg('rating')).values('avg')),
+        review_count=Coalesce(Subquery(reviews.annotate(count=Count('pk')).values('count')), 0),
+    )
+
+
+@cache_anonymous_page()
+async def home(request):
     """Home page view"""
-    featured_products = Product.objects.filter(
+    add_cache_tags(request, 'catalog')
+    featured_products = with_ratings(Product.objects.filter(
         is_active=True,
         is_featured=True
-    ).select_related('category')[:8]
+    ).select_related('category'))[:8]
 
-    new_products = Product.objects.filter(
+    new_products = with_ratings(Product.objects.filter(
         is_active=True
-    ).select_related('category').order_by('-created_at')[:8]
-
-    categories = Category.objects.filter(is_active=True)
+    ).select_related('category')).order_by('-created_at')[:8]
 
-    # Check if on sale
-    for product in featured_products:
-        product.current_price = product.get_current_price()
-        product.is_on_sale = product.is_on_sale()
+    trending_products = with_ratings(Product.objects.filter(
+        is_active=True,
+        trending_score__gt=0
+    ).select_related('category')).order_by('-trending_score')[:4]
 
-    for product in new_products:
-        product.current_price = product.get_current_price()
-        product.is_on_sale = product.is_on_sale()
+    # Only read when the cached category fragment is rebuilt.
+    categories = Category.objects.filter(is_active=True)
 
     context = {
-        'featured_products': featured_products,
-        'new_products': new_products,
+        'featured_products': with_prices([product async for product in featured_products]),
+        'new_products': with_prices([product async for product in new_products]),
+        'trending_products': with_prices([product async for product in trending_products]),
         'categories': categories,
     }
-    return render(request, 'shop/home.html', context)
+    return await arender(request, 'shop/home.html', context)
 
 
 def about(request):
@@ -87,9 +137,17 @@ def contact(request):
 # PRODUCT CATALOG VIEWS
 # ============================================
 
-def shop(request):
+def count_search(request):
+    """Count a search served from the page cache, if it found products"""
+    if page_meta(request).get('search_found'):
+        autocomplete.record_search(request.GET['q'])
+
+
+@cache_anonymous_page(on_hit=count_search)
+async def shop(request):
     """Shop page with all products"""
-    products = Product.objects.filter(is_active=True).select_related('category')
+    add_cache_tags(request, 'catalog')
+    products = with_ratings(Product.objects.filter(is_active=True).select_related('category'))
     categories = Category.objects.filter(is_active=True)
 
     # Get filter parameters
@@ -99,7 +157,7 @@ def shop(request):
 
     # Filter by category
     if category_slug:
-        category = get_object_or_404(Category, slug=category_slug, is_active=True)
+        category = await aget_object_or_404(Category, slug=category_slug, is_active=True)
         products = products.filter(category=category)
 
     # Search functionality
@@ -116,14 +174,16 @@ def shop(request):
         'price_low': 'price',
         'price_high': '-price',
         'newest': '-created_at',
-        'rating': '-reviews__rating',
+        'rating': F('average_rating').desc(nulls_last=True),
     }
     products = products.order_by(sort_options.get(sort_by, 'name'))
+    products = with_prices([product async for product in products])
 
-    # Add price and rating to each product
-    for product in products:
-        product.current_price = product.get_current_price()
-        product.is_on_sale = product.is_on_sale()
+    # Only searches that found something become suggestions.
+    search_found = bool(search_query and products)
+    set_page_meta(request, search_found=search_found)
+    if search_found and not is_background_refresh(request):
+        await sync_to_async(autocomplete.record_search)(search_query)
 
     context = {
         'products': products,
@@ -132,36 +192,83 @@ def shop(request):
         'sort_by': sort_by,
         'search_query': search_query,
     }
-    return render(request, 'shop/shop.html', context)
+    return await arender(request, 'shop/shop.html', context)
+
+
+async def search_suggestions(request):
+    """Autocomplete suggestions for the search box"""
+    # The first lookup in a worker may have to build the index.
+    suggestions = await sync_to_async(autocomplete.suggest)(request.GET.get('q', '')[:100])
+    response = JsonResponse({'suggestions': suggestions})
+    # The same for every visitor, so browsers and the proxy may keep them.
+    patch_cache_control(response, public=True, max_age=60)
+    return response
+
+
+def count_product_view(request, slug):
+    """Count a view of a product page served from the page cache"""
+    record_view(slug)
+
 
+def product_page_tags(request, slug):
+    """Cache tags of a product page, from one lookup on the slug index"""
+    rows = Product.objects.filter(slug=slug, is_active=True).values_list(
+        'pk', 'category_id', 'recommendations__recommended_id'
+    ).order_by()
+    if rows:
+        pk, category_id, _ = rows[0]
+        return [f'product:{pk}', f'category:{category_id}'] + [
+            f'product:{recommended}' for _, _, recommended in rows if recommended is not None
+        ]
 
-def product_detail(request, slug):
+
+def category_page_tags(request, slug):
+    """Cache tags of a category page, from one lookup on the slug index"""
+    pk = Category.objects.filter(slug=slug, is_active=True).values_list('pk', flat=True).first()
+    if pk is not None:
+        return [f'category:{pk}']
+
+
+@conditional_page(product_page_tags, on_not_modified=count_product_view)
+@cache_anonymous_page(on_hit=count_product_view)
+async def product_detail(request, slug):
     """Product detail page"""
-    product = get_object_or_404(
+    product = await aget_object_or_404(
         Product.objects.select_related('category').prefetch_related('reviews__user'),
         slug=slug,
         is_active=True
     )
+    add_cache_tags(request, f'product:{product.pk}', f'category:{product.category_id}')
 
-    # Increment view count
-    Product.objects.filter(pk=product.pk).update(views=F('views') + 1)
-
-    # Get related products from same category
-    related_products = Product.objects.filter(
-        category=product.category,
-        is_active=True
-    ).exclude(pk=product.pk)[:4]
+    # Frequently bought together (see build_recommendations), or products
+    # from the same category until this one has been ordered with others
+    related_products = [
+        recommendation.recommended async for recommendation in ProductRecommendation.objects.filter(
+            product=product,
+            recommended__is_active=True
+        ).select_related('recommended')
+    ]
+    bought_together = bool(related_products)
+    if bought_together:
+        add_cache_tags(request, *[f'product:{related.pk}' for related in related_products])
+    else:
+        related_products = [related async for related in Product.objects.filter(
+            category=product.category,
+            is_active=True
+        ).exclude(pk=product.pk)[:4]]
 
     # Get reviews
-    reviews = product.reviews.filter(is_active=True).select_related('user')
+    reviews = [review async for review in product.reviews.filter(is_active=True).select_related('user')]
+    rating = await product.reviews.filter(is_active=True).aaggregate(average=Avg('rating'), count=Count('pk'))
 
     # Check if user has reviewed
     user_reviewed = False
-    if request.user.is_authenticated:
-        user_reviewed = Review.objects.filter(
+    user = await request.auser()
+    if user.is_authenticated:
+        user_reviewed = await Review.objects.filter(
             product=product,
-            user=request.user
-        ).exists()
+            user=user
+        ).aexists()
 
     # Add to cart form
     cart_form = AddToCartForm()
@@ -171,33 +278,35 @@ def product_detail(request, slug):
         'current_price': product.get_current_price(),
         'is_on_sale': product.is_on_sale(),
         'discount_percent': product.get_discount_percentage(),
-        'average_rating': product.get_average_rating(),
-        'review_count': product.get_review_count(),
+        'average_rating': round(rating['average'], 1) if rating['count'] else 0,
+        'review_count': rating['count'],
         'related_products': related_products,
+        'bought_together': bought_together,
         'reviews': reviews,
         'user_reviewed': user_reviewed,
         'cart_form': cart_form,
     }
-    return render(request, 'shop/product_detail.html', context)
+    if not is_background_refresh(request):
+        await sync_to_async(record_view)(product.slug)
+    return await arender(request, 'shop/product_detail.html', context)
 
 
-def category_products(request, slug):
+@conditional_page(category_page_tags)
+@cache_anonymous_page()
+async def category_products(request, slug):
     """Products by category"""
-    category = get_object_or_404(Category, slug=slug, is_active=True)
-    products = Product.objects.filter(
+    category = await aget_object_or_404(Category, slug=slug, is_active=True)
+    add_cache_tags(request, f'category:{category.pk}')
+    products = with_ratings(Product.objects.filter(
         category=category,
         is_active=True
-    ).select_related('category')
-
-    for product in products:
-        product.current_price = product.get_current_price()
-        product.is_on_sale = product.is_on_sale()
+    ).select_related('category'))
 
     context = {
         'category': category,
-        'products': products,
+        'products': with_prices([product async for product in products]),
     }
-    return render(request, 'shop/category_products.html', context)
+    return await arender(request, 'shop/category_products.html', context)
 
 
 # ============================================
@@ -210,15 +319,13 @@ def get_or_create_cart(user):
     return cart
 
 
-@login_required
 def cart(request):
     """Shopping cart page"""
-    cart = get_or_create_cart(request.user)
-    cart_items = cart.items.select_related('product').all()
+    cart_items = cart_lines(get_cart(request))
 
     # Calculate subtotal for each item
-    total_items = cart.get_total_items()
-    subtotal = cart.get_total_price()
+    total_items = sum(item.quantity for item in cart_items)
+    subtotal = sum(item.get_subtotal() for item in cart_items)
 
     context = {
         'cart_items': cart_items,
@@ -228,8 +335,8 @@ def cart(request):
     return render(request, 'shop/cart.html', context)
 
 
-@login_required
 @require_POST
+@idempotent
 def add_to_cart(request):
     """Add product to cart"""
     product_id = request.POST.get('product_id')
@@ -240,84 +347,132 @@ def add_to_cart(request):
 
     product = get_object_or_404(Product, id=product_id, is_active=True)
 
-    if quantity > product.stock:
-        messages.error(request, f'Sorry, only {product.stock} items available in stock.')
+    try:
+        apply_operations(get_cart(request), [(product.pk, None, quantity)])
+    except CartOperationError as e:
+        messages.error(request, str(e))
         return redirect('product_detail', slug=product.slug)
 
-    cart = get_or_create_cart(request.user)
-    cart_item, created = CartItem.objects.get_or_create(
-        cart=cart,
-        product=product,
-        defaults={'quantity': quantity}
-    )
-
-    if not created:
-        new_quantity = cart_item.quantity + quantity
-        if new_quantity > product.stock:
-            messages.error(request, f'Sorry, only {product.stock} items available in stock.')
-            return redirect('product_detail', slug=product.slug)
-        cart_item.quantity = new_quantity
-        cart_item.save()
-
     messages.success(request, f'{product.name} added to cart!')
     return redirect('cart')
 
 
-@login_required
 @require_POST
+@idempotent
 def update_cart(request):
     """Update cart item quantity"""
-    item_id = request.POST.get('item_id')
+    product_id = request.POST.get('product_id')
     action = request.POST.get('action')
 
-    if not item_id:
-        return HttpResponseBadRequest('Item ID is required')
-
-    cart_item = get_object_or_404(
-        CartItem.objects.select_related('product', 'cart'),
-        id=item_id,
-        cart__user=request.user
-    )
+    if not product_id or not product_id.isdigit():
+        return HttpResponseBadRequest('Product ID is required')
+    product_id = int(product_id)
 
-    if action == 'increase':
-        if cart_item.quantity < cart_item.product.stock:
-            cart_item.quantity += 1
-            messages.success(request, 'Cart updated!')
-        else:
-            messages.warning(request, 'Maximum stock reached!')
-    elif action == 'decrease':
-        if cart_item.quantity > 1:
-            cart_item.quantity -= 1
-            messages.success(request, 'Cart updated!')
-        else:
-            messages.warning(request, 'Minimum quantity is 1!')
-    elif action == 'remove':
-        cart_item.delete()
+    cart = get_cart(request)
+    if action == 'remove':
+        apply_operations(cart, [(product_id, 0, None)])
         messages.success(request, 'Item removed from cart!')
         return redirect('cart')
 
-    cart_item.save()
+    quantity = next((item.quantity for item in cart_lines(cart) if item.product_id == product_id), None)
+    if quantity is None:
+        raise Http404('No such item in the cart')
+    if action == 'decrease' and quantity <= 1:
+        messages.warning(request, 'Minimum quantity is 1!')
+    elif action in ('increase', 'decrease'):
+        try:
+            apply_operations(cart, [(product_id, None, 1 if action == 'increase' else -1)])
+            messages.success(request, 'Cart updated!')
+        except CartOperationError:
+            messages.warning(request, 'Maximum stock reached!')
     return redirect('cart')
 
 
-@login_required
-def remove_from_cart(request, item_id):
-    """Remove item from cart"""
-    cart_item = get_object_or_404(
-        CartItem,
-        id=item_id,
-        cart__user=request.user
-    )
-    cart_item.delete()
+@require_POST
+@idempotent
+def remove_from_cart(request, product_id):
+    """Remove a product's line from the cart"""
+    apply_operations(get_cart(request), [(product_id, 0, None)])
     messages.success(request, 'Item removed from cart!')
     return redirect('cart')
 
 
+def cart_summary(cart_items):
+    """Lines and totals of a cart, as returned by the cart API"""
+    lines = []
+    total_items = 0
+    subtotal = 0
+    for item in cart_items:
+        line_subtotal = item.get_subtotal()
+        total_items += item.quantity
+        subtotal += line_subtotal
+        lines.append({
+            'product_id': item.product_id,
+            'quantity': item.quantity,
+            'stock': item.product.stock,
+            'unit_price': str(item.product.get_current_price()),
+            'subtotal': str(line_subtotal),
+            'subtotal_display': inr_price(line_subtotal),
+        })
+    tax = subtotal * Decimal('0.05')
+    return {
+        'lines': lines,
+        'total_items': total_items,
+        'subtotal': str(subtotal),
+        'subtotal_display': inr_price(subtotal),
+        'tax_display': inr_price(tax),
+    }
+
+
+def parse_cart_operations(body):
+    """Validate a batch of ``{"product_id", "quantity" | "delta"}`` operations"""
+    try:
+        operations = json.loads(body)['operations']
+    except (ValueError, KeyError, TypeError):
+        raise CartOperationError('Expected a JSON object with an "operations" list.')
+    if not isinstance(operations, list) or not 0 < len(operations) <= CART_MAX_OPERATIONS:
+        raise CartOperationError(f'Send between 1 and {CART_MAX_OPERATIONS} operations.')
+    parsed = []
+    for operation in operations:
+        if not isinstance(operation, dict) or ('quantity' in operation) == ('delta' in operation):
+            raise CartOperationError('Each operation needs a product_id and either quantity or delta.')
+        product_id, quantity, delta = (operation.get(key) for key in ('product_id', 'quantity', 'delta'))
+        # bool is an int subclass; reject it along with everything else.
+        if type(product_id) is not int or type(quantity if delta is None else delta) is not int:
+            raise CartOperationError('product_id, quantity and delta must be integers.')
+        if quantity is not None and quantity < 0:
+            raise CartOperationError('quantity cannot be negative.')
+        parsed.append((product_id, quantity, delta))
+    return parsed
+
+
+@require_http_methods(['GET', 'POST'])
+@idempotent
+async def cart_api(request):
+    """JSON cart: GET returns it, POST applies a batch of line operations atomically"""
+    cart = await aget_cart(request)
+    if request.method == 'POST':
+        try:
+            operations = parse_cart_operations(request.body)
+        except CartOperationError as e:
+            return JsonResponse({'error': str(e)}, status=400)
+        try:
+            # Runs in a transaction, which needs a thread of its own.
+            await sync_to_async(apply_operations)(cart, operations)
+        except CartOperationError as e:
+            # Nothing was applied; send the cart as it still is.
+            return JsonResponse(
+                {'error': str(e), 'index': e.index, 'cart': cart_summary(await acart_lines(cart))}, status=409
+            )
+    return JsonResponse(cart_summary(await acart_lines(cart)))
+
+
 # ============================================
 # CHECKOUT & ORDER VIEWS
 # ============================================
 
 @login_required
+@idempotent
 def checkout(request):
     """Checkout page"""
     cart = get_or_create_cart(request.user)
@@ -325,6 +480,7 @@ def checkout(request):
 
     if not cart_items:
         messages.warning(request, 'Your cart is empty!')
+        metrics.CHECKOUTS.inc(outcome='empty_cart')
         return redirect('shop')
 
     subtotal = cart.get_total_price()
@@ -340,7 +496,7 @@ def checkout(request):
                 'pickup': 0,
             }
             shipping_cost = shipping_costs.get(shipping_method, 49)
-            tax = subtotal * 0.05  # 5% GST for food items
+            tax = subtotal * Decimal('0.05')  # 5% GST for food items
             total = subtotal + shipping_cost + tax
 
             # Create order
@@ -381,6 +537,7 @@ def checkout(request):
                 request.user.save()
 
             # Create Stripe payment intent
+            stripe = get_stripe()
             try:
                 intent = stripe.PaymentIntent.create(
                     amount=int(total * 100),  # Amount in cents
@@ -391,10 +548,11 @@ def checkout(request):
                     },
                     description=f'Goodluck Bakery Order {order.order_number}'
                 )
+                metrics.CHECKOUTS.inc(outcome='payment_intent_created')
 
                 context = {
                     'order': order,
-                    'stripe_public_key': request.build_absolute_uri('/')[:-1],
+                    'stripe_public_key': os.getenv('STRIPE_PUBLIC_KEY', ''),
                     'client_secret': intent.client_secret,
                     'subtotal': subtotal,
                     'shipping_cost': shipping_cost,
@@ -404,9 +562,11 @@ def checkout(request):
                 return render(request, 'shop/payment.html', context)
 
             except stripe.error.StripeError as e:
+                metrics.CHECKOUTS.inc(outcome='payment_error')
                 messages.error(request, f'Payment error: {str(e)}')
                 order.delete()
                 return redirect('checkout')
+        metrics.CHECKOUTS.inc(outcome='invalid_form')
     else:
         form = CheckoutForm(user=request.user)
 
@@ -415,6 +575,7 @@ def checkout(request):
         'cart_items': cart_items,
         'subtotal': subtotal,
         'stripe_public_key': os.getenv('STRIPE_PUBLIC_KEY', ''),
+        'idempotency_key': new_key(),
     }
     return render(request, 'shop/checkout.html', context)
 
@@ -427,17 +588,21 @@ def stripe_webhook(request):
     payload = request.body
     sig_header = request.META.get('HTTP_STRIPE_SIGNATURE')
     webhook_secret = os.getenv('STRIPE_WEBHOOK_SECRET', '')
+    stripe = get_stripe()
 
     try:
         event = stripe.Webhook.construct_event(
             payload, sig_header, webhook_secret
         )
     except ValueError:
+        metrics.PAYMENTS.inc(outcome='invalid_payload')
         return HttpResponseBadRequest('Invalid payload')
     except stripe.error.SignatureVerificationError:
+        metrics.PAYMENTS.inc(outcome='invalid_signature')
         return HttpResponseBadRequest('Invalid signature')
 
     if event['type'] == 'payment_intent.succeeded':
+        metrics.PAYMENTS.inc(outcome='succeeded')
         payment_intent = event['data']['object']
         order_id = payment_intent['metadata'].get('order_id')
 
@@ -459,6 +624,10 @@ def stripe_webhook(request):
             # Clear cart
             cart = Cart.objects.get(user=order.user)
             cart.clear_cart()
+    elif event['type'] == 'payment_intent.payment_failed':
+        metrics.PAYMENTS.inc(outcome='failed')
+    else:
+        metrics.PAYMENTS.inc(outcome='ignored')
 
     return JsonResponse({'status': 'success'})
 
@@ -479,31 +648,21 @@ def payment_cancel(request):
 @login_required
 def order_confirmation(request, order_number):
     """Order confirmation page"""
-    order = get_object_or_404(
-        Order.objects.prefetch_related('items__product'),
-        order_number=order_number,
-        user=request.user
-    )
+    order = get_order_or_404(order_number=order_number, user=request.user)
     return render(request, 'shop/order_confirmation.html', {'order': order})
 
 
 @login_required
 def user_orders(request):
     """User orders list"""
-    orders = Order.objects.filter(
-        user=request.user
-    ).prefetch_related('items').order_by('-created_at')
+    orders = orders_for_user(request.user)
     return render(request, 'shop/user_orders.html', {'orders': orders})
 
 
 @login_required
 def order_detail(request, order_number):
     """Order detail page"""
-    order = get_object_or_404(
-        Order.objects.prefetch_related('items__product'),
-        order_number=order_number,
-        user=request.user
-    )
+    order = get_order_or_404(order_number=order_number, user=request.user)
     return render(request, 'shop/order_detail.html', {'order': order})
 
 
@@ -580,7 +739,7 @@ def profile(request):
     else:
         form = UserProfileForm(instance=request.user)
 
-    orders = Order.objects.filter(user=request.user).order_by('-created_at')[:5]
+    orders = orders_for_user(request.user, limit=5)
 
     context = {
         'form': form,
@@ -639,3 +798,18 @@ def newsletter_subscribe(request):
         messages.error(request, 'Please enter a valid email address.')
 
     return redirect('home')
+
+
+# ============================================
+# MONITORING VIEWS
+# ============================================
+
+def metrics_view(request):
+    """Prometheus metrics aggregated over all worker processes"""
+    allowed_ips = getattr(settings, 'METRICS_ALLOWED_IPS', [])
+    if request.META.get('REMOTE_ADDR') not in allowed_ips and not request.user.is_staff:
+        return HttpResponseForbidden('Forbidden')
+    return HttpResponse(
+        metrics.generate_latest(),
+        content_type='text/plain; version=0.0.4; charset=utf-8'
+    )
@@ -0,0 +1,74 @@
+"""Do the work of a worker's first requests before it takes traffic.
+
+``warm()`` builds the URL resolver, compiles the project's templates into
+the cached template loader, loads the translation catalog, imports and
+configures Stripe and maps the autocomplete index. ``wsgi.py`` and
+``asgi.py`` call it when ``WARMUP`` is on. Under ``gunicorn --preload``
+that happens once in the master, and every worker forks with it done.
+
+Nothing started here may outlive the fork: database connections are
+closed at the end, and the per-process state in ``metrics``,
+``view_counter`` and ``invalidation`` is recreated in each worker.
+"""
+import logging
+import time
+from pathlib import Path
+
+from django.conf import settings
+from django.db import connections
+from django.template import engines
+from django.urls import get_resolver
+from django.utils import translation
+
+from . import autocomplete
+
+
+logger = logging.getLogger(__name__)
+
+
+def _urls():
+    # Compiles every pattern and builds the reverse lookup tables.
+    get_resolver().reverse_dict
+
+
+def _templates():
+    for engine in engines.all():
+        for directory in map(Path, engine.engine.dirs):
+            for path in sorted(directory.rglob('*.html')):
+                engine.get_template(path.relative_to(directory).as_posix())
+
+
+def _translations():
+    with translation.override(settings.LANGUAGE_CODE):
+        translation.gettext('Home')
+
+
+def _stripe():
+    from .views import get_stripe
+    get_stripe()
+
+
+STEPS = (
+    ('urls', _urls),
+    ('templates', _templates),
+    ('translations', _translations),
+    ('stripe', _stripe),
+    ('autocomplete', autocomplete.get_snapshot),
+)
+
+
+def warm():
+    """Run every step and return ``{step: seconds}``; failures are logged."""
+    timings = {}
+    try:
+        for name, step in STEPS:
+            start = time.perf_counter()
+            try:
+                step()
+            except Exception:
+                logger.exception('Warm-up step %s failed', name)
+            timings[name] = time.perf_counter() - start
+    finally:
+        # Forked workers must not share the master's connections.
+        connections.close_all()
+    return timings
@@ -6,11 +6,17 @@ cd /workspace
 # Activate virtual environment
 source venv/bin/activate
 
-# Collect static files
-python manage.py collectstatic --noinput 2>/dev/null || true
-
-# Apply any pending migrations
-python manage.py migrate --noinput 2>/dev/null || true
+# Collect static files and apply pending migrations, but only when the code
+# changed since they last succeeded: each step boots Django, which is most
+# of a restart otherwise. Delete the stamp to force them.
+STAMP=.cache/release.stamp
+if [ ! -f "$STAMP" ] || [ -n "$(find static shop goodluck_bakery requirement.txt -newer "$STAMP" -print -quit)" ]; then
+    python manage.py collectstatic --noinput 2>/dev/null && collected=1
+    python manage.py migrate --noinput 2>/dev/null && migrated=1
+    if [ -n "$collected" ] && [ -n "$migrated" ]; then
+        mkdir -p .cache && touch "$STAMP"
+    fi
+fi
 
 # Start Django with gunicorn in production
 # For development, use runserver
@@ -19,5 +25,10 @@ if [ "$DEBUG" = "True" ]; then
     exec python manage.py runserver 0.0.0.0:8000
 else
     echo "Starting Django with gunicorn..."
-    exec gunicorn goodluck_bakery.wsgi:application --bind 0.0.0.0:8000 --workers 3
+    # Workers, threads, preloading and recycling come from gunicorn.conf.py;
+    # GUNICORN_PROFILE picks the worker model (threaded, async or sync).
+    if [ "$ASGI" = "True" ]; then
+        export GUNICORN_PROFILE=async
+    fi
+    exec gunicorn
 fi
@@ -339,6 +339,117 @@ document.addEventListener('DOMContentLoaded', function() {
         });
     }
 
+    // Search box suggestions
+    const searchInput = document.querySelector('#search-input');
+    const suggestionMenu = document.querySelector('#search-suggestions');
+    if (searchInput && suggestionMenu) {
+        let timer = null;
+        searchInput.addEventListener('input', function() {
+            clearTimeout(timer);
+            const query = this.value.trim();
+            if (query.length < 2) {
+                suggestionMenu.classList.remove('show');
+                return;
+            }
+            timer = setTimeout(function() {
+                fetch(`${searchInput.dataset.suggestUrl}?q=${encodeURIComponent(query)}`)
+                    .then(response => response.json())
+                    .then(data => {
+                        suggestionMenu.replaceChildren(...data.suggestions.map(function(suggestion) {
+                            const link = document.createElement('a');
+                            link.className = 'dropdown-item';
+                            link.href = suggestion.url;
+                            link.textContent = suggestion.label;
+                            return link;
+                        }));
+                        suggestionMenu.classList.toggle('show', data.suggestions.length > 0);
+                    });
+            }, 120);
+        });
+        searchInput.addEventListener('blur', function() {
+            setTimeout(() => suggestionMenu.classList.remove('show'), 200);
+        });
+    }
+
+    // Cart page: quantity changes go to the cart API in one batch
+    const cartLines = document.querySelector('#cart-lines');
+    if (cartLines) {
+        const pending = new Map();
+        let timer = null;
+
+        const render = function(cart) {
+            if (!cart.lines.length) {
+                window.location.reload();
+                return;
+            }
+            const lines = new Map(cart.lines.map(line => [String(line.product_id), line]));
+            cartLines.querySelectorAll('[data-cart-line]').forEach(function(row) {
+                const line = lines.get(row.dataset.cartLine);
+                if (!line) {
+                    row.remove();
+                    return;
+                }
+                row.querySelector('.quantity-input').value = line.quantity;
+                row.querySelector('.line-subtotal').textContent = line.subtotal_display;
+            });
+            document.querySelector('#cart-total-items').textContent = cart.total_items;
+            document.querySelector('#cart-tax').textContent = cart.tax_display;
+            document.querySelectorAll('.cart-subtotal').forEach(el => el.textContent = cart.subtotal_display);
+        };
+
+        const flush = function() {
+            const operations = Array.from(pending.values());
+            pending.clear();
+            CartAPI.applyOperations(cartLines.dataset.cartApi, operations).then(function(data) {
+                const error = document.querySelector('#cart-error');
+                error.classList.toggle('d-none', !data.error);
+                error.textContent = data.error || '';
+                if (data.cart || data.lines) {
+                    render(data.cart || data);
+                }
+            });
+        };
+
+        cartLines.addEventListener('click', function(e) {
+            const button = e.target.closest('[data-cart-delta], [data-cart-remove]');
+            if (!button) {
+                return;
+            }
+            e.preventDefault();
+            const productId = Number(button.closest('[data-cart-line]').dataset.cartLine);
+            const operation = pending.get(productId) || {product_id: productId, delta: 0};
+            if (button.hasAttribute('data-cart-remove')) {
+                pending.set(productId, {product_id: productId, quantity: 0});
+            } else if ('delta' in operation) {
+                operation.delta += Number(button.dataset.cartDelta);
+                pending.set(productId, operation);
+            }
+            // Clicks in quick succession are sent together.
+            clearTimeout(timer);
+            timer = setTimeout(flush, 300);
+        });
+    }
+
+    // Cart forms carry one idempotency key per submission, so a double
+    // click or a resubmitted request does not add the item twice.
+    document.addEventListener('submit', function(e) {
+        const form = e.target;
+        if (!form.hasAttribute('data-idempotent') || form.querySelector('input[name="idempotency_key"]')) {
+            return;
+        }
+        const input = document.createElement('input');
+        input.type = 'hidden';
+        input.name = 'idempotency_key';
+        input.value = newIdempotencyKey();
+        form.appendChild(input);
+    });
+    window.addEventListener('pageshow', function(e) {
+        // Coming back to the page is a new submission.
+        if (e.persisted) {
+            document.querySelectorAll('form[data-idempotent] input[name="idempotency_key"]').forEach(el => el.remove());
+        }
+    });
+
     // Coupon code validation (placeholder)
     const couponForm = document.querySelector('#coupon-form');
     if (couponForm) {
@@ -351,10 +462,9 @@ document.addEventListener('DOMContentLoaded', function() {
     }
 });
 
-// Stripe Payment Handler (if on payment page)
-const stripe = Stripe(stripePublicKey);
-
-function handlePayment(clientSecret) {
+// Stripe Payment Handler (called by the payment page)
+function handlePayment(publicKey, clientSecret) {
+    const stripe = Stripe(publicKey);
     const elements = stripe.elements({
         fonts: {
             cssSrc: 'https://fonts.googleapis.com/css2?family=Poppins:wght@400;500;600&display=swap'
@@ -424,8 +534,8 @@ const CartAPI = {
         }).then(response => response.json());
     },
 
-    removeItem: function(itemId) {
-        return fetch(`/cart/remove/${itemId}/`, {
+    removeItem: function(productId) {
+        return fetch(`/cart/remove/${productId}/`, {
             method: 'POST',
             headers: {
                 'X-CSRFToken': document.querySelector('[name=csrfmiddlewaretoken]').value
@@ -436,7 +546,29 @@ const CartAPI = {
     getCart: function() {
         return fetch('/cart/api/')
             .then(response => response.json());
+    },
+
+    applyOperations: function(url, operations) {
+        const send = () => fetch(url, {
+            method: 'POST',
+            headers: {
+                'Content-Type': 'application/json',
+                'X-CSRFToken': document.querySelector('[name=csrfmiddlewaretoken]').value,
+                'Idempotency-Key': key
+            },
+            body: JSON.stringify({operations: operations})
+        });
+        const key = newIdempotencyKey();
+        // A retry with the same key is applied at most once.
+        return send().catch(send).then(response => response.json());
     }
 };
 
+function newIdempotencyKey() {
+    if (window.crypto && crypto.randomUUID) {
+        return crypto.randomUUID();
+    }
+    return Array.from(crypto.getRandomValues(new Uint8Array(16)), b => b.toString(16).padStart(2, '0')).join('');
+}
+
 console.log('Goodluck Bakery - Loaded successfully');